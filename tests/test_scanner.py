@@ -0,0 +1,80 @@
+# Path: test/test_scanner.py
+
+import json
+import random
+from glob import glob
+
+from umtoken.alphabet import EU24_ALPHABET, unescape
+from umtoken.pre import PreTokenizer, SPLIT_REGEX, LEGACY_SPLIT_REGEX, SCANNER_SPLIT_REGEXES
+from umtoken.scanner import SplitScanner
+
+ASSETS = ["./assets/ipt_eu3_24k_l3--tied.json",
+          "./assets/wikipedia_eu8_40k_l3--tied.json",
+          "./assets/wikipedia_eu15_64k_l3--tied.json"]
+
+EXAMPLES = [
+    "Resistivity is_commonly represented  by the Greek letter ρ (rho). The SI unit of electrical resistivity is the ohm-meter (Ω⋅m).",
+    "   indentation",
+    "\n\nnew paragraph",
+    "\t\t\ttabbed text",
+    "### heading 3",
+    "x<sup>2</sup>+y H<sub>2</sub>O foo<u>bar</u> <ux> text{++added++}more {--removed--} {==highlighted==}",
+    "ABCdef ABc AAb Aa ǅemal ᾈ SCHWEIẞE Σίσυφος ΣΙΣΥΦΟΣ ٣٤ ² 中文ＡＢＣ",
+    " \n \n\n  \r\n\x85 \xa0 　 end",
+]
+
+def get_corpora():
+    texts = list(EXAMPLES)
+    for path in ["README.md"] + sorted(glob("umtoken/langs/*.md")):
+        with open(path, "r", encoding="utf8") as f:
+            texts.append(f.read())
+    return texts
+
+def assert_same_spans(pattern, texts):
+    pre = PreTokenizer(alphabet=EU24_ALPHABET, split_regex=pattern)
+    scanner = SplitScanner(markup=SCANNER_SPLIT_REGEXES[pattern])
+    for text in texts:
+        expected = [m.span(1) for m in pre.split_regex.finditer(text)]
+        actual = list(scanner.spans(text))
+        assert actual == expected, f"Spans differ for {text[:40]!r}"
+
+def test_scanner_corpora():
+    texts = get_corpora()
+    assert_same_spans(SPLIT_REGEX, texts)
+    assert_same_spans(LEGACY_SPLIT_REGEX, texts)
+
+def test_scanner_assets():
+    for file in ASSETS:
+        with open(file, "r", encoding="utf8") as f:
+            d = json.load(f)
+        pattern = d["pre"]["split_regex"]
+        assert pattern in SCANNER_SPLIT_REGEXES
+        # join the unescaped vocab with various separators to cover all characters of the vocab
+        words = [unescape(v) for v in d["model"]["vocab"]]
+        texts = [" ".join(words), "".join(words), "\n".join(words)]
+        assert_same_spans(pattern, texts)
+
+def test_scanner_random():
+    rnd = random.Random(42)
+    chars = list("aAbBß ǅᾈΣσ\n\t\r\x85\xa0　<>/subp{}=+-.!#1٣²中Ａ") + ["<sub>", "</sup>", "<u>", "{==", "++}", "--}"]
+    for pattern, markup in SCANNER_SPLIT_REGEXES.items():
+        pre = PreTokenizer(alphabet=EU24_ALPHABET, split_regex=pattern)
+        scanner = SplitScanner(markup=markup)
+        for _ in range(5000):
+            text = "".join(rnd.choice(chars) for _ in range(rnd.randint(0, 16)))
+            pos = rnd.randint(0, len(text))
+            endpos = rnd.randint(pos, len(text))
+            expected = [m.span(1) for m in pre.split_regex.finditer(text, pos, endpos)]
+            actual = list(scanner.spans(text, pos, endpos))
+            assert actual == expected, f"Spans differ for {text!r} ({pos}, {endpos})"
+
+def test_pre_tokenizer_split_engine():
+    text = "[SOT]Resistivity is  ρ\n (rho).[EOT] x²­\n"
+    for normalization in ["default", "ipt", None]:
+        kwargs = dict(alphabet=EU24_ALPHABET, normalization=normalization, reserved_tokens=["[SOT]", "[EOT]"])
+        pre_regex = PreTokenizer(**kwargs)
+        pre_scanner = PreTokenizer(split_engine="scanner", **kwargs)
+        for handle_reserved in [False, True]:
+            assert pre_scanner.split(text, handle_reserved=handle_reserved) == pre_regex.split(text, handle_reserved=handle_reserved)
+            assert (pre_scanner.split_and_escape(text, handle_reserved=handle_reserved, return_ranges=True) ==
+                    pre_regex.split_and_escape(text, handle_reserved=handle_reserved, return_ranges=True))
@@ -0,0 +1,142 @@
+# Path: test/test_tokenizer.py
+
+import random
+from glob import glob
+
+from umtoken.cache import SegmentCache
+from umtoken.streaming import StreamingTokenizer
+from umtoken.tokenizer import Tokenizer
+
+TOKENIZER_FILE = "./assets/ipt_eu3_24k_l3--tied.json"
+
+def get_long_text():
+    texts = []
+    for path in ["README.md"] + sorted(glob("umtoken/langs/*.md")):
+        with open(path, "r", encoding="utf8") as f:
+            texts.append(f.read())
+    # add reserved tokens, odd whitespace, and characters changed by normalization
+    return "[SOT]" + "[EOT]\r\n \n[SOT]Ω⋅m x² Café­  \n".join(texts) + "[EOT]"
+
+def test_segment_boundaries():
+    tokenizer = Tokenizer.load(TOKENIZER_FILE)
+    pre = tokenizer.pre
+    text = get_long_text()
+    for handle_reserved in [False, True]:
+        cuts = pre.find_segment_boundaries(text, 200, handle_reserved=handle_reserved)
+        assert len(cuts) > 10
+        expected = pre.split_and_escape(text, handle_reserved=handle_reserved, return_ranges=True)
+        words = []
+        ranges = []
+        for start, end in zip([0] + cuts, cuts + [len(text)]):
+            w, r = pre.split_and_escape(text[start:end], handle_reserved=handle_reserved, return_ranges=True)
+            words.extend(w)
+            ranges.extend((s + start, l) for s, l in r)
+        assert (words, ranges) == expected
+
+def test_tokenize_long():
+    tokenizer = Tokenizer.load(TOKENIZER_FILE)
+    text = get_long_text()
+    expected = tokenizer.tokenize(text, handle_reserved=True, return_ranges=True)
+    actual = tokenizer.tokenize_long(text, workers=2, segment_length=1000, handle_reserved=True, return_ranges=True)
+    assert actual == expected
+    with tokenizer.create_pool(2) as pool:
+        actual = tokenizer.tokenize_long(text, segment_length=500, pool=pool, merge_prop_ids=False)
+    assert actual == tokenizer.tokenize(text, merge_prop_ids=False)
+
+def test_segment_cache():
+    tokenizer = Tokenizer.load(TOKENIZER_FILE)
+    cache = SegmentCache(max_tokens=2000)
+    system = "[SOT]You are a helpful assistant. Answer briefly.[EOT]\n"
+    examples = [system + "[SOT]What is the capital of France?[EOT]",
+                system + "[SOT]Wie heißt die Hauptstadt von Frankreich?[EOT]",
+                system + "[SOT]What is the capital of France?[EOT]",
+                "[SOT]Ω⋅m x² Café​ [EOT] \n[SOT][EOT]"]
+    for example in examples:
+        expected = tokenizer.tokenize(example, handle_reserved=True, return_ranges=True)
+        actual = tokenizer.tokenize(example, handle_reserved=True, return_ranges=True, segment_cache=cache)
+        assert actual == expected
+        assert tokenizer.tokenize(example, handle_reserved=True, allowed_reserved=["[SOT]"], segment_cache=cache) == \
+            tokenizer.tokenize(example, handle_reserved=True, allowed_reserved=["[SOT]"])
+    assert cache.hits > 0
+    assert cache.token_count <= cache.max_tokens
+
+    # bounded memory: least recently used segments are evicted
+    cache = SegmentCache(max_tokens=20)
+    tokenizer.tokenize(get_long_text(), handle_reserved=True, segment_cache=cache)
+    assert 0 < cache.token_count <= 20
+
+def test_retokenize():
+    tokenizer = Tokenizer.load(TOKENIZER_FILE)
+    rnd = random.Random(42)
+    text = get_long_text()[:20000]
+    inserts = ["", "a", " ", "\n", "X", "[EOT]", "[SO", "ü", "­", " Hello World. ", "²\r\n"]
+    for handle_reserved in [False, True]:
+        local_cache = {}
+        result = tokenizer.tokenize(text, handle_reserved=handle_reserved, return_ranges=True)
+        edited = text
+        for _ in range(50):
+            offset = rnd.randint(0, len(edited))
+            deleted_len = rnd.choice([0, 0, 1, 5, 100])
+            inserted = rnd.choice(inserts)
+            edited = edited[:offset] + inserted + edited[offset + deleted_len:]
+            result = tokenizer.retokenize(edited, result, (offset, deleted_len, inserted),
+                                          handle_reserved=handle_reserved, local_cache=local_cache)
+            assert result == tokenizer.tokenize(edited, handle_reserved=handle_reserved, return_ranges=True)
+
+def test_streaming_tokenizer():
+    tokenizer = Tokenizer.load(TOKENIZER_FILE)
+    rnd = random.Random(42)
+    text = get_long_text()[:20000] + " Σίσυφος ΣΙΣΥΦΟΣ 中文。 x­\n"
+    for handle_reserved in [False, True]:
+        expected = tokenizer.tokenize(text, handle_reserved=handle_reserved, return_ranges=True)
+        stream = StreamingTokenizer(tokenizer, handle_reserved=handle_reserved, return_ranges=True)
+        actual = ([], [], [])
+        pos = 0
+        while pos < len(text):
+            end = pos + rnd.randint(1, 20)
+            result = stream.push(text[pos:end])
+            for a, r in zip(actual, result):
+                a.extend(r)
+            pos = end
+        # only the trailing fragment is held back
+        assert len(stream.buffer) < 100
+        for a, r in zip(actual, stream.flush()):
+            a.extend(r)
+        assert actual == expected
+    stream = StreamingTokenizer(tokenizer)
+    assert stream.push("Hello world") == tokenizer.tokenize("Hello")
+    assert stream.flush() == tokenizer.tokenize(" world")
+
+def test_streaming_tokenizer_max_buffer_length():
+    tokenizer = Tokenizer.load(TOKENIZER_FILE)
+    rnd = random.Random(42)
+    # no blanks, so there are no safe cut positions
+    text = "中文的句子没有空格所以不能切开。这是第二句话，还是没有空格。" * 200
+    expected = tokenizer.tokenize(text, return_ranges=True)
+    stream = StreamingTokenizer(tokenizer, return_ranges=True, max_buffer_length=100)
+    actual = ([], [], [])
+    pos = 0
+    while pos < len(text):
+        end = pos + rnd.randint(1, 20)
+        result = stream.push(text[pos:end])
+        for a, r in zip(actual, result):
+            a.extend(r)
+        assert len(stream.buffer) <= 120
+        pos = end
+    for a, r in zip(actual, stream.flush()):
+        a.extend(r)
+    # cut at the start of the last word
+    assert actual == expected
+    # a single word is cut at the end of the buffer
+    stream = StreamingTokenizer(tokenizer, return_ranges=True, max_buffer_length=100)
+    word_ranges = []
+    for _ in range(100):
+        word_ranges.extend(stream.push("中文")[1])
+        assert len(stream.buffer) <= 100
+    word_ranges.extend(stream.flush()[1])
+    assert word_ranges[0][0] == 0 and len(word_ranges) > 1
+    assert all(s + n == s2 for (s, n), (s2, _) in zip(word_ranges, word_ranges[1:]))
+    assert sum(n for _, n in word_ranges) == 200
+    # without a maximum length, the text is held back until flush
+    stream = StreamingTokenizer(tokenizer, max_buffer_length=None)
+    assert stream.push(text[:1000]) == []
@@ -0,0 +1,737 @@
+# Path: test/test_trainer.py
+
+import os
+import pickle
+from collections import Counter
+from glob import glob
+from multiprocessing import Process
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from umtoken.alphabet import get_alphabet
+from umtoken.candidates import top_substrings
+from umtoken.langs import get_rules
+from umtoken.lattice import PackedLattices
+from umtoken.model import Model, digamma, MIN_LOGIT
+from umtoken.pool import FilePool, WorkerPool, imap_batches, serve
+from umtoken.pre import PreTokenizer
+import umtoken.trainer as trainer_module
+from umtoken.trainer import (Trainer, TrainerConfig, shared_morpher, build_lattices_single, step_E_lattices_single,
+                             compute_losses_lattices_single, step_E_pool, compute_losses_pool, subsample_words,
+                             extrapolate_logits, extend_model, nll_pool, restore_logits,
+                             _init_shard, _build_shard_lattices, _iter_shard, _remap_shard)
+from umtoken.utils import balanced_ranges, word_cost
+from umtoken.words import WordTable
+
+LANGS = ["de", "en", "fr"]
+
+def get_words_by_lang():
+    pre = PreTokenizer(alphabet=get_alphabet(LANGS), preserve_soft_hyphen=True)
+    words_by_lang = {}
+    for lang in LANGS:
+        counter = Counter()
+        for path in ["README.md"] + sorted(glob(f"umtoken/langs/{lang}*.md")):
+            with open(path, "r", encoding="utf8") as f:
+                for word in pre.split_and_escape(f.read()):
+                    word = word.strip(" ")
+                    if len(word) > 1:
+                        counter[word] += 1
+        words_by_lang[lang] = counter
+    return words_by_lang
+
+def get_trainer(**kwargs):
+    config = TrainerConfig(alphabet=get_alphabet(LANGS), **{"vocab_size": 600, "spread_factor": 4, "iterations": 3, "workers": 1, **kwargs})
+    return Trainer(config)
+
+def get_model(trainer, words):
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    candidates = sorted(trainer.generate_candidates(words) | trainer.protected_tokens)
+    model = Model(candidates, rules, [0.0] * len(candidates), [0.0] * len(rules),
+                  trainer.config.alpha, trainer.config.beta, langs=LANGS)
+    model.reset_logits()
+    return model
+
+def test_top_substrings():
+    words = [(w, c) for counter in get_words_by_lang().values() for w, c in counter.items()]
+    expected = top_substrings(words, 500, 12)
+    counts = Counter()
+    for word, count in words:
+        for i in range(len(word)):
+            for j in range(i + 2, min(i + 12, len(word)) + 1):
+                counts[word[i:j]] += count
+    assert sorted(c for _, c in expected) == sorted(counts.values())[-500:]
+    for max_entries in [2000, 10000]:
+        assert top_substrings(words, 500, 12, max_entries=max_entries) == expected
+    with WorkerPool(2) as pool:
+        table = WordTable.from_words([w for w, _ in words], [c for _, c in words])
+        pool.run(_init_shard, [(table[s:e],) for s, e in balanced_ranges([1] * len(words), 2)])
+        for max_entries in [None, 10000]:
+            assert top_substrings(None, 500, 12, max_entries=max_entries, pool=pool) == expected
+
+def test_prepare_words():
+    words_by_lang = get_words_by_lang()
+    words_by_lang["en"]["Hauptbahnhof"] = words_by_lang["de"]["Hauptbahnhof"] = 2
+    trainer = get_trainer(tie_by_langs=True, min_balance_langs=0.5)
+    words, lang_by_words = trainer.prepare_words({"tokenizer": 3}, words_by_lang)
+    assert len(words) == len(lang_by_words) and isinstance(words, WordTable)
+    expected = Counter({"tokenizer": 3})
+    for lang_words in words_by_lang.values():
+        expected.update(lang_words)
+    expected = [w for w, c in expected.items() if not w.isdigit() and w not in trainer.protected_tokens]
+    assert [w for w, _ in words] == [w + "X" for w in expected]
+    for (word, count), lang in zip(words, lang_by_words):
+        lang_counts = {l: words_by_lang[l].get(word[:-1], 0) for l in LANGS}
+        if word == "HauptbahnhofX":
+            # ties go to the first language
+            assert lang == "de" and count >= 4
+        elif max(lang_counts.values()) > 0:
+            assert lang_counts[lang] == max(lang_counts.values())
+        else:
+            assert lang is None
+    # slices are views, only the sliced part is pickled
+    part = words[100:110]
+    assert np.shares_memory(part.buffer, words.buffer) and list(part) == list(words)[100:110]
+    assert list(part.lang_by_words) == list(lang_by_words[100:110])
+    restored = pickle.loads(pickle.dumps(part))
+    assert list(restored) == list(part) and len(restored.buffer) == part.sizes().sum()
+    assert words.costs()[100:110].tolist() == [word_cost(w.encode("utf-8")) for w, _ in part]
+
+def test_train_out_of_core():
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    words_by_lang = get_words_by_lang()
+    kwargs = {"tie_by_langs": True, "min_balance_langs": 0.9, "subsample_schedule": [0.5], "workers": 2}
+    trainer = get_trainer(**kwargs)
+    words, lang_by_words = trainer.prepare_words(None, words_by_lang)
+    with TemporaryDirectory() as directory:
+        # the partitions are merged from iterables of (word, count) pairs
+        iterables = {lang: iter(lang_words.items()) for lang, lang_words in words_by_lang.items()}
+        mapped, mapped_langs = trainer.prepare_words_on_disk(None, iterables, directory, partitions=4)
+        assert mapped.path == directory and len(mapped) == len(words)
+        assert sorted(zip(mapped, mapped_langs)) == sorted(zip(words, lang_by_words))
+        # slices of mapped tables are pickled as references
+        assert len(pickle.dumps(mapped[10:len(mapped)])) < 1000
+        assert list(pickle.loads(pickle.dumps(mapped[10:20]))) == list(mapped)[10:20]
+
+        expected = trainer.train(rules, words, None)
+        model = get_trainer(stream_dir=directory, stream_chunk_size=200, **kwargs).train(rules, words, None)
+        assert model.vocab == expected.vocab and np.array_equal(model.vocab_langs, expected.vocab_langs)
+        assert np.allclose(model.vocab_logits, expected.vocab_logits, atol=1e-5)
+        model = get_trainer(stream_dir=directory, stream_chunk_size=200, **kwargs).train(rules, mapped, None)
+        assert len(model.vocab) == trainer.config.vocab_size
+
+def test_update_logits():
+    assert np.allclose(digamma(np.array([0.5, 1.0, 10.0])), [-1.9635100260, -0.5772156649, 2.2517525891])
+    assert np.isclose(digamma(1.0), -0.5772156649)
+    trainer = get_trainer()
+    words, _ = trainer.prepare_words(None, get_words_by_lang())
+    model = get_model(trainer, words)
+    m_vocab = np.random.default_rng(0).exponential(1.0, len(model.vocab)) * (np.arange(len(model.vocab)) % 4 != 0)
+    model.update_logits(m_vocab, [0.0] * len(model.rules))
+    valid = m_vocab >= 1e-3
+    expected = np.maximum([digamma(c) - digamma(m_vocab[valid].sum()) for c in m_vocab[valid]], MIN_LOGIT)
+    assert np.allclose(model.vocab_logits[valid], expected)
+    assert np.all(model.vocab_logits[~valid] == MIN_LOGIT) and np.all(model.rules_logits == MIN_LOGIT)
+
+def init_pool(pool, model, words):
+    pool.run(_init_shard, [(words[s:e],) for s, e in balanced_ranges(words.costs(), pool.workers)])
+    with shared_morpher(pool, model, force_slow=False):
+        pool.broadcast(_build_shard_lattices, model, False, None)
+
+def test_packed_lattices():
+    trainer = get_trainer()
+    words, lang_by_words = trainer.prepare_words(None, get_words_by_lang())
+    counts = np.array([c for _, c in words])
+    model = get_model(trainer, words)
+    lattices = build_lattices_single(model, words, lang_by_words, show_progress=False, force_slow=False)
+    assert len(lattices) == len(words)
+
+    # the E-step on the lattices of the workers matches the E-step on the lattices of single words
+    m_vocab, m_rules = [0.0] * len(model.vocab), [0.0] * len(model.rules)
+    nll = -sum(model.add_marginal(word, count, lang, m_vocab, m_rules) for (word, count), lang in zip(words, lang_by_words))
+    nll /= counts.sum()
+    for workers in [1, 2]:
+        with WorkerPool(workers) as pool:
+            init_pool(pool, model, words)
+            packed_nll, packed_m_vocab, packed_m_rules, _ = step_E_pool(pool, model)
+            assert np.isclose(packed_nll, nll)
+            assert np.allclose(packed_m_vocab, m_vocab)
+            assert np.allclose(packed_m_rules, m_rules)
+    model.update_logits(m_vocab, m_rules)
+    with WorkerPool(2) as pool:
+        init_pool(pool, model, words)
+        pool_losses = compute_losses_pool(pool, model)
+    edge_logits = model.score_edges(lattices)
+    logits_forward = lattices.forward_sum(edge_logits)
+    logits_backward = lattices.backward_sum(edge_logits)
+    marginals = lattices.marginal_logits(edge_logits, logits_forward, logits_backward)
+    removal_losses = lattices.removal_losses(edge_logits, logits_forward, logits_backward)
+    best_logits, path = lattices.viterbi(edge_logits)
+    on_path = np.zeros(lattices.edge_count, dtype=bool)
+    on_path[path] = True
+    for k, (word, lang) in enumerate(zip(words.iter_words(), lang_by_words)):
+        # the lattice of a single word has the same edges in the same order
+        lattice = model.build_lattice(word, lang)
+        s, e = lattices.offsets[k], lattices.offsets[k+1]
+        assert [edge[-1] for edge in lattice.edges] == list(zip(lattices.vocab_ids[s:e].tolist(), lattices.rule_ids[s:e].tolist()))
+        best = lattice.viterbi()
+        assert best_logits[k] == (sum(edge[2] for edge in best) if best else -np.inf)
+        assert sorted(lattice.edges.index(edge) for edge in best or []) == np.flatnonzero(on_path[s:e]).tolist()
+        lattice.forward_sum()
+        lattice.backward_sum()
+        assert np.allclose(marginals[s:e], lattice.marginal_logits())
+        # losses of edges that are (almost) necessary are dominated by rounding noise
+        expected = np.array(lattice.removal_losses())
+        assert np.allclose(np.minimum(removal_losses[s:e], 20), np.minimum(expected, 20))
+    expected_losses = compute_losses_lattices_single(lattices, edge_logits, counts, len(model.vocab), show_progress=False)
+    assert np.allclose(pool_losses, expected_losses)
+    # the losses can be computed by the E-step
+    losses = np.zeros(len(model.vocab))
+    step_E_lattices_single(lattices, edge_logits, counts, len(model.vocab), len(model.rules), show_progress=False, losses=losses)
+    assert np.allclose(losses, expected_losses)
+
+    indices = np.arange(0, len(lattices), 7)
+    selected = lattices.select(indices)
+    expected = PackedLattices.concatenate([lattices.slice(k, k + 1) for k in indices])
+    for name in ["lengths", "offsets", "starts", "ends", "vocab_ids", "rule_ids"]:
+        assert np.array_equal(getattr(selected, name), getattr(expected, name))
+
+    # removing vocab entries only removes edges
+    keep = np.arange(len(model.vocab)) % 3 != 1
+    vocab_map = np.where(keep, np.cumsum(keep) - 1, -1)
+    pruned = Model([v for v, k in zip(model.vocab, keep) if k], model.rules, model.vocab_logits[keep], model.rules_logits,
+                   model.alpha, model.beta, langs=LANGS)
+    expected = build_lattices_single(pruned, words, lang_by_words, show_progress=False, force_slow=False)
+    actual = lattices.remap_vocab(vocab_map)
+    for name in ["lengths", "offsets", "starts", "ends", "vocab_ids", "rule_ids"]:
+        assert np.array_equal(getattr(actual, name), getattr(expected, name))
+
+def test_subsample_words():
+    rng = np.random.default_rng(0)
+    counts = np.floor(1000.0 / np.arange(1, 5001)) + 1 # tail-heavy
+    estimates = np.zeros(len(counts))
+    for _ in range(200):
+        indices, weights = subsample_words(counts, 0.1, rng)
+        assert np.all(np.diff(indices) > 0)
+        assert abs(len(indices) - 500) < 100
+        # frequent words are always kept with their counts
+        assert np.array_equal(indices[:10], np.arange(10)) and np.array_equal(weights[:10], counts[:10])
+        estimates[indices] += weights
+    # the weighted sample is an unbiased estimate of the counts
+    assert np.isclose(estimates.sum() / 200, counts.sum(), rtol=0.02)
+
+def test_step_E_viterbi():
+    trainer = get_trainer()
+    words, _ = trainer.prepare_words(None, get_words_by_lang())
+    model = get_model(trainer, words)
+    with WorkerPool(2) as pool:
+        init_pool(pool, model, words)
+        nll, m_vocab, _, _ = step_E_pool(pool, model)
+        hard_nll, hard_m_vocab, _, _, soft_nll = step_E_pool(pool, model, hard=True, with_soft_nll=True)
+        expected_nll = nll_pool(pool, model)
+    # the best decompositions are counted with the (integer) counts of their words
+    assert np.array_equal(hard_m_vocab, np.round(hard_m_vocab)) and not np.array_equal(m_vocab, np.round(m_vocab))
+    # the NLL of all decompositions is computed in the same pass
+    assert np.isclose(soft_nll, nll) and np.isclose(soft_nll, expected_nll) and hard_nll > soft_nll
+
+class HardTrainer(Trainer):
+    """Records the token counts of the E-steps (and whether they are hard)."""
+    def train(self, *args, **kwargs):
+        self.counts = []
+        return super().train(*args, **kwargs)
+
+    def step_E(self, pool, model, hard=False, with_losses=False, with_soft_nll=False):
+        result = super().step_E(pool, model, hard, with_losses, with_soft_nll)
+        self.counts.append((hard, result[1]))
+        return result
+
+def test_train_hard_em(monkeypatch):
+    # the NLL of hard EM iterations is reported without an extra pass
+    nll_calls = []
+    monkeypatch.setattr(trainer_module, "nll_pool", lambda *args: nll_calls.append(args))
+    trainer = HardTrainer(get_trainer(hard_em_iterations=2).config)
+    model = trainer.train(get_rules(LANGS, remove_unconditional_op_rules=True), None, get_words_by_lang())
+    assert len(model.vocab) == trainer.config.vocab_size
+    assert nll_calls == []
+    assert [hard for hard, _ in trainer.counts] == [True] * 4 + [False] * 3
+    for hard, m_vocab in trainer.counts:
+        assert np.array_equal(m_vocab, np.round(m_vocab)) == hard
+
+def test_train_subsampled_hard_em():
+    trainer = get_trainer(iterations=4, subsample_schedule=[0.3, 0.6], hard_em_iterations=1)
+    model = trainer.train(get_rules(LANGS, remove_unconditional_op_rules=True), None, get_words_by_lang())
+    assert len(model.vocab) == trainer.config.vocab_size
+
+def _has_sample(state):
+    return state.get("sample") is not None
+
+class SampleTrainer(Trainer):
+    """Records whether the E-steps use a sample, and whether the workers still hold a sample after the EM steps."""
+    def train(self, *args, **kwargs):
+        self.sampled_steps = []
+        self.has_sample = []
+        return super().train(*args, **kwargs)
+
+    def step_E(self, pool, model, hard=False, with_losses=False, with_soft_nll=False):
+        self.pool = pool
+        self.sampled_steps.append(any(pool.broadcast(_has_sample)))
+        return super().step_E(pool, model, hard, with_losses, with_soft_nll)
+
+    def eval_model(self, model, eval_words):
+        self.has_sample.append(any(self.pool.broadcast(_has_sample)))
+
+def test_train_subsampled_em_steps():
+    # all EM steps of the scheduled iterations use the sample, only the other iterations use all words
+    trainer = SampleTrainer(get_trainer(iterations=4, subsample_schedule=[0.3, 0.6]).config)
+    model = trainer.train(get_rules(LANGS, remove_unconditional_op_rules=True), None, get_words_by_lang())
+    assert len(model.vocab) == trainer.config.vocab_size
+    # two EM steps in each of the first three iterations, three in the final iteration
+    assert trainer.sampled_steps == [True] * 4 + [False] * 5
+    assert trainer.has_sample == [False] * trainer.config.iterations
+
+def test_restore_logits():
+    logits = np.log(np.array([0.6, 0.4, 0.0, 0.0]) + 1e-12).astype(np.float32)
+    prev_logits = np.log(np.array([0.25, 0.25, 0.25, 0.25]))
+    restored = restore_logits(logits, prev_logits, np.array([False, False, True, False]))
+    # the restored entry keeps its share relative to the others, the total mass is unchanged
+    assert np.isclose(np.exp(restored).sum(), np.exp(logits.astype(np.float64)).sum(), rtol=1e-5)
+    assert np.isclose(restored[0] - restored[1], logits[0] - logits[1])
+    assert np.isclose(restored[2] - restored[0], prev_logits[2] - logits[0])
+    assert restored[3] == MIN_LOGIT
+
+def test_extrapolate_logits():
+    # EM steps that converge geometrically towards the target are extrapolated beyond the last step
+    target = np.log(np.array([0.5, 0.3, 0.2]))
+    points = [(target + 0.5 ** k * np.array([-1.0, 0.5, 0.5]), np.array([0.0, -20.0])) for k in range(3)]
+    vocab_logits, rules_logits = extrapolate_logits(*points)
+    assert np.abs(vocab_logits - target).max() < np.abs(points[2][0] - target).max()
+    assert np.array_equal(rules_logits, points[2][1])
+    # without progress, the last step is kept
+    vocab_logits, _ = extrapolate_logits(points[0], points[0], points[0])
+    assert np.array_equal(vocab_logits, points[0][0])
+
+def test_train_squarem():
+    trainer = get_trainer(em_steps=6, em_tolerance=1e-3, squarem=True)
+    model = trainer.train(get_rules(LANGS, remove_unconditional_op_rules=True), None, get_words_by_lang())
+    assert len(model.vocab) == trainer.config.vocab_size
+
+class NLLTrainer(Trainer):
+    """
+    Records the NLLs of the E-steps the M-steps are based on (per iteration),
+    and the NLL of the last E-step and of the logits each iteration ends with.
+    """
+    def train(self, *args, **kwargs):
+        self.nlls = []
+        self.trajectories = [[]]
+        return super().train(*args, **kwargs)
+
+    def step_E(self, pool, model, hard=False, with_losses=False, with_soft_nll=False):
+        self.pool = pool
+        result = super().step_E(pool, model, hard, with_losses, with_soft_nll)
+        self.last_nll = result[0]
+        return result
+
+    def step_M(self, model, m_vocab, m_rules):
+        self.trajectories[-1].append(self.last_nll)
+        super().step_M(model, m_vocab, m_rules)
+
+    def eval_model(self, model, eval_words):
+        self.nlls.append((self.last_nll, nll_pool(self.pool, model)))
+        self.trajectories.append([])
+
+def test_train_squarem_final_nll(monkeypatch):
+    # extrapolations that overshoot (here: back to the first point) must be rejected by an E-step,
+    # so with the default EM steps, the last step of an iteration is not extrapolated
+    monkeypatch.setattr(trainer_module, "extrapolate_logits", lambda logits0, logits1, logits2: logits0)
+    trainer = NLLTrainer(get_trainer(squarem=True).config)
+    trainer.train(get_rules(LANGS, remove_unconditional_op_rules=True), None, get_words_by_lang())
+    assert len(trainer.nlls) == trainer.config.iterations
+    for last_nll, final_nll in trainer.nlls:
+        assert final_nll <= last_nll + 1e-6
+
+def test_train_squarem_nll_trajectory(monkeypatch):
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    trainer = NLLTrainer(get_trainer(em_steps=6, squarem=True).config)
+    trainer.train(rules, None, get_words_by_lang())
+    for trajectory in trainer.trajectories[:-1]:
+        assert len(trajectory) == 6
+        assert all(b <= a + 1e-6 for a, b in zip(trajectory, trajectory[1:]))
+    # an extrapolation back to the point before the last EM step does not increase the NLL,
+    # but it is worse than the EM step it replaces, so it is rejected
+    monkeypatch.setattr(trainer_module, "extrapolate_logits", lambda logits0, logits1, logits2: logits1)
+    trainer.train(rules, None, get_words_by_lang())
+    for trajectory in trainer.trajectories[:-1]:
+        assert all(b < a for a, b in zip(trajectory, trajectory[1:]))
+
+class LossesTrainer(Trainer):
+    """Records whether the E-steps compute the pruning losses."""
+    def train(self, *args, **kwargs):
+        self.with_losses = []
+        return super().train(*args, **kwargs)
+
+    def step_E(self, pool, model, hard=False, with_losses=False, with_soft_nll=False):
+        self.with_losses.append(with_losses)
+        return super().step_E(pool, model, hard, with_losses, with_soft_nll)
+
+def test_train_approx_prune_losses(monkeypatch):
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    for hard_em_iterations in [0, 2]:
+        trainer = get_trainer(approx_prune_losses=True, hard_em_iterations=hard_em_iterations)
+        model = trainer.train(rules, None, get_words_by_lang())
+        assert len(model.vocab) == trainer.config.vocab_size
+    # only the last E-step of an iteration computes the losses, the final iteration does not need them
+    loss_calls = []
+    def counting_losses_pool(*args):
+        loss_calls.append(args)
+        return compute_losses_pool(*args)
+    monkeypatch.setattr(trainer_module, "compute_losses_pool", counting_losses_pool)
+    trainer = LossesTrainer(get_trainer(approx_prune_losses=True).config)
+    trainer.train(rules, None, get_words_by_lang())
+    assert trainer.with_losses == [False, True] * 2 + [False] * 3
+    assert loss_calls == []
+    # after an early stop, the losses are computed once by an extra pass
+    trainer = LossesTrainer(get_trainer(approx_prune_losses=True, em_steps=4, em_tolerance=1e9).config)
+    trainer.train(rules, None, get_words_by_lang())
+    assert trainer.with_losses == [False] * 2 * trainer.config.iterations
+    assert 0 < len(loss_calls) <= trainer.config.iterations - 1
+
+def _set_value(state, value):
+    state["value"] = value
+
+def _get_value(state, offset):
+    assert state["value"] >= 0, "negative value"
+    return state["index"], state["value"] + offset
+
+def test_worker_pool():
+    for workers in [1, 3]:
+        with WorkerPool(workers) as pool:
+            pool.run(_set_value, [(i * 10,) for i in range(workers)])
+            assert pool.broadcast(_get_value, 1) == [(i, i * 10 + 1) for i in range(workers)]
+            try:
+                pool.broadcast(_get_value, None)
+                assert False, "expected an error"
+            except (RuntimeError, TypeError):
+                pass
+            # workers survive errors
+            assert pool.broadcast(_get_value, 2)[0] == (0, 2)
+
+def _scale(factor, batch):
+    return [factor * x for x in batch]
+
+def test_balanced_ranges():
+    costs = [1, 9, 1, 1, 4, 4, 1, 1, 1, 1]
+    for n in [1, 2, 3, 20]:
+        ranges = balanced_ranges(costs, n)
+        assert len(ranges) == n
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(costs)
+        assert all(e1 == s2 for (_, e1), (s2, _) in zip(ranges, ranges[1:]))
+        # each range stays below its share unless it consists of a single expensive item
+        assert all(sum(costs[s:e]) <= sum(costs) / n + max(costs) for s, e in ranges)
+    batches = [list(range(s, e)) for s, e in balanced_ranges(costs, 5)]
+    for workers in [1, 2]:
+        assert list(imap_batches(_scale, 2, batches, workers)) == [_scale(2, b) for b in batches]
+
+def _decompose(state, model, words):
+    return [sorted(model.morpher.decompose(word, None)) for word in words]
+
+def test_shared_morpher():
+    trainer = get_trainer()
+    words, _ = trainer.prepare_words(None, get_words_by_lang())
+    model = get_model(trainer, words)
+    words = [w for w, _ in words[:200]]
+    expected = [sorted(model.morpher.decompose(word, None)) for word in words]
+    with TemporaryDirectory() as directory:
+        model.morpher.share(directory)
+        data = pickle.dumps(model.morpher)
+        assert len(data) < len(pickle.dumps(model.morpher.stem_trie))
+        morpher = pickle.loads(data)
+        assert [sorted(morpher.decompose(word, None)) for word in words] == expected
+        # the values of the base trie are read from the shared array
+        assert [type(v) for _, v in morpher.base_trie.prefixes_and_values(words[0])] == [int] * len(morpher.base_trie.prefixes(words[0]))
+        model.morpher.unshare()
+    with WorkerPool(2) as pool:
+        with shared_morpher(pool, model, force_slow=False):
+            assert pool.broadcast(_decompose, model, words) == [expected, expected]
+
+def _shard_lattices(state):
+    pieces = list(_iter_shard(state, sampled=False))
+    return PackedLattices.concatenate([lattices for lattices, _ in pieces]), np.concatenate([counts for _, counts in pieces])
+
+def test_rebalance_shards():
+    words, _ = get_trainer().prepare_words(None, get_words_by_lang())
+    model = get_model(get_trainer(), words)
+    words = WordTable.from_words([w for w, _ in words], [c for _, c in words])
+    expected = build_lattices_single(model, words, words.lang_by_words, False, False)
+    shards = [(0, 10), (10, 20), (20, len(words))]
+    with TemporaryDirectory() as directory:
+        for stream_dir in [None, directory]:
+            trainer = get_trainer(workers=3, stream_dir=stream_dir, stream_chunk_size=100)
+            with WorkerPool(3) as pool:
+                pool.run(_init_shard, [(words[s:e], stream_dir) for s, e in shards])
+                trainer.build_lattices(pool, model)
+                new_shards = trainer.rebalance_shards(pool, words, shards)
+                assert new_shards[0][0] == 0 and new_shards[-1][1] == len(words)
+                assert all(e - s > 100 for s, e in new_shards)
+                if stream_dir is None:
+                    assert new_shards == balanced_ranges(np.diff(expected.offsets), 3)
+                for (s, e), (lattices, counts) in zip(new_shards, pool.broadcast(_shard_lattices)):
+                    part = expected.slice(s, e)
+                    for name in ["lengths", "offsets", "starts", "ends", "vocab_ids", "rule_ids"]:
+                        assert np.array_equal(getattr(lattices, name), getattr(part, name))
+                    assert np.array_equal(counts, words.counts[s:e])
+
+def test_remap_shard_replay():
+    trainer = get_trainer()
+    words, _ = trainer.prepare_words(None, get_words_by_lang())
+    model = get_model(trainer, words)
+    words = WordTable.from_words([w for w, _ in words[:300]], [c for _, c in words[:300]])
+    vocab_maps = []
+    size = len(model.vocab)
+    for _ in range(2):
+        keep = np.arange(size) % 3 != 1
+        vocab_maps.append(np.where(keep, np.cumsum(keep) - 1, -1))
+        size = int(keep.sum())
+    expected = build_lattices_single(model, words, words.lang_by_words, False, False)
+    for vocab_map in vocab_maps:
+        expected = expected.remap_vocab(vocab_map)
+    with TemporaryDirectory() as directory:
+        # a worker that takes over the shard replays the calls on the files of the previous worker
+        for _ in range(2):
+            state = {"index": 0}
+            _init_shard(state, words, directory)
+            _build_shard_lattices(state, model, False, 100)
+            for vocab_map in vocab_maps:
+                _remap_shard(state, vocab_map)
+            lattices, _ = _shard_lattices(state)
+            for name in ["lengths", "offsets", "starts", "ends", "vocab_ids", "rule_ids"]:
+                assert np.array_equal(getattr(lattices, name), getattr(expected, name))
+            assert sorted(os.listdir(directory)) == [f"lattices-0-{k}-v2.npz" for k in range(3)]
+
+def test_extend_vocab():
+    trainer = get_trainer()
+    words, lang_by_words = trainer.prepare_words(None, get_words_by_lang())
+    model = get_model(trainer, words)
+    added = [v for v in model.vocab if len(v) > 3][::10]
+    base = Model([v for v in model.vocab if v not in added], model.rules, [0.0] * (len(model.vocab) - len(added)),
+                 model.rules_logits, model.alpha, model.beta, langs=LANGS)
+    vocab = list(base.vocab)
+    assert base.extend_vocab(added + vocab[:3]) == list(range(len(vocab), len(vocab) + len(added))) + [0, 1, 2]
+    assert base.vocab == vocab + added and len(base.vocab_logits) == len(base.vocab)
+    morpher = pickle.loads(pickle.dumps(base.morpher))
+    for word, _ in words[:300]:
+        expected = sorted((model.vocab[b], r, i, j) for b, r, i, j in model.morpher.decompose(word, None))
+        for force_slow in [False, True]:
+            assert sorted((base.vocab[b], r, i, j) for b, r, i, j in base.morpher.decompose(word, None, force_slow)) == expected
+        assert sorted((base.vocab[b], r, i, j) for b, r, i, j in morpher.decompose(word, None)) == expected
+
+def test_remap_vocab():
+    trainer = get_trainer()
+    words, _ = trainer.prepare_words(None, get_words_by_lang())
+    model = get_model(trainer, words)
+    full_vocab = list(model.vocab)
+    words = [w for w, _ in words[:300]]
+    rng = np.random.default_rng(0)
+    for keep_rate in [0.8, 0.3]:
+        # reorder and remove tokens, the tries are compacted when most of their bases are removed
+        keep = rng.random(len(model.vocab)) < keep_rate
+        vocab_map = np.full(len(model.vocab), -1)
+        vocab_map[keep] = rng.permutation(int(keep.sum()))
+        model.remap_vocab(vocab_map)
+        vocab_langs = rng.integers(1, 1 << len(LANGS), len(model.vocab))
+        model.update_tied_langs(LANGS, vocab_langs)
+        expected = Model(model.vocab, model.rules, model.vocab_logits, model.rules_logits, model.alpha, model.beta,
+                         langs=LANGS, vocab_langs=vocab_langs)
+        for word in words:
+            for langs in [None, "de"]:
+                for force_slow in [False, True]:
+                    assert (sorted(model.morpher.decompose(word, langs, force_slow)) ==
+                            sorted(expected.morpher.decompose(word, langs, force_slow)))
+    # removed tokens can be added again
+    removed = [v for v in full_vocab if v not in model.vocab_lookup][:20]
+    model.extend_vocab(removed)
+    expected = Model(model.vocab, model.rules, model.vocab_logits, model.rules_logits, model.alpha, model.beta,
+                     langs=LANGS, vocab_langs=model.vocab_langs)
+    for word in words:
+        assert sorted(model.morpher.decompose(word, None)) == sorted(expected.morpher.decompose(word, None))
+
+def test_extend_model():
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    trainer = get_trainer()
+    model = trainer.train(rules, None, get_words_by_lang())
+    vocab, vocab_logits = list(model.vocab), model.vocab_logits.copy()
+    words, lang_by_words = trainer.prepare_words(None, {"en": {"tokenizers": 10, "tokenization": 5}})
+    ids = extend_model(model, ["tokeniz", "tokenizat"], words, lang_by_words, workers=2)
+    assert ids == [600, 601] and model.vocab[:600] == vocab
+    assert np.all(model.vocab_logits[ids] > vocab_logits.min())
+    assert set(t for t, _ in model.encode("tokenizers")) & set(ids)
+    # tokens that don't occur in the words keep their relative logits
+    unused = [i for i, v in enumerate(vocab) if v[:2] not in "tokenizers tokenization" and vocab_logits[i] > -15]
+    assert np.allclose(np.diff(model.vocab_logits[unused]), np.diff(vocab_logits[unused]), atol=0.05)
+
+def test_train():
+    trainer = get_trainer(tie_by_langs=True)
+    model = trainer.train(get_rules(LANGS, remove_unconditional_op_rules=True), None, get_words_by_lang())
+    assert len(model.vocab) == trainer.config.vocab_size
+    assert model.vocab[:len(trainer.config.reserved_tokens)] == trainer.config.reserved_tokens
+    assert model.decode(model.encode("tokenizer")) == "tokenizer"
+
+def _add_value(state, offset):
+    state["value"] += offset
+
+def _value(state):
+    return state["value"]
+
+def _get_pid(state):
+    return os.getpid()
+
+def start_servers(directory, count, stale_after=60):
+    processes = [Process(target=serve, args=(directory, 0.01, 60, stale_after)) for _ in range(count)]
+    for process in processes:
+        process.start()
+    return processes
+
+def test_file_pool():
+    with TemporaryDirectory() as directory:
+        # the third process finds all shards claimed, it stands by until the run ends
+        processes = start_servers(directory, 3)
+        with FilePool(directory, 2, poll_interval=0.01, timeout=60) as pool:
+            pool.run(_set_value, [(10,), (20,)])
+            assert pool.broadcast(_get_value, 1) == [(0, 11), (1, 21)]
+            pool.run(_set_value, [(-1,), (5,)])
+            try:
+                pool.broadcast(_get_value, 1)
+                assert False
+            except RuntimeError as e:
+                assert "negative value" in str(e)
+            # the workers keep serving after an error
+            pool.run(_set_value, [(3,), (5,)])
+            assert pool.broadcast(_get_value, 2) == [(0, 5), (1, 7)]
+            # values are exchanged without pickling, only other arguments are pickled, results must be values
+            value = {"counts": np.arange(3.0), "pair": (None, [True, "x"])}
+            pool.broadcast(_set_value, value)
+            result = pool.broadcast(_value)[0]
+            assert result.keys() == value.keys() and np.array_equal(result["counts"], value["counts"])
+            assert result["pair"] == value["pair"]
+            pool.run(_set_value, [({1},), ({2},)])
+            assert not glob(os.path.join(pool.run_dir, "task-*.pkl"))
+            assert len(glob(os.path.join(pool.run_dir, "args-*.pkl"))) == 2
+            try:
+                pool.broadcast(_value)
+                assert False, "expected an error"
+            except RuntimeError as e:
+                assert "cannot be saved without pickling" in str(e)
+        for process in processes:
+            process.join(60)
+            assert process.exitcode == 0
+        assert os.listdir(directory) == []
+
+def test_file_pool_takeover():
+    with TemporaryDirectory() as directory:
+        processes = start_servers(directory, 3, stale_after=0.5)
+        with FilePool(directory, 2, poll_interval=0.01, timeout=60, stale_after=0.5) as pool:
+            pool.run(_set_value, [(10,), (20,)])
+            pool.broadcast(_add_value, 5)
+            pids = pool.broadcast(_get_pid)
+            killed = next(process for process in processes if process.pid == pids[1])
+            killed.kill()
+            # the process standing by takes over the shard, and restores its state by replaying the calls
+            assert pool.broadcast(_get_value, 1) == [(0, 16), (1, 26)]
+            assert pool.broadcast(_get_pid)[1] not in pids
+        for process in processes:
+            process.join(60)
+            assert process.exitcode == (-9 if process is killed else 0)
+        assert os.listdir(directory) == []
+        # without a worker for a shard, the pool gives up after the timeout
+        processes = start_servers(directory, 1)
+        with FilePool(directory, 2, poll_interval=0.01, timeout=0.5) as pool:
+            try:
+                pool.broadcast(_get_pid)
+                assert False, "expected a timeout"
+            except TimeoutError:
+                pass
+        processes[0].join(60)
+
+def test_file_pool_stale_runs():
+    with TemporaryDirectory() as directory:
+        # the run of a crashed pool has no heartbeats, it is removed
+        crashed = os.path.join(directory, "run-crashed")
+        os.makedirs(crashed)
+        with FilePool(directory, 1, poll_interval=0.01, stale_after=0.5) as pool:
+            assert not os.path.exists(crashed)
+            # the run of a live pool is kept
+            try:
+                FilePool(directory, 1, poll_interval=0.01, stale_after=0.5)
+                assert False, "expected an error"
+            except RuntimeError as e:
+                assert "Another pool" in str(e)
+            assert os.path.isdir(pool.run_dir)
+        assert os.listdir(directory) == []
+
+def test_train_file_pool():
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    trainer = get_trainer(tie_by_langs=True, workers=2)
+    expected = trainer.train(rules, None, get_words_by_lang())
+    with TemporaryDirectory() as directory:
+        processes = start_servers(directory, 2)
+        model = get_trainer(tie_by_langs=True, workers=2, pool_dir=directory).train(rules, None, get_words_by_lang())
+        for process in processes:
+            process.join(60)
+    assert model.vocab == expected.vocab and np.array_equal(model.vocab_langs, expected.vocab_langs)
+    assert np.allclose(model.vocab_logits, expected.vocab_logits)
+
+class _InterruptedTrainer(Trainer):
+    def save_checkpoint(self, checkpoint_file, it, *args, **kwargs):
+        super().save_checkpoint(checkpoint_file, it, *args, **kwargs)
+        if it == 1:
+            raise KeyboardInterrupt()
+
+def test_train_vocab_sizes():
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    trainer = get_trainer(vocab_size=[600, 900, 100000], iterations=4)
+    models = trainer.train(rules, None, get_words_by_lang())
+    # sizes larger than the number of candidates are skipped
+    assert sorted(models.keys()) == [600, 900]
+    for size, model in models.items():
+        assert len(model.vocab) == size
+        assert model.decode(model.encode("tokenizer")) == "tokenizer"
+
+def test_warm_start():
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    words_by_lang = get_words_by_lang()
+    init_model = get_trainer().train(rules, None, words_by_lang)
+    trainer = get_trainer(iterations=2, spread_factor=1.5)
+    words, _ = trainer.prepare_words(None, words_by_lang)
+    model = get_model(trainer, words)
+    trainer.init_logits(model, init_model)
+    assert np.isclose(np.logaddexp.reduce(model.vocab_logits.astype(np.float64)), 0.0, atol=1e-4)
+    # known tokens keep their relative logits
+    known = [v for v in init_model.vocab if v in model.vocab_lookup and v not in trainer.protected_tokens][:20]
+    init_logits = np.array([init_model.vocab_logits[init_model.vocab_lookup[v]] for v in known])
+    logits = np.array([model.vocab_logits[model.vocab_lookup[v]] for v in known])
+    assert np.allclose(logits - logits[0], init_logits - init_logits[0], atol=1e-4)
+    model = trainer.train(rules, None, words_by_lang, init_model=init_model)
+    assert len(model.vocab) == trainer.config.vocab_size
+    assert len(set(model.vocab) & set(init_model.vocab)) > 0.9 * trainer.config.vocab_size
+
+def test_resume():
+    rules = get_rules(LANGS, remove_unconditional_op_rules=True)
+    words_by_lang = get_words_by_lang()
+    for vocab_size in [600, [600, 900]]:
+        expected = get_trainer(vocab_size=vocab_size, iterations=4).train(rules, None, words_by_lang)
+        with TemporaryDirectory() as directory:
+            config = get_trainer(vocab_size=vocab_size, iterations=4, checkpoint_dir=directory).config
+            try:
+                _InterruptedTrainer(config).train(rules, None, words_by_lang)
+                assert False, "expected an interruption"
+            except KeyboardInterrupt:
+                pass
+            for _ in range(2):
+                # the second run resumes from the checkpoint of the finished run
+                models = Trainer(config).train(rules, None, words_by_lang, resume=True)
+                if isinstance(vocab_size, int):
+                    models = {vocab_size: models}
+                assert models.keys() == (expected.keys() if isinstance(vocab_size, list) else {vocab_size})
+                for size, model in models.items():
+                    expected_model = expected[size] if isinstance(vocab_size, list) else expected
+                    assert model.vocab == expected_model.vocab
+                    assert np.allclose(model.vocab_logits, expected_model.vocab_logits)
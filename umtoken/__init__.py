@@ -8,6 +8,7 @@ from .morpher import Morpher
 from .pre import PreTokenizer
 from .rules import MorphOp, RegexOp, MorphRule, SuffixRule
 from .tokenizer import Tokenizer
+from .streaming import StreamingTokenizer
 from .utils import format as format_token_ids
 from .langs import get_rules
 try:
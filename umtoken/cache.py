@@ -0,0 +1,76 @@
+# Path: umtoken/cache.py
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+DEFAULT_MAX_TOKENS = 1024 * 1024
+
+class SegmentCache():
+    def __init__(self, max_tokens: int = DEFAULT_MAX_TOKENS):
+        """
+        A bounded LRU cache for the token ids of text segments between reserved tokens (see Tokenizer.tokenize).
+        Segments are keyed by a hash of their content, so that the cache does not hold the segment texts.
+        A cache must only be used with a single tokenizer.
+
+        Args:
+            max_tokens: The maximum number of tokens held by the cache.
+                        Least recently used segments are evicted when the limit is exceeded.
+        """
+        self.max_tokens = max_tokens
+        self.entries = OrderedDict()
+        self.token_count = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(segment: str, *args: Hashable) -> tuple:
+        """
+        Returns the cache key of a segment.
+
+        Args:
+            segment: The segment text.
+            args: Further (hashable) arguments that affect the token ids.
+        """
+        digest = hashlib.blake2b(segment.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        return (digest,) + args
+
+    def get(self, key: tuple) -> Optional[Any]:
+        """Returns the cached value for key (or None) and marks it as recently used."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: tuple, value: Any, size: int):
+        """
+        Adds a value to the cache.
+
+        Args:
+            key: The cache key (see key).
+            value: The value.
+            size: The number of tokens of the value.
+        """
+        if size > self.max_tokens:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.token_count -= old[0]
+        self.entries[key] = (size, value)
+        self.token_count += size
+        while self.token_count > self.max_tokens:
+            _, (old_size, _) = self.entries.popitem(last=False)
+            self.token_count -= old_size
+
+    def clear(self):
+        """Removes all entries and resets the statistics."""
+        self.entries.clear()
+        self.token_count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,118 @@
+# Path: umtoken/candidates.py
+
+import heapq
+import zlib
+from collections import Counter
+from itertools import chain
+from typing import Iterable, List, Optional, Tuple
+
+from .alphabet import ASCII_RESERVED_EOW
+from .pool import WorkerPool
+
+def iter_substrings(word: str, max_length: int) -> Iterable[str]:
+    """
+    Yields the candidate tokens of a word: all substrings of length 2..max_length (with repetitions).
+
+    Args:
+        word: The (escaped) word.
+        max_length: The maximum length of a token.
+    """
+    # avoid dangling end-of-word markers
+    word_len = len(word) - 1 if word.endswith(ASCII_RESERVED_EOW) else len(word)
+    for i in range(word_len):
+        for j in range(i + 2, min(i + max_length, word_len) + 1):
+            yield word[i:j]
+
+def partition_of(token: str, modulus: int) -> int:
+    """Returns the partition of a token (stable across processes, unlike hash)."""
+    return zlib.crc32(token.encode("utf-8", "surrogatepass")) % modulus
+
+def count_substrings(words: List[Tuple[str, float]], max_length: int, token_regex=None,
+                     partition: Tuple[int, int] = (1, 0), max_entries: Optional[int] = None) -> Optional[Counter]:
+    """
+    Counts the candidate tokens of the words that belong to a partition.
+
+    Args:
+        words: The words and their counts.
+        max_length: The maximum length of a token.
+        token_regex: Only tokens matching this (compiled) regex are counted.
+        partition: The partition (modulus, residue), see partition_of.
+        max_entries: The maximum number of distinct tokens (None: unbounded).
+
+    Returns:
+        The counts, or None if the partition has more than max_entries distinct tokens.
+    """
+    modulus, residue = partition
+    counts = Counter()
+    for word, count in words:
+        if modulus == 1:
+            for token in iter_substrings(word, max_length):
+                counts[token] += count
+        else:
+            for token in iter_substrings(word, max_length):
+                if partition_of(token, modulus) == residue:
+                    counts[token] += count
+        if max_entries is not None and len(counts) > max_entries:
+            return None
+    if token_regex:
+        # filter distinct tokens instead of every occurrence
+        counts = Counter({t: c for t, c in counts.items() if token_regex.match(t)})
+    return counts
+
+def _count_shard(state, max_length, token_regex, partition, max_entries):
+    return count_substrings(state["words"], max_length, token_regex, partition, max_entries)
+
+def count_substrings_pool(pool: WorkerPool, max_length: int, token_regex=None,
+                          partition: Tuple[int, int] = (1, 0), max_entries: Optional[int] = None) -> Optional[Counter]:
+    """
+    Counts the candidate tokens that belong to a partition in parallel (see count_substrings).
+    Each worker counts the words of its shard (state["words"]), the partial counts are merged.
+    """
+    counts = Counter()
+    for _counts in pool.broadcast(_count_shard, max_length, token_regex, partition, max_entries):
+        if _counts is None:
+            return None
+        counts.update(_counts)
+        if max_entries is not None and len(counts) > max_entries:
+            return None
+    return counts
+
+def top_substrings(words: Optional[List[Tuple[str, float]]], k: int, max_length: int, token_regex=None,
+                   max_entries: Optional[int] = None, pool: Optional[WorkerPool] = None) -> List[Tuple[str, float]]:
+    """
+    Returns the k most frequent candidate tokens of the words (exact, ties are broken by the token).
+
+    Memory is bounded by max_entries distinct tokens (plus the top k): the tokens are partitioned by their hash,
+    and each partition is counted in a separate pass over the words. A partition that exceeds max_entries
+    is split into two partitions, so that only as many passes as necessary are made.
+
+    Args:
+        words: The words and their counts (must be iterable repeatedly, ignored if pool is set).
+        k: The number of tokens to return.
+        max_length: The maximum length of a token.
+        token_regex: Only tokens matching this (compiled) regex are counted.
+        max_entries: The maximum number of distinct tokens counted at once (None: unbounded, single pass).
+                     With a pool, the limit applies to each worker and to the merged counts.
+        pool: The worker pool holding the words in shards (state["words"]), the shards are counted in parallel.
+
+    Returns:
+        A list of (token, count) tuples, sorted by descending count.
+    """
+    assert max_entries is None or max_entries > 0
+    top = []
+    partitions = [(1, 0)]
+    passes = 0
+    while partitions:
+        modulus, residue = partitions.pop()
+        passes += 1
+        if pool is not None:
+            counts = count_substrings_pool(pool, max_length, token_regex, (modulus, residue), max_entries)
+        else:
+            counts = count_substrings(words, max_length, token_regex, (modulus, residue), max_entries)
+        if counts is None:
+            partitions.extend([(modulus * 2, residue + modulus), (modulus * 2, residue)])
+            continue
+        top = heapq.nsmallest(k, chain(top, counts.items()), key=lambda x: (-x[1], x[0]))
+    if passes > 1:
+        print(f"Counted candidates in {passes} passes")
+    return top
@@ -5,14 +5,13 @@ import regex as re
 import argparse
 import json
 from collections import Counter
-from multiprocessing import Pool
-from time import sleep
 from typing import List, Tuple
 
 from tqdm import tqdm
 
+from .pool import DEFAULT_BATCHES_PER_WORKER, imap_batches
 from .tokenizer import Tokenizer
-from .utils import format, chunk_list
+from .utils import format, balanced_ranges, word_cost
 
 def process_single(words: List[Tuple[str, int]], 
                    tokenizer: Tokenizer, 
@@ -37,6 +36,9 @@ def process_single(words: List[Tuple[str, int]],
         token_count += len(token_ids) * count
     return word_count, token_count, ids_by_words
 
+def _process_batch(context, words):
+    return process_single(words, *context, show_progress=False, progress_message=None)
+
 def replace_continue_char(w, cc):
     return w.replace(cc, "\u00AD") if len(w) > 1 else w
 
@@ -76,13 +78,12 @@ def main(args):
                 results = [process_single(counter.items(), tokenizer, need_ids, 
                                           args.check, True, f"Processing {input_file}")]
             else:
-                chunks = chunk_list(list(counter.items()), workers)
-                with Pool(workers) as p:
-                    results = [p.apply_async(process_single, (c, tokenizer, need_ids, args.check, i==0, f"Processing {input_file}")) 
-                               for i, c in enumerate(chunks)]
-                    while any(not r.ready() for r in results):
-                        sleep(0.1)
-                    results = [r.get() for r in results]
+                # many cost-balanced batches are handed out to idle workers
+                items = list(counter.items())
+                ranges = balanced_ranges([word_cost(w) for w, _ in items], workers * DEFAULT_BATCHES_PER_WORKER)
+                batches = [items[s:e] for s, e in ranges if s < e]
+                results = list(imap_batches(_process_batch, (tokenizer, need_ids, args.check), batches, workers,
+                                            desc=f"Processing {input_file}"))
                         
             for word_count, token_count, ids in results:
                 words_by_langs[input_lang] += word_count
@@ -2,6 +2,8 @@
 
 import math
 
+import numpy as np
+
 def log_sum_exp(a, b):
     if a == float("-inf"):
         return b
@@ -12,6 +14,23 @@ def log_sum_exp(a, b):
     else:
         return b + math.log1p(math.exp(a - b))
 
+def _segment_log_sum_exp(values, keys):
+    """Returns the unique keys and the log-sum-exp of the values of each key (keys must be sorted)."""
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    m = np.maximum.reduceat(values, starts)
+    m = np.where(np.isfinite(m), m, 0.0)
+    with np.errstate(divide='ignore'):
+        logits = np.log(np.add.reduceat(np.exp(values - np.repeat(m, np.diff(np.append(starts, len(values))))), starts)) + m
+    return keys[starts], logits
+
+def _segment_max(values, keys):
+    """Returns the unique keys, the max of the values of each key and the index of the first max (keys must be sorted)."""
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    m = np.maximum.reduceat(values, starts)
+    is_max = values == np.repeat(m, np.diff(np.append(starts, len(values))))
+    first = np.minimum.reduceat(np.where(is_max, np.arange(len(values)), len(values)), starts)
+    return keys[starts], m, first
+
 class Lattice():
     def __init__(self, count):
         assert count > 1
@@ -181,4 +200,293 @@ class Lattice():
                 loss = max_loss
             losses[k] = loss
 
-        return losses
\ No newline at end of file
+        return losses
+
+class PackedLattices():
+    def __init__(self, lengths, offsets, starts, ends, vocab_ids, rule_ids):
+        """
+        The lattices of many words, packed into flat arrays. The edges of word k are the edges
+        offsets[k]:offsets[k+1]. Edge logits are not stored, so that the lattices can be re-scored
+        whenever the logits change (see Model.score_edges).
+
+        Args:
+            lengths: The word lengths (the lattice of word k has lengths[k]+1 nodes).
+            offsets: The edge offsets of the words (len(lengths)+1 entries).
+            starts: The start node of each edge.
+            ends: The end node of each edge.
+            vocab_ids: The vocab id of each edge.
+            rule_ids: The rule id of each edge.
+        """
+        assert len(offsets) == len(lengths) + 1
+        assert len(starts) == len(ends) == len(vocab_ids) == len(rule_ids) == offsets[-1] - offsets[0]
+        self.lengths = lengths
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+        self.vocab_ids = vocab_ids
+        self.rule_ids = rule_ids
+        self._schedule_forward = None
+        self._schedule_backward = None
+        self._batches = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def edge_count(self):
+        return len(self.starts)
+
+    def word_ids(self):
+        """Returns the word index of each edge."""
+        return np.repeat(np.arange(len(self.lengths)), np.diff(self.offsets))
+
+    def slice(self, start, end):
+        """Returns the lattices of the words start:end (the edge arrays are views)."""
+        offsets = self.offsets[start:end+1]
+        s, e = offsets[0], offsets[-1]
+        return PackedLattices(self.lengths[start:end], offsets - s,
+                              self.starts[s:e], self.ends[s:e], self.vocab_ids[s:e], self.rule_ids[s:e])
+
+    def select(self, indices):
+        """Returns the lattices of the words with the given (sorted) indices (the edge arrays are copies)."""
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = np.diff(self.offsets)[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        edges = np.repeat(self.offsets[indices] - self.offsets[0] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return PackedLattices(self.lengths[indices], offsets,
+                              self.starts[edges], self.ends[edges], self.vocab_ids[edges], self.rule_ids[edges])
+
+    def batches(self, batch_size):
+        """
+        Returns the lattices split into batches of at most batch_size words, as a list of (start, end, lattices).
+        The batches are cached, so that their schedules (see forward_sum) are only computed once.
+        """
+        if self._batches is None or self._batches[0] != batch_size:
+            if len(self.lengths) <= batch_size:
+                batches = [(0, len(self.lengths), self)]
+            else:
+                batches = [(s, min(s + batch_size, len(self.lengths)), self.slice(s, min(s + batch_size, len(self.lengths))))
+                           for s in range(0, len(self.lengths), batch_size)]
+            self._batches = (batch_size, batches)
+        return self._batches[1]
+
+    @staticmethod
+    def concatenate(lattices_list):
+        """Concatenates the lattices of consecutive word lists (lattices_list must not be empty)."""
+        assert len(lattices_list) > 0
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for lattices in lattices_list:
+            offsets.append(lattices.offsets[1:] - lattices.offsets[0] + total)
+            total += lattices.edge_count
+        return PackedLattices(np.concatenate([l.lengths for l in lattices_list]),
+                              np.concatenate(offsets),
+                              np.concatenate([l.starts for l in lattices_list]),
+                              np.concatenate([l.ends for l in lattices_list]),
+                              np.concatenate([l.vocab_ids for l in lattices_list]),
+                              np.concatenate([l.rule_ids for l in lattices_list]))
+
+    def arrays(self):
+        """Returns the arrays of the lattices (the arguments of the constructor, e.g., to send them without pickling)."""
+        return self.lengths, self.offsets, self.starts, self.ends, self.vocab_ids, self.rule_ids
+
+    def save(self, file):
+        """Saves the arrays to a file or file object (uncompressed .npz, see load)."""
+        np.savez(file, lengths=self.lengths, offsets=self.offsets, starts=self.starts, ends=self.ends,
+                 vocab_ids=self.vocab_ids, rule_ids=self.rule_ids)
+
+    @staticmethod
+    def load(file):
+        """Loads lattices saved with save."""
+        with np.load(file) as data:
+            return PackedLattices(data["lengths"], data["offsets"], data["starts"], data["ends"],
+                                  data["vocab_ids"], data["rule_ids"])
+
+    def remap_vocab(self, vocab_map):
+        """
+        Remaps the vocab ids and removes the edges of removed vocab ids.
+
+        Args:
+            vocab_map: Array that maps old vocab ids to new vocab ids (-1: removed).
+
+        Returns:
+            The remapped lattices.
+        """
+        vocab_ids = vocab_map[self.vocab_ids]
+        keep = vocab_ids >= 0
+        counts = np.bincount(self.word_ids()[keep], minlength=len(self.lengths))
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return PackedLattices(self.lengths, offsets, self.starts[keep], self.ends[keep],
+                              vocab_ids[keep].astype(self.vocab_ids.dtype), self.rule_ids[keep])
+
+    def node_offsets(self):
+        """Returns the offset of the first node of each word in the node arrays (len(self)+1 entries)."""
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths + 1, out=offsets[1:])
+        return offsets
+
+    def _get_schedule(self, backward):
+        """
+        Returns the edges sorted by position (end for forward, start for backward) and node, the slice bounds for each
+        position, and the global start and end nodes of the edges. Computed once, since it doesn't depend on the logits.
+        """
+        schedule = self._schedule_backward if backward else self._schedule_forward
+        if schedule is None:
+            node_offsets = self.node_offsets()[self.word_ids()]
+            start_nodes = node_offsets + self.starts
+            end_nodes = node_offsets + self.ends
+            positions, nodes = (self.starts, start_nodes) if backward else (self.ends, end_nodes)
+            order = np.lexsort((nodes, positions))
+            max_length = int(self.lengths.max()) if len(self.lengths) else 0
+            bounds = np.searchsorted(positions[order], np.arange(max_length + 2))
+            schedule = order, bounds, start_nodes, end_nodes
+            if backward:
+                self._schedule_backward = schedule
+            else:
+                self._schedule_forward = schedule
+        return schedule
+
+    def forward_sum(self, edge_logits):
+        """
+        Computes the forward logits of all lattices at once, position by position (vectorized over all words).
+
+        Args:
+            edge_logits: The edge logits.
+
+        Returns:
+            The forward logits of all nodes (see node_offsets).
+        """
+        node_offsets = self.node_offsets()
+        logits_forward = np.full(node_offsets[-1], -np.inf)
+        logits_forward[node_offsets[:-1]] = 0.0
+        order, bounds, start_nodes, end_nodes = self._get_schedule(backward=False)
+        for j in range(1, len(bounds) - 1):
+            edges = order[bounds[j]:bounds[j+1]]
+            if len(edges) == 0:
+                continue
+            nodes, logits = _segment_log_sum_exp(logits_forward[start_nodes[edges]] + edge_logits[edges], end_nodes[edges])
+            logits_forward[nodes] = logits
+        return logits_forward
+
+    def backward_sum(self, edge_logits):
+        """
+        Computes the backward logits of all lattices at once (see forward_sum).
+
+        Args:
+            edge_logits: The edge logits.
+
+        Returns:
+            The backward logits of all nodes (see node_offsets).
+        """
+        node_offsets = self.node_offsets()
+        logits_backward = np.full(node_offsets[-1], -np.inf)
+        logits_backward[node_offsets[1:] - 1] = 0.0
+        order, bounds, start_nodes, end_nodes = self._get_schedule(backward=True)
+        for i in reversed(range(len(bounds) - 1)):
+            edges = order[bounds[i]:bounds[i+1]]
+            if len(edges) == 0:
+                continue
+            nodes, logits = _segment_log_sum_exp(logits_backward[end_nodes[edges]] + edge_logits[edges], start_nodes[edges])
+            logits_backward[nodes] = logits
+        return logits_backward
+
+    def forward_max(self, edge_logits):
+        """
+        Computes the max-product forward logits of all lattices at once (see forward_sum and Lattice.forward_max).
+
+        Args:
+            edge_logits: The edge logits.
+
+        Returns:
+            A tuple of the forward logits of all nodes (see node_offsets) and the best incoming edge of each node (-1: none).
+        """
+        node_offsets = self.node_offsets()
+        logits_forward = np.full(node_offsets[-1], -np.inf)
+        logits_forward[node_offsets[:-1]] = 0.0
+        best_forward = np.full(node_offsets[-1], -1, dtype=np.int64)
+        order, bounds, start_nodes, end_nodes = self._get_schedule(backward=False)
+        for j in range(1, len(bounds) - 1):
+            edges = order[bounds[j]:bounds[j+1]]
+            if len(edges) == 0:
+                continue
+            # edges of a node are in insertion order, so that ties are resolved like in Lattice.forward_max
+            nodes, logits, first = _segment_max(logits_forward[start_nodes[edges]] + edge_logits[edges], end_nodes[edges])
+            finite = np.isfinite(logits)
+            logits_forward[nodes] = logits
+            best_forward[nodes[finite]] = edges[first[finite]]
+        return logits_forward, best_forward
+
+    def viterbi(self, edge_logits):
+        """
+        Finds the best decomposition of all words (see Lattice.viterbi).
+
+        Args:
+            edge_logits: The edge logits.
+
+        Returns:
+            A tuple of the logit of the best path of each word (-inf if there is no full-coverage decomposition)
+            and the indices of the edges on the best paths.
+        """
+        logits_forward, best_forward = self.forward_max(edge_logits)
+        _, _, start_nodes, _ = self._get_schedule(backward=False)
+        node_offsets = self.node_offsets()
+        best_logits = logits_forward[node_offsets[1:] - 1]
+        # backtrack from the last node of all words at once
+        words = np.flatnonzero(np.isfinite(best_logits))
+        nodes = node_offsets[words + 1] - 1
+        first_nodes = node_offsets[words]
+        path = []
+        while len(nodes):
+            edges = best_forward[nodes]
+            path.append(edges)
+            nodes = start_nodes[edges]
+            active = nodes != first_nodes
+            nodes, first_nodes = nodes[active], first_nodes[active]
+        return best_logits, np.sort(np.concatenate(path)) if path else np.zeros(0, dtype=np.int64)
+
+    def partitions(self, logits_forward):
+        """Returns the log partition function of each word (-inf if there is no full-coverage decomposition)."""
+        return logits_forward[self.node_offsets()[1:] - 1]
+
+    def _edge_path_logits(self, edge_logits, logits_forward, logits_backward):
+        """Returns log[P(eij,word)/P(word)] of each edge and whether it is part of a full path."""
+        _, _, start_nodes, end_nodes = self._get_schedule(backward=False)
+        lf = logits_forward[start_nodes]
+        lb = logits_backward[end_nodes]
+        valid = np.isfinite(lf) & np.isfinite(lb)
+        with np.errstate(invalid='ignore'):
+            x = edge_logits + lf + lb - self.partitions(logits_forward)[self.word_ids()]
+        return x, valid
+
+    def marginal_logits(self, edge_logits, logits_forward, logits_backward):
+        """
+        Returns the marginal logits of all edges (see Lattice.marginal_logits).
+
+        Args:
+            edge_logits: The edge logits.
+            logits_forward: The result of forward_sum.
+            logits_backward: The result of backward_sum.
+        """
+        x, valid = self._edge_path_logits(edge_logits, logits_forward, logits_backward)
+        # clamp away rounding noise above 0
+        return np.where(valid, np.minimum(x, 0.0), -np.inf)
+
+    def removal_losses(self, edge_logits, logits_forward, logits_backward):
+        """
+        Returns the removal losses of all edges (see Lattice.removal_losses).
+
+        Args:
+            edge_logits: The edge logits.
+            logits_forward: The result of forward_sum.
+            logits_backward: The result of backward_sum.
+        """
+        x, valid = self._edge_path_logits(edge_logits, logits_forward, logits_backward)
+        max_loss = math.log(1e+20)
+        x = np.where(valid, np.minimum(x, 0.0), -np.inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # L = -log(1 - exp(x)), computed accurately for x close to 0 and for x << 0
+            log_1m = np.where(x > -math.log(2), np.log(-np.expm1(x)), np.log1p(-np.exp(x)))
+        losses = np.minimum(-log_1m, max_loss)
+        return np.where(valid, losses, 0.0)
@@ -1,6 +1,7 @@
 # Path: umtoken/model.py 
 
 import hashlib
+from array import array
 from base64 import b64encode
 from typing import List, Optional, Tuple, Union
 
@@ -9,7 +10,7 @@ import numpy as np
 from .alphabet import ASCII_RESERVED_EOW as EOW, ASCII_ENCODING_SHY as SHY
 from .rules import MorphRule, SuffixRule
 from .morpher import Morpher
-from .lattice import Lattice
+from .lattice import Lattice, PackedLattices
 from .utils import format, get_rules_bitmask
 
 MIN_LOGIT = -20.0
@@ -17,15 +18,28 @@ CUTOFF = 1E-3
 SHIFT = 1E-12 # tie-breaking for ambiguous paths
 
 def digamma(x):
-    "digamma function assumes x > 0."
-    r = 0
-    while (x <= 5):
-        r -= 1 / x
-        x += 1
+    "digamma function assumes x > 0 (scalars or arrays)."
+    x = np.array(x, dtype=np.float64)
+    r = np.zeros_like(x)
+    # shift small arguments up until the asymptotic expansion is accurate
+    small = x <= 5
+    while np.any(small):
+        r[small] -= 1 / x[small]
+        x[small] += 1
+        small = x <= 5
     f = 1 / (x * x)
     t = f * (-1/12.0 + f * (1/120.0 + f * (-1/252.0 + f * (1/240.0 + f * (-1/132.0 + 
         f * (691/32760.0 + f * (-1/12.0 + f * 3617/8160.0)))))))
-    return r + np.log(x) - 0.5 / x + t
+    out = r + np.log(x) - 0.5 / x + t
+    return out if out.ndim > 0 else out.item()
+
+def score_edges(lattices: PackedLattices, vocab_logits: np.ndarray, rules_logits: np.ndarray,
+                alpha: float, beta: float, rule_penalties: List[float]) -> np.ndarray:
+    """Computes the edge logits of packed lattices (see Model.score_edges)."""
+    vl = (vocab_logits * alpha).astype(np.float64)
+    rl = (rules_logits * beta).astype(np.float64)
+    rp = np.array(rule_penalties, dtype=np.float64)
+    return vl[lattices.vocab_ids] + rl[lattices.rule_ids] - rp[lattices.rule_ids] - lattices.starts * SHIFT
 
 class Model():
     def __init__(self, 
@@ -95,14 +109,14 @@ class Model():
         
     def _normalize(self, logits):
         # operate on a copy: callers (e.g. step_M) still need the original counts
-        total = sum(l for l in logits if l >= CUTOFF)
+        logits = np.asarray(logits, dtype=np.float64)
+        valid = logits >= CUTOFF
+        total = logits[valid].sum()
+        out = np.full(len(logits), MIN_LOGIT, dtype=np.float32)
         if total <= 0:
             # every entry is below CUTOFF — nothing to renormalize against; pin all to the floor
-            return np.full(len(logits), MIN_LOGIT, dtype=np.float32)
-        logsum = digamma(total)
-        out = np.empty(len(logits), dtype=np.float32)
-        for i in range(len(logits)):
-            out[i] = max(digamma(logits[i]) - logsum, MIN_LOGIT) if logits[i] >= CUTOFF else MIN_LOGIT
+            return out
+        out[valid] = np.maximum(digamma(logits[valid]) - digamma(total), MIN_LOGIT)
         return out
     
     def reset_logits(self):
@@ -120,6 +134,13 @@ class Model():
         self.rules_logits = self._normalize(m_rules)
         self._vl_scaled = None
         self._rl_scaled = None
+
+    def set_logits(self, vocab_logits: np.ndarray, rules_logits: np.ndarray):
+        """Set the logits (e.g., extrapolated or restored logits)."""
+        self.vocab_logits = np.asarray(vocab_logits, dtype=np.float32)
+        self.rules_logits = np.asarray(rules_logits, dtype=np.float32)
+        self._vl_scaled = None
+        self._rl_scaled = None
         
     def update_tied_langs(self, langs: List[str], vocab_langs: List[int]):
         """
@@ -146,10 +167,8 @@ class Model():
             self.rules_langs = list(rules_langs)
         
         if self.morpher is not None:
-            # re-create morpher
-            self.morpher = Morpher(self.langs, self.vocab, self.rules, 
-                                   min_base_length=self.morpher.min_base_length,
-                                   vocab_langs=self.vocab_langs, rules_langs=self.rules_langs)
+            # the tries don't depend on the languages
+            self.morpher.set_langs(self.langs, self.vocab_langs, self.rules_langs)
         
     def encode(self, word: str, langs: Optional[Union[str,List[str]]] = None, 
                force_slow: bool = False, eow_applied: bool = False) -> List[Tuple[int, int]]:
@@ -277,6 +296,44 @@ class Model():
             add_edge(i, j, vl[vocab_id] + rl[rule_id] - rp[rule_id] - i * SHIFT, (vocab_id, rule_id))
         return lattice
     
+    def build_packed_lattices(self, words, langs_by_words, force_slow=False):
+        """
+        Build the lattices of many words, packed into flat arrays (without edge logits, see score_edges).
+
+        Args:
+            words: The words (iterable).
+            langs_by_words: The languages of each word (iterable).
+            force_slow: Whether to force slow decomposition.
+
+        Returns:
+            The packed lattices.
+        """
+        lengths, offsets = array('i'), array('q', [0])
+        starts, ends, vocab_ids, rule_ids = array('i'), array('i'), array('i'), array('i')
+        decompose = self.morpher.decompose
+        for word, langs in zip(words, langs_by_words):
+            for vocab_id, rule_id, i, j in decompose(word, langs, force_slow=force_slow):
+                starts.append(i)
+                ends.append(j)
+                vocab_ids.append(vocab_id)
+                rule_ids.append(rule_id)
+            lengths.append(len(word))
+            offsets.append(len(starts))
+        return PackedLattices(*(np.array(a, dtype=np.int64 if a.typecode == 'q' else np.int32)
+                                for a in (lengths, offsets, starts, ends, vocab_ids, rule_ids)))
+
+    def score_edges(self, lattices: PackedLattices) -> np.ndarray:
+        """
+        Computes the edge logits of packed lattices (identical to the logits used by build_lattice).
+
+        Args:
+            lattices: The packed lattices.
+
+        Returns:
+            The edge logits (float64).
+        """
+        return score_edges(lattices, self.vocab_logits, self.rules_logits, self.alpha, self.beta, self._rule_penalties)
+
     def rearrange_vocab(self, order):
         """
         Rearrange the vocabulary.
@@ -284,6 +341,23 @@ class Model():
         Args:
             order: The new order.
         """
+        vocab_map = np.empty(len(order), dtype=np.int64)
+        vocab_map[np.asarray(order, dtype=np.int64)] = np.arange(len(order))
+        self.remap_vocab(vocab_map)
+
+    def remap_vocab(self, vocab_map):
+        """
+        Change the ids of the vocabulary in place (reorder and/or remove tokens).
+        The tries of the morpher are not rebuilt (see Morpher.remap_vocab).
+
+        Args:
+            vocab_map: The new id of each token (-1: removed), the new ids must be 0, 1, ..., n-1.
+        """
+        vocab_map = np.asarray(vocab_map, dtype=np.int64)
+        assert len(vocab_map) == len(self.vocab), "vocab_map must have the same length as vocab"
+        keep = vocab_map >= 0
+        order = np.empty(int(keep.sum()), dtype=np.int64)
+        order[vocab_map[keep]] = np.flatnonzero(keep)
         self.vocab = [self.vocab[i] for i in order]
         self.vocab_lookup = {v: i for i, v in enumerate(self.vocab)}
         self.vocab_logits = self.vocab_logits[order]
@@ -293,11 +367,42 @@ class Model():
                 self.vocab_langs = self.vocab_langs[order]
             else:
                 self.vocab_langs = [self.vocab_langs[i] for i in order]
+        if 0 <= self.unk_token_id < len(vocab_map) and vocab_map[self.unk_token_id] >= 0:
+            self.unk_token_id = int(vocab_map[self.unk_token_id])
         if self.morpher is not None:
-            # re-create morpher
-            self.morpher = Morpher(self.langs, self.vocab, self.rules, 
-                                   min_base_length=self.morpher.min_base_length,
-                                   vocab_langs=self.vocab_langs, rules_langs=self.rules_langs)
+            self.morpher.remap_vocab(vocab_map, self.vocab, self.vocab_langs)
+
+    def extend_vocab(self, tokens: List[str], logits: Optional[List[float]] = None,
+                     vocab_langs: Optional[List[int]] = None) -> List[int]:
+        """
+        Append tokens to the vocabulary, without reordering it or rebuilding the morpher (see Morpher.add_bases),
+        so that the ids of the existing tokens (e.g., rows of embeddings) stay valid.
+
+        Args:
+            tokens: The tokens (tokens which are already in the vocabulary are ignored).
+            logits: The logits of the tokens (default: MIN_LOGIT).
+            vocab_langs: The languages of the tokens (default: all languages), if the vocabulary is tied to languages.
+
+        Returns:
+            The ids of the tokens.
+        """
+        assert logits is None or len(logits) == len(tokens), "logits must have the same length as tokens"
+        assert vocab_langs is None or len(vocab_langs) == len(tokens), "vocab_langs must have the same length as tokens"
+        new = {}
+        for k, token in enumerate(tokens):
+            if token not in self.vocab_lookup and token not in new:
+                new[token] = k
+        new_tokens = list(new.keys())
+        self.morpher.add_bases(new_tokens, [vocab_langs[k] for k in new.values()] if vocab_langs is not None else None)
+        # the morpher appends to the vocabulary it shares with the model
+        assert len(self.vocab) == len(self.vocab_lookup) + len(new_tokens)
+        for token in new_tokens:
+            self.vocab_lookup[token] = len(self.vocab_lookup)
+        self.vocab_langs = self.morpher.vocab_langs
+        new_logits = [logits[k] for k in new.values()] if logits is not None else [MIN_LOGIT] * len(new_tokens)
+        self.vocab_logits = np.concatenate([self.vocab_logits, np.array(new_logits, dtype=np.float32)])
+        self._vl_scaled = None
+        return [self.vocab_lookup[token] for token in tokens]
 
     def format_token(self, tid: int, rid: int) -> str:
         """
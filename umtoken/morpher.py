@@ -1,8 +1,12 @@
 # Path: umtoken/morpher.py
 
+import os
 from typing import List, Optional, Union, Iterable, Tuple
 
+import numpy as np
+
 from .alphabet import ASCII_RESERVED_EOW as EOW
+from .shared import SharedArrays
 from .trie import DictTrie, LookupTrie
 from .rules import MorphRule, SuffixRule
 from .utils import get_rules_bitmask, get_langs_bitmask
@@ -44,40 +48,207 @@ class Morpher:
         self.any_op = any(r.op for r in rules)
         self.min_base_length = min_base_length
 
-        self.base_trie = DictTrie(pairs=[(l, i) for i, l in enumerate(self.vocab)])
         self.suffix_trie = LookupTrie(pairs=[(r.suffix, i) for i, r in enumerate(self.rules)])
         self.reverse_suffix_trie = LookupTrie(pairs=[(r.suffix[::-1], i) for i, r in enumerate(self.rules)])
 
+        self._shared = None
+        self._build_base_tries()
+        if prebuild_stem_trie:
+            self._build_stem_trie()
+
+    def _build_base_tries(self):
+        # the tries map the bases to internal ids (indices into _bases), which are mapped to the ids of the vocab by _ids
+        # (None: identity, -1: removed), so that the vocab can be reordered or reduced without rebuilding them
+        self._bases = list(self.vocab)
+        self._ids = None
+        self.base_trie = DictTrie(pairs=[(l, i) for i, l in enumerate(self._bases)])
         self.max_part_length = max(max(len(r.suffix) for r in self.rules if isinstance(r, SuffixRule)),
                                    max(len(l) for l in self.vocab))
-
         self.stem_trie = None
         self._stem_trie_built = False
-        if prebuild_stem_trie:
-            self._build_stem_trie()
+        # whether the stems were filtered by the languages of the bases and rules (see set_langs)
+        self._stem_trie_langs = False
+        # bases added after construction (see add_bases) are kept in separate (small) tries
+        self._base_count = len(self._bases)
+        self.added_base_trie = None
+        self.added_stem_trie = None
 
-    def _build_stem_trie(self):
-        if self.any_op and not self._stem_trie_built:
-            # TODO: it would be faster to group rules by ops so that each op is only applied once to each base
-            # dict preserves insertion order and dedupes — keeps trie construction deterministic
-            stems = {}
-            for j, r in enumerate(self.rules):
-                if r.op is None:
+    def remap_vocab(self, vocab_map: List[int], vocab: List[str], vocab_langs: Optional[List[int]] = None):
+        """
+        Changes the ids of the bases (reordering and/or removing bases) without rebuilding the tries.
+        The tries are only rebuilt (compacted) when more than half of their bases have been removed.
+
+        Args:
+            vocab_map: The new id of each base (-1: removed).
+            vocab: The new vocab (the bases in the order of their new ids).
+            vocab_langs: The languages of the new vocab, if the vocab is tied to languages.
+        """
+        assert len(vocab_map) == len(self.vocab), "vocab_map must have the same length as the vocab"
+        assert vocab_langs is None or len(vocab_langs) == len(vocab), "vocab_langs must have the same length as vocab"
+        assert self._shared is None, "a shared morpher cannot be changed"
+        vocab_map = [int(i) for i in vocab_map]
+        ids = self._ids if self._ids is not None else range(len(self._bases))
+        self._ids = [vocab_map[i] if i >= 0 else -1 for i in ids]
+        self.vocab = vocab
+        self.vocab_langs = vocab_langs
+        if len(self.vocab) < len(self._bases) // 2:
+            self._build_base_tries()
+
+    def set_langs(self, langs: List[str], vocab_langs: Optional[List[int]], rules_langs: Optional[List[int]] = None):
+        """
+        Changes the languages of the bases and rules (re-tying) without rebuilding the base tries.
+        Stems are only recomputed if they were filtered by languages.
+
+        Args:
+            langs: The languages.
+            vocab_langs: The languages of the bases (None: all languages).
+            rules_langs: The languages of the rules (default: derived from the rules).
+        """
+        assert vocab_langs is None or len(vocab_langs) == len(self.vocab), "vocab_langs must have the same length as vocab"
+        assert self._shared is None, "a shared morpher cannot be changed"
+        self.langs = langs
+        self.vocab_langs = vocab_langs
+        self.rules_langs = rules_langs if rules_langs is not None else get_rules_bitmask(langs, self.rules)
+        if self._stem_trie_langs:
+            self.stem_trie = None
+            self._stem_trie_built = False
+            self._stem_trie_langs = False
+        if self.any_op and self._base_count < len(self._bases):
+            self._build_added_tries()
+
+    def share(self, directory: str):
+        """
+        Builds the stem trie and publishes the base and stem tries for other processes.
+
+        The tries are saved to directory (and memory-mapped by other processes), their values are published in
+        shared memory. Afterwards, pickling the morpher only transfers a handle, so that worker processes neither
+        unpickle nor rebuild the tries. The directory must exist until unshare is called.
+
+        Args:
+            directory: The directory for the trie files.
+        """
+        assert self._shared is None, "morpher is already shared"
+        self._build_stem_trie()
+        paths = {}
+        arrays = {}
+        for name in ["base_trie", "stem_trie"]:
+            trie = getattr(self, name)
+            if trie is None:
+                continue
+            paths[name] = os.path.join(directory, f"{name}_{os.getpid()}_{id(self)}.marisa")
+            for key, array in trie.export(paths[name]).items():
+                arrays[f"{name}.{key}"] = array
+        self._shared = (paths, SharedArrays(arrays))
+
+    def unshare(self):
+        """Releases the shared memory of share (processes which have already unpickled the morpher are not affected)."""
+        if self._shared is not None:
+            self._shared[1].close()
+            self._shared = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shared is not None:
+            paths, shared = self._shared
+            state["_shared"] = (paths, shared.handle)
+            for name in paths:
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            paths, handle = self._shared
+            arrays = SharedArrays.attach(handle)
+            for name, path in paths.items():
+                trie_class = DictTrie if name == "base_trie" else LookupTrie
+                prefix = f"{name}."
+                setattr(self, name, trie_class.load_exported(path, {k[len(prefix):]: a for k, a in arrays.items() if k.startswith(prefix)}))
+            # the unpickled copy does not own the shared memory
+            self._shared = None
+
+    def add_bases(self, bases: List[str], bases_langs: Optional[List[int]] = None):
+        """
+        Appends bases to the vocab (the list passed to the constructor), so that the ids of the existing bases stay valid.
+
+        The tries of the existing bases are not rebuilt: the added bases (and their stems) are kept in separate tries,
+        which are rebuilt from the added bases only.
+
+        Args:
+            bases: The new bases (must not be in the vocab).
+            bases_langs: The languages of the new bases (default: all languages), if the vocab is tied to languages.
+        """
+        assert bases_langs is None or len(bases_langs) == len(bases), "bases_langs must have the same length as bases"
+        assert all(self._base_index(b) is None for b in bases), "bases must not be in the vocab"
+        assert self._shared is None, "a shared morpher cannot be changed"
+        if not bases:
+            return
+        if self._ids is not None:
+            self._ids.extend(range(len(self.vocab), len(self.vocab) + len(bases)))
+        self._bases.extend(bases)
+        self.vocab.extend(bases)
+        if self.vocab_langs is not None:
+            if bases_langs is None:
+                bases_langs = [(1 << len(self.langs)) - 1] * len(bases)
+            if isinstance(self.vocab_langs, np.ndarray):
+                self.vocab_langs = np.concatenate([self.vocab_langs, np.array(bases_langs, dtype=self.vocab_langs.dtype)])
+            else:
+                self.vocab_langs = list(self.vocab_langs) + list(bases_langs)
+        self.max_part_length = max(self.max_part_length, max(len(b) for b in bases))
+        self._build_added_tries()
+
+    def _build_added_tries(self):
+        added = range(self._base_count, len(self._bases))
+        self.added_base_trie = DictTrie(pairs=[(self._bases[i], i) for i in added])
+        self.added_stem_trie = None
+        if self.any_op:
+            stems = self._collect_stems(added)
+            if stems:
+                self.added_stem_trie = LookupTrie(pairs=stems.keys())
+                self.max_part_length = max(self.max_part_length, max(len(r) for r, _ in stems))
+
+    def _base_index(self, base: str) -> Optional[int]:
+        # a removed base may have been added again
+        for base_trie in (self.base_trie, self.added_base_trie):
+            if base_trie is not None:
+                base_idx = base_trie.get(base)
+                if base_idx is not None and self._ids is not None:
+                    base_idx = self._ids[base_idx]
+                if base_idx is not None and base_idx >= 0:
+                    return base_idx
+        return None
+
+    def _collect_stems(self, base_idxs: Iterable[int]) -> dict:
+        # TODO: it would be faster to group rules by ops so that each op is only applied once to each base
+        # dict preserves insertion order and dedupes — keeps trie construction deterministic
+        stems = {}
+        for j, r in enumerate(self.rules):
+            if r.op is None:
+                continue
+            for i in base_idxs:
+                k = i if self._ids is None else self._ids[i]
+                if k < 0:
                     continue
-                for i, l in enumerate(self.vocab):
-                    if len(l) < (r.min_base_length or self.min_base_length):
-                        continue
-                    if self.vocab_langs is not None and self.vocab_langs[i] & self.rules_langs[j] == 0:
-                        continue
-                    if r.op.can_apply(l):
-                        stem = r.op.apply(l)
-                        assert r.op.can_revert(stem), f"op {r.op} cannot be reverted for base {l} -> {stem}"
-                        stems[(stem, (i, j))] = None
+                l = self._bases[i]
+                if len(l) < (r.min_base_length or self.min_base_length):
+                    continue
+                if self.vocab_langs is not None and self.vocab_langs[k] & self.rules_langs[j] == 0:
+                    continue
+                if r.op.can_apply(l):
+                    stem = r.op.apply(l)
+                    assert r.op.can_revert(stem), f"op {r.op} cannot be reverted for base {l} -> {stem}"
+                    stems[(stem, (i, j))] = None
+        return stems
 
+    def _build_stem_trie(self):
+        if self.any_op and not self._stem_trie_built:
+            # stems of added bases are in added_stem_trie
+            stems = self._collect_stems(range(self._base_count))
             if stems:
                 self.stem_trie = LookupTrie(pairs=stems.keys())
                 self.max_part_length = max(self.max_part_length, max(len(r) for r, _ in stems))
             self._stem_trie_built = True
+            self._stem_trie_langs = self.vocab_langs is not None
             
     def decompose(self, word: str, langs: Optional[Union[str,int,List[str]]], force_slow: bool = False) -> Iterable[Tuple[int, int, int, int]]:
         """Return all valid decompositions inside word as tuples (base index, rule index, start index, end index).
@@ -118,9 +289,9 @@ class Morpher:
                     if len(base) < (rule.min_base_length or self.min_base_length) and i >= 2: 
                         continue
                     # check base
-                    if not base in self.base_trie:
+                    base_idx = self._base_index(base)
+                    if base_idx is None:
                         continue
-                    base_idx = self.base_trie[base]
                     # check constraint
                     if rule.constraint_regex and not rule.constraint_regex.search(base):
                         continue
@@ -157,6 +328,7 @@ class Morpher:
             Iterable of tuples (base index, rule index, start index, end index)."""
         # ensure that the stem trie is built
         self._build_stem_trie()
+        ids = self._ids
 
         stems = [[] for _ in range(len(word))]
         # rules[j] for j>=1: positions where a stem can end; pre-seed with the empty-rule fallback.
@@ -178,14 +350,25 @@ class Morpher:
                         rules[i].append((suffix, rule_idx))
 
             # iterate over stems (= bases, for rules without op)
-            for stem, base_idx in self.base_trie.prefixes_and_values(part):
-                stems[i].append((stem, base_idx, None))
+            for base_trie in (self.base_trie, self.added_base_trie):
+                if base_trie is not None:
+                    for stem, base_idx in base_trie.prefixes_and_values(part):
+                        if ids is not None:
+                            base_idx = ids[base_idx]
+                            if base_idx < 0:
+                                continue
+                        stems[i].append((stem, base_idx, None))
 
             # iterate over stems (= morphed bases)
-            if self.stem_trie is not None:
-                for stem, idxs in self.stem_trie.prefixes_and_values(part):
-                    for base_idx, rule_idx in idxs:
-                        stems[i].append((stem, base_idx, rule_idx))
+            for stem_trie in (self.stem_trie, self.added_stem_trie):
+                if stem_trie is not None:
+                    for stem, idxs in stem_trie.prefixes_and_values(part):
+                        for base_idx, rule_idx in idxs:
+                            if ids is not None:
+                                base_idx = ids[base_idx]
+                                if base_idx < 0:
+                                    continue
+                            stems[i].append((stem, base_idx, rule_idx))
         
         # combine stems and rules
         for i in range(len(word)):
@@ -0,0 +1,579 @@
+# Path: umtoken/pool.py
+
+import importlib
+import io
+import json
+import os
+import pickle
+import shutil
+import socket
+import stat
+import sys
+import threading
+import time
+import traceback
+import uuid
+from functools import partial
+from multiprocessing import Pipe, Pool, Process
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+DEFAULT_BATCHES_PER_WORKER = 16
+DEFAULT_POLL_INTERVAL = 0.1 # seconds between checks for tasks and results of a FilePool
+DEFAULT_TIMEOUT = 600.0 # seconds a shard of a FilePool may be without a live worker
+DEFAULT_STALE_AFTER = 60.0 # seconds without heartbeats after which the claim of a FilePool worker is stale
+RUN_FILE = "run.json" # the current run of a FilePool directory
+
+class WorkerPool():
+    def __init__(self, workers: int):
+        """
+        A pool of long-lived worker processes with resident state.
+
+        Unlike multiprocessing.Pool, each call is sent to a specific worker, so that workers can keep data
+        between calls (e.g., their shard of the training words). Functions must be picklable (module-level)
+        and are called as func(state, *args), where state is a dict that persists in the worker and
+        state["index"] is the index of the worker. With a single worker, functions are called in-process.
+
+        Args:
+            workers: The number of workers.
+        """
+        assert workers > 0
+        self.workers = workers
+        self.connections = []
+        self.processes = []
+        self.state = None
+        self.local = True # the workers can attach to shared memory of this process
+        if workers == 1:
+            self.state = {"index": 0}
+        else:
+            for i in range(workers):
+                parent_conn, child_conn = Pipe()
+                process = Process(target=_worker_main, args=(child_conn, i), daemon=True)
+                process.start()
+                child_conn.close()
+                self.connections.append(parent_conn)
+                self.processes.append(process)
+
+    def run(self, func: Callable, args_list: Sequence[tuple]) -> List[Any]:
+        """
+        Calls func(state, *args) in each worker with its own arguments.
+
+        Args:
+            func: The function.
+            args_list: The arguments for each worker.
+
+        Returns:
+            The results of all workers.
+        """
+        assert len(args_list) == self.workers
+        if self.state is not None:
+            return [func(self.state, *args_list[0])]
+        for conn, args in zip(self.connections, args_list):
+            conn.send_bytes(pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL))
+        return self._receive()
+
+    def broadcast(self, func: Callable, *args) -> List[Any]:
+        """
+        Calls func(state, *args) in all workers with the same arguments (which are pickled only once).
+
+        Returns:
+            The results of all workers.
+        """
+        if self.state is not None:
+            return [func(self.state, *args)]
+        data = pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL)
+        for conn in self.connections:
+            conn.send_bytes(data)
+        return self._receive()
+
+    def _receive(self):
+        results = []
+        errors = []
+        for conn in self.connections:
+            ok, result = pickle.loads(conn.recv_bytes())
+            if ok:
+                results.append(result)
+            else:
+                errors.append(result)
+        if errors:
+            raise RuntimeError(f"Worker failed:\n{errors[0]}")
+        return results
+
+    def close(self):
+        """Stops the workers."""
+        for conn in self.connections:
+            try:
+                conn.send_bytes(pickle.dumps((None, None)))
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+        self.state = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _worker_main(conn, index):
+    state = {"index": index}
+    while True:
+        try:
+            func, args = pickle.loads(conn.recv_bytes())
+        except EOFError:
+            break
+        if func is None:
+            break
+        try:
+            result = (True, func(state, *args))
+        except Exception:
+            result = (False, traceback.format_exc())
+        conn.send_bytes(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    conn.close()
+
+class FilePool():
+    def __init__(self, directory: str, workers: int, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 timeout: Optional[float] = DEFAULT_TIMEOUT, stale_after: float = DEFAULT_STALE_AFTER):
+        """
+        A pool of worker processes on any number of machines, which communicate through a shared directory
+        (e.g., on a network file system) instead of pipes. It has the interface of WorkerPool.
+
+        The pool publishes a run in the directory (RUN_FILE), the workers are started separately on any machine
+        (see serve) and claim the shards of the run (the worker indices) with lock files, until all shards are claimed.
+        Each call is written to a task file (the function and its arguments, e.g., the logits of the model), each worker
+        calls it with the state of its shard and writes the result to a result file, which the pool collects (map/reduce).
+        Results and the arguments of most calls (e.g., the logits of each E-step) are values, i.e., NumPy arrays, numbers,
+        strings, None, and tuples, lists and dicts of them, which are saved as .npz files (see _dump_values) and loaded
+        without unpickling. Only calls with other arguments (e.g., the words and the model, sent once) are pickled.
+        Files are written atomically (to a temporary file, which is renamed). Only one pool may use a directory at a time:
+        the pool sends heartbeats by touching its run directory, a new pool removes the runs without heartbeats
+        (of crashed pools, which may take stale_after seconds) and raises an error if the run of another pool is alive.
+
+        Workers send heartbeats by touching their claim file (every stale_after / 10 seconds). A claim without heartbeats
+        for stale_after seconds is stale: another worker (one that stands by because all shards were claimed, or one
+        started later) takes over the shard with a new claim, and restores the state of the shard by replaying the calls
+        of the run. Therefore, the task files are kept until the pool is closed, and the functions must be deterministic
+        given the calls before them. stale_after must exceed the time the file system may cache file attributes,
+        and all pools and workers of a directory must use the same stale_after.
+
+        WARNING: the workers unpickle the task files of calls with other arguments, which can run arbitrary code
+        (the pool never unpickles files). Everyone who can write to the directory can run code in the workers,
+        so the directory must only be writable by trusted users (directories that are writable by all users are rejected).
+
+        Args:
+            directory: The shared directory.
+            workers: The number of workers (shards).
+            poll_interval: The interval between checks for results (seconds).
+            timeout: The maximum time a shard may be without a live worker while the pool waits for its result
+                     (seconds, default: DEFAULT_TIMEOUT, None = no limit), e.g., until a crashed worker is replaced.
+            stale_after: The time without heartbeats after which a worker is considered dead (seconds).
+        """
+        assert workers > 0
+        self.workers = workers
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.heartbeats = _Heartbeats(stale_after)
+        self.state = None
+        self.local = False
+        os.makedirs(directory, exist_ok=True)
+        _check_directory(directory)
+        _remove_stale_runs(directory, stale_after, poll_interval)
+        self.run_id = uuid.uuid4().hex
+        self.run_dir = os.path.join(directory, f"run-{self.run_id}")
+        os.makedirs(self.run_dir)
+        self.stop = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=_send_heartbeats, args=(self.run_dir, stale_after / 10, self.stop), daemon=True)
+        self.heartbeat_thread.start()
+        self.task = 0
+        _write_file(os.path.join(directory, RUN_FILE), json.dumps({"run": self.run_id, "workers": workers}).encode("utf-8"))
+
+    def run(self, func: Callable, args_list: Sequence[tuple]) -> List[Any]:
+        """
+        Calls func(state, *args) in each worker with its own arguments (see WorkerPool.run).
+        """
+        assert len(args_list) == self.workers
+        for i, args in enumerate(args_list):
+            _write_task_file(self._path(f"args-{self.task}-{i}"), args)
+        return self._call(func, None)
+
+    def broadcast(self, func: Callable, *args) -> List[Any]:
+        """
+        Calls func(state, *args) in all workers with the same arguments (written to a single task file).
+        """
+        return self._call(func, args)
+
+    def _path(self, name):
+        return os.path.join(self.run_dir, name)
+
+    def _call(self, func, args):
+        # the arguments of each worker are in separate files if args is None (see run)
+        assert self.run_dir is not None, "pool is closed"
+        task = self.task
+        self.task += 1
+        _write_task_file(self._path(f"task-{task}"), (func, args))
+        results = [None] * self.workers
+        pending = set(range(self.workers))
+        # the last time each shard had a live worker
+        alive = {i: time.monotonic() for i in pending}
+        while pending:
+            for i in sorted(pending):
+                path = self._path(f"result-{task}-{i}.npz")
+                if os.path.exists(path):
+                    results[i] = _load_values(path)
+                    os.remove(path)
+                    pending.remove(i)
+            if pending:
+                claims = _claims(self.run_dir)
+                now = time.monotonic()
+                for i in pending:
+                    if i in claims and self.heartbeats.alive(claims[i][1]):
+                        alive[i] = now
+                dead = sorted(i for i in pending if now - alive[i] > self.timeout) if self.timeout is not None else []
+                if dead:
+                    raise TimeoutError(f"No live workers for shards {dead} for {self.timeout} seconds")
+                time.sleep(self.poll_interval)
+        errors = [result for ok, result in results if not ok]
+        if errors:
+            raise RuntimeError(f"Worker failed:\n{errors[0]}")
+        return [result for _, result in results]
+
+    def close(self):
+        """Stops the workers (they stop after their current call, or when they find the run directory removed)."""
+        if self.run_dir is None:
+            return
+        _write_task_file(self._path(f"task-{self.task}"), (None, None))
+        run_file = os.path.join(self.directory, RUN_FILE)
+        try:
+            with open(run_file, "r", encoding="utf8") as f:
+                if json.load(f)["run"] == self.run_id:
+                    os.remove(run_file)
+        except (OSError, ValueError):
+            pass
+        self.stop.set()
+        self.heartbeat_thread.join()
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.run_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _Heartbeats():
+    def __init__(self, stale_after: float):
+        """
+        Tracks the heartbeats of claim files (and run directories): a claim is stale if its file was not touched
+        for stale_after seconds, measured with the local clock (so that the clocks of the machines and of the file server
+        need not agree). Claims are alive when they are seen for the first time.
+        """
+        self.stale_after = stale_after
+        self.seen = {}
+        self.first = {} # the mtime of each file when it was seen for the first time
+
+    def alive(self, path: str) -> bool:
+        now = time.monotonic()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        seen = self.seen.get(path)
+        if seen is None or seen[0] != mtime:
+            self.seen[path] = (mtime, now)
+            self.first.setdefault(path, mtime)
+            return True
+        return now - seen[1] < self.stale_after
+
+    def touched(self, path: str) -> bool:
+        """Whether the file was touched since it was seen for the first time (see alive)."""
+        return path in self.seen and self.seen[path][0] != self.first[path]
+
+def _claims(run_dir: str) -> Dict[int, Tuple[int, str]]:
+    # the latest claim of each shard as (generation, path), a worker that takes over a shard claims the next generation
+    claims = {}
+    for name in os.listdir(run_dir):
+        if name.startswith("claim-"):
+            index, generation = map(int, name[len("claim-"):].split("-"))
+            if claims.get(index, (-1, None))[0] < generation:
+                claims[index] = (generation, os.path.join(run_dir, name))
+    return claims
+
+def _remove_stale_runs(directory: str, stale_after: float, poll_interval: float):
+    # waits until the run directories are touched (alive) or stale, the runs of crashed pools are removed
+    # (their workers stop when their run directory is removed)
+    heartbeats = _Heartbeats(stale_after)
+    runs = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith("run-")]
+    while runs:
+        for run_dir in list(runs):
+            if not heartbeats.alive(run_dir):
+                shutil.rmtree(run_dir, ignore_errors=True)
+                runs.remove(run_dir)
+            elif heartbeats.touched(run_dir):
+                raise RuntimeError(f"Another pool is running in {directory} ({run_dir})")
+        if runs:
+            time.sleep(poll_interval)
+
+def _check_directory(directory: str):
+    # everyone who can write to the directory can run code in the pool and its workers (the files are pickled)
+    assert not os.stat(directory).st_mode & stat.S_IWOTH, f"{directory} must not be writable by all users"
+
+def serve(directory: str, poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: Optional[float] = None,
+          stale_after: float = DEFAULT_STALE_AFTER) -> bool:
+    """
+    Serves a shard of the run of a FilePool: waits for a run in directory, claims a shard and calls the functions
+    of the tasks with the state of the shard (state["index"] is the index of the shard), until the pool is closed.
+    If all shards are claimed, the worker stands by until a claim turns stale, and takes over its shard
+    (replaying the calls of the run to restore the state of the shard, see FilePool).
+
+    WARNING: the task files of calls with other arguments than values are unpickled, which can run arbitrary code,
+    so the directory must only be writable by trusted users (see FilePool).
+
+    Args:
+        directory: The shared directory of the pool.
+        poll_interval: The interval between checks for runs and tasks (seconds).
+        timeout: The maximum time to wait for a run (seconds, default: None = no limit).
+        stale_after: The time without heartbeats after which a claim is stale (seconds, see FilePool).
+
+    Returns:
+        Whether a shard was served (False: no run within the timeout, or the run ended before a shard was claimed).
+    """
+    started = time.time()
+    run = None
+    while run is None:
+        try:
+            with open(os.path.join(directory, RUN_FILE), "r", encoding="utf8") as f:
+                run = json.load(f)
+        except (OSError, ValueError):
+            if timeout is not None and time.time() - started > timeout:
+                return False
+            time.sleep(poll_interval)
+    _check_directory(directory)
+    run_dir = os.path.join(directory, f"run-{run['run']}")
+
+    claim = _claim_shard(run_dir, run["workers"], poll_interval, stale_after)
+    if claim is None:
+        return False
+    index, generation = claim
+    stop = threading.Event()
+    heartbeats = threading.Thread(target=_send_heartbeats, args=(os.path.join(run_dir, f"claim-{index}-{generation}"),
+                                                                  stale_after / 10, stop), daemon=True)
+    heartbeats.start()
+    try:
+        _serve_shard(run_dir, index, generation, poll_interval)
+    finally:
+        stop.set()
+        heartbeats.join()
+    return True
+
+def _claim_shard(run_dir: str, workers: int, poll_interval: float, stale_after: float) -> Optional[Tuple[int, int]]:
+    # claims a free shard or takes over a shard with a stale claim, returns (index, generation), None if the run is over
+    heartbeats = _Heartbeats(stale_after)
+    while True:
+        try:
+            claims = _claims(run_dir)
+        except FileNotFoundError:
+            return None
+        for i in range(workers):
+            generation, path = claims.get(i, (-1, None))
+            if path is not None and heartbeats.alive(path):
+                continue
+            try:
+                # only one worker can create the claim of the next generation
+                fd = os.open(os.path.join(run_dir, f"claim-{i}-{generation + 1}"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            except FileNotFoundError:
+                return None
+            os.write(fd, f"{socket.gethostname()}:{os.getpid()}".encode("utf-8"))
+            os.close(fd)
+            return i, generation + 1
+        time.sleep(poll_interval)
+
+def _send_heartbeats(path: str, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except OSError:
+            # the run is over
+            break
+
+def _serve_shard(run_dir: str, index: int, generation: int, poll_interval: float):
+    state = {"index": index}
+    task = 0
+    try:
+        while True:
+            path = _find_task_file(os.path.join(run_dir, f"task-{task}"))
+            if path is None:
+                if not os.path.isdir(run_dir) or _claims(run_dir)[index][0] != generation:
+                    # the run is over, or another worker took over the shard
+                    break
+                time.sleep(poll_interval)
+                continue
+            try:
+                func, args = _read_task_file(path)
+                if func is None:
+                    break
+                if args is None:
+                    args = _read_task_file(_find_task_file(os.path.join(run_dir, f"args-{task}-{index}")))
+                result = (True, func(state, *args))
+                data = _dump_values(result)
+            except Exception:
+                data = _dump_values((False, traceback.format_exc()))
+            task += 1
+            # when replaying the calls of a shard that was taken over, the results of all but the last call
+            # have been collected (the pool writes the next task after collecting the results)
+            if _find_task_file(os.path.join(run_dir, f"task-{task}")) is not None:
+                continue
+            if _claims(run_dir)[index][0] != generation:
+                break
+            _write_file(os.path.join(run_dir, f"result-{task - 1}-{index}.npz"), data)
+    except FileNotFoundError:
+        # the run directory was removed
+        pass
+
+def _write_task_file(base: str, value):
+    # values are saved without pickling (path base.npz), anything else is pickled (path base.pkl)
+    try:
+        _write_file(f"{base}.npz", _dump_values(value))
+    except TypeError:
+        _write_file(f"{base}.pkl", pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+def _find_task_file(base: str) -> Optional[str]:
+    for path in [f"{base}.npz", f"{base}.pkl"]:
+        if os.path.exists(path):
+            return path
+    return None
+
+def _read_task_file(path: str):
+    if path.endswith(".npz"):
+        return _load_values(path)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def _dump_values(value) -> bytes:
+    """
+    Saves a value to an .npz file without pickling: the arrays are stored as arrays, everything else is stored
+    as a JSON structure (see _encode_value). Module-level functions are stored by name.
+
+    Args:
+        value: The value (NumPy arrays, numbers, strings, None, module-level functions, and tuples, lists and dicts
+               with string keys of values).
+
+    Returns:
+        The content of the file.
+
+    Raises:
+        TypeError: If the value contains anything else.
+    """
+    arrays = []
+    structure = json.dumps(_encode_value(value, arrays)).encode("utf-8")
+    f = io.BytesIO()
+    np.savez(f, *arrays, structure=np.frombuffer(structure, dtype=np.uint8))
+    return f.getvalue()
+
+def _load_values(path: str):
+    """Loads a value saved with _dump_values (without unpickling)."""
+    with np.load(path, allow_pickle=False) as data:
+        return _decode_value(json.loads(data["structure"].tobytes().decode("utf-8")), data)
+
+def _encode_value(value, arrays: list):
+    # JSON values are kept, the other values are encoded as objects with a single key (their kind)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            # e.g., Python integers that exceed the NumPy integer types
+            if value.ndim != 1:
+                raise TypeError("Only one-dimensional object arrays can be saved without pickling")
+            return {"objects": [_encode_value(v, arrays) for v in value.tolist()]}
+        arrays.append(value)
+        return {"array": len(arrays) - 1}
+    if isinstance(value, np.generic):
+        return _encode_value(value.item(), arrays)
+    if isinstance(value, tuple):
+        return {"tuple": [_encode_value(v, arrays) for v in value]}
+    if isinstance(value, list):
+        return [_encode_value(v, arrays) for v in value]
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {"dict": {k: _encode_value(v, arrays) for k, v in value.items()}}
+    name = _function_name(value)
+    if name is not None:
+        return {"function": name}
+    raise TypeError(f"{type(value).__name__} cannot be saved without pickling")
+
+def _function_name(func) -> Optional[str]:
+    # module-level functions are stored by name (as pickle does), None for anything else
+    module, name = getattr(func, "__module__", None), getattr(func, "__qualname__", None)
+    if module in sys.modules and name is not None and getattr(sys.modules[module], name, None) is func:
+        return f"{module}:{name}"
+    return None
+
+def _decode_value(value, arrays):
+    if isinstance(value, list):
+        return [_decode_value(v, arrays) for v in value]
+    if not isinstance(value, dict):
+        return value
+    (kind, content), = value.items()
+    if kind == "array":
+        return arrays[f"arr_{content}"]
+    if kind == "objects":
+        objects = np.empty(len(content), dtype=object)
+        objects[:] = [_decode_value(v, arrays) for v in content]
+        return objects
+    if kind == "tuple":
+        return tuple(_decode_value(v, arrays) for v in content)
+    if kind == "dict":
+        return {k: _decode_value(v, arrays) for k, v in content.items()}
+    if kind == "function":
+        module, name = content.split(":")
+        return getattr(importlib.import_module(module), name)
+    raise ValueError(f"Unknown kind of value: {kind}")
+
+def _write_file(path: str, data: bytes):
+    # readers never see partial files
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def imap_batches(func: Callable, context: Any, batches: Sequence, workers: int, desc: Optional[str] = None) -> Iterator[Any]:
+    """
+    Calls func(context, batch) for each batch, handing out the batches one by one to idle workers.
+
+    Compared to splitting the work into one task per worker, many (cost-balanced) micro-batches keep all workers busy
+    until the end, even if the costs are estimated poorly or workers compete for cores.
+    The context (e.g., the model) is sent to each worker only once. With a single worker, batches are processed in-process.
+
+    Args:
+        func: The function (must be picklable).
+        context: The data shared by all batches.
+        batches: The batches.
+        workers: The number of workers.
+        desc: The description of the progress bar (None: no progress bar).
+
+    Returns:
+        An iterator over the results (in the order of the batches).
+    """
+    progress = partial(tqdm, desc=desc, total=len(batches), disable=desc is None)
+    if workers == 1:
+        for batch in progress(batches):
+            yield func(context, batch)
+        return
+    with Pool(workers, initializer=_set_context, initargs=(context,)) as p:
+        yield from progress(p.imap(partial(_call_with_context, func), batches, chunksize=1))
+
+_context = None
+
+def _set_context(context):
+    global _context
+    _context = context
+
+def _call_with_context(func, batch):
+    return func(_context, batch)
@@ -5,6 +5,7 @@ import regex as re
 import unicodedata
 
 from .alphabet import Encoding, unescape
+from .scanner import SplitScanner
 from .utils import cumsum
 
 # default pre-split regex
@@ -19,6 +20,10 @@ from .utils import cumsum
 # 9. match any (repeated) character that is not a letter, digit, or whitespace
 # wherein a single blank is merged to any succeeding match that is not a whitespace
 SPLIT_REGEX = r'( ?(?:[\p{Ll}\p{Lo}\p{Lm}]+|(?:\p{Lu}\p{Ll}|\p{Lt})[\p{Ll}\p{Lo}\p{Lm}]*|\p{Lu}\p{Lu}[\p{Lu}\p{Lo}\p{Lm}]*(?!\p{Ll})|\d+|(?<! )(\s)\2*|</?(?:su[bp]|u)>|\{(?:==|\+\+|--)|(?:==|\+\+|--)\}|(.)\3*))'
+# previous default pre-split regex without 7. and 8. (used by tokenizers trained before, e.g. the bundled assets)
+LEGACY_SPLIT_REGEX = r'( ?(?:[\p{Ll}\p{Lo}\p{Lm}]+|(?:\p{Lu}\p{Ll}|\p{Lt})[\p{Ll}\p{Lo}\p{Lm}]*|\p{Lu}\p{Lu}[\p{Lu}\p{Lo}\p{Lm}]*(?!\p{Ll})|\d+|(?<! )(\s)\2*|(.)\3*))'
+# split regexes that can be evaluated by the SplitScanner (pattern -> markup)
+SCANNER_SPLIT_REGEXES = {SPLIT_REGEX: True, LEGACY_SPLIT_REGEX: False}
 
 PAD_TOKEN = "[PAD]" # padding token
 UNK_TOKEN = "[UNK]" # unknown token (should never happen because we escape all text - also used if something goes wrong in model.encode)
@@ -36,9 +41,13 @@ _ws_or_control_regex = re.compile(r'\p{Z}(?<! )|\p{Cc}(?<![\t\n])', re.UNICODE)
 _alpha_or_num_regex = re.compile(r'\p{N}|(\p{L}(?<!\p{Lm}))+', re.UNICODE)
 # per-char form of _alpha_or_num_regex for the offset-tracking slow path
 _alpha_or_num_char_regex = re.compile(r'\p{N}|[\p{Ll}\p{Lu}\p{Lt}\p{Lo}]', re.UNICODE)
-# fast path for normalize(return_offsets=True): ASCII printable + tab/newline/CR + Latin-1 letter half
-# every char in this set is NFC-stable, NFKC-stable, and not in \p{Cf}/\p{M}/\p{Cc}/non-space \p{Z}.
-_norm_stable_regex = re.compile(r'\A[\x20-\x7E\t\n\rÀ-ÿ]*\Z', re.UNICODE)
+# fast path for normalize(return_offsets=True): ASCII printable + tab/newline + Latin-1 letter half
+# every char in this set is NFC-stable, NFKC-stable, and not in \p{Cf}/\p{M}/non-space \p{Z}/\p{Cc} (except tab/newline).
+# CR is excluded because it is replaced by a blank in 'default' and 'ipt' normalization.
+_norm_stable_regex = re.compile(r'\A[\x20-\x7E\t\nÀ-ÿ]*\Z', re.UNICODE)
+# characters before a safe cut position (see PreTokenizer.find_segment_boundaries), NFKC maps the excluded
+# Arabic presentation forms to a blank followed by a mark that is removed by the clean regex
+_CUT_PREDECESSOR = r"(?<=[\p{L}\p{N}\p{P}\p{S}])(?<![\uFC5E-\uFC63\uFE70-\uFE7F])"
 
 class PreTokenizer:
     def __init__(self,
@@ -48,7 +57,8 @@ class PreTokenizer:
                  split_regex=SPLIT_REGEX,
                  reserved_tokens: Optional[List[str]] = None,
                  preserve_soft_hyphen: Union[bool, str] = False,
-                 preserve_format_and_diactritic: bool = False):
+                 preserve_format_and_diactritic: bool = False,
+                 split_engine: Literal["regex", "scanner"] = "regex"):
         """
         Pre-tokenizer that pre-splits and optionally encodes (escapes) the text.
         
@@ -68,6 +78,9 @@ class PreTokenizer:
                                   True or 'preserve': preserve soft hyphen as isolated character and escape it
                                   'append': preserve soft hyphen and append it to the preceding word if any (otherwise preserve as isolated character)
             preserve_format_and_diactritic: Whether to preserve format characters (Cf) and uncombined diacritics (M) before splitting.
+            split_engine: The engine to evaluate the split regex with.
+                          'regex': use the regex module
+                          'scanner': use the hand-written SplitScanner (faster, only available for SPLIT_REGEX and LEGACY_SPLIT_REGEX)
             
         Remarks:
             The term word is used here to refer to split units of text (including punctuation, whitespace, etc.)
@@ -84,6 +97,8 @@ class PreTokenizer:
         assert alphabet is None or encoding is None, "alphabet and encoding must not be provided simultaneously"
         assert normalization is None or normalization in ["default", "ipt", "nfc"], "normalization must be None, 'default', 'ipt', or 'nfc'"
         assert preserve_soft_hyphen in [False, True, 'remove', 'preserve', 'append'], "preserve_soft_hyphen must be a boolean or one of 'remove', 'preserve', 'append'"
+        assert split_engine in ["regex", "scanner"], "split_engine must be 'regex' or 'scanner'"
+        assert split_engine == "regex" or split_regex in SCANNER_SPLIT_REGEXES, "split_engine 'scanner' requires the default split regex"
 
         if preserve_soft_hyphen == False:
             preserve_soft_hyphen = 'remove'
@@ -101,9 +116,12 @@ class PreTokenizer:
         self.encoding = encoding or (Encoding(alphabet) if alphabet is not None else None)
         self.normalization = normalization
         self.split_regex = re.compile(split_regex, re.UNICODE)
+        self.split_engine = split_engine
+        self.split_scanner = SplitScanner(markup=SCANNER_SPLIT_REGEXES[split_regex]) if split_engine == "scanner" else None
         self.reserved_tokens = frozenset(self.reserved_tokens_list)
         self.reserved_tokens_regex = re.compile("(" + "|".join(re.escape(t) for t in regex_order) + ")", re.UNICODE) if regex_order else None
         self._allowed_reserved_regex_cache = {}
+        self._cut_regex_cache = {}
         self.preserve_soft_hyphen = preserve_soft_hyphen
         self.preserve_format_and_diactritic = preserve_format_and_diactritic
         
@@ -159,7 +177,7 @@ class PreTokenizer:
                 else:
                     words.append(part)
         else:
-            words = list(m.group(1) for m in self.split_regex.finditer(text))
+            words = list(text[start:end] for start, end in self._split_spans(text))
             
         if self.preserve_soft_hyphen == 'append' and any(w == "\u00AD" for w in words):
             # append soft hyphen to preceding word if any
@@ -344,16 +362,7 @@ class PreTokenizer:
             return (src_map[n_start], src_map[n_end] - src_map[n_start])
 
         word_spans = list(self._split_normalized(normalized, handle_reserved, allowed_reserved))
-
-        if self.preserve_soft_hyphen == 'append' and any(w == "­" for w, _, _ in word_spans):
-            merged: List[Tuple[str, int, int]] = []
-            for w, ns, ne in word_spans:
-                if w == "­" and merged and not merged[-1][0].endswith("­"):
-                    pw, pns, _ = merged[-1]
-                    merged[-1] = (pw + w, pns, ne)
-                else:
-                    merged.append((w, ns, ne))
-            word_spans = merged
+        word_spans = self._merge_soft_hyphen_spans(word_spans)
 
         # split compound words into parts, partitioning each word's normalized
         # span among the parts; reserved tokens are never split
@@ -374,6 +383,164 @@ class PreTokenizer:
         ranges = [to_orig(ns, ne) for _, ns, ne in word_spans]
         return escaped, ranges
 
+    def find_segment_boundaries(self, text: str,
+                                segment_length: int,
+                                handle_reserved: bool = False,
+                                allowed_reserved: Optional[list[str]] = None) -> List[int]:
+        """
+        Finds positions at which the text can be cut into segments of at least segment_length characters,
+        such that splitting and escaping the segments separately yields the same words as splitting the whole text.
+
+        Args:
+            text: The text to segment.
+            segment_length: The minimum length of each segment (except for the last one).
+            handle_reserved: Whether reserved tokens are handled (see split).
+            allowed_reserved: Restrict allowed reserved tokens to this list, if provided.
+
+        Returns:
+            The sorted list of cut positions (excluding 0 and len(text)), empty if the text cannot be cut safely.
+
+        Remarks:
+            A position c is a safe cut if text[c] is a blank or newline that does not occur in any reserved token,
+            and text[c-1] is a letter, number, punctuation, or symbol (see _CUT_PREDECESSOR):
+            - normalization: text[c] starts a new combining sequence, text[c-1] is not removed and does not become whitespace
+              (except for a few Arabic presentation forms that are excluded);
+            - reserved tokens: no match can contain text[c], so no match crosses the cut and matching restarts at c;
+            - split regex: only whitespace runs and a leading blank can contain text[c], both must start at c because text[c-1] is
+              not whitespace, and the lookbehind "(?<! )" at c succeeds both with and without text[c-1];
+            - soft hyphens are only appended to a preceding word, and the first word of a segment starts with text[c].
+            Only the default split regexes are supported (custom split regexes are never cut).
+        """
+        if segment_length <= 0 or len(text) <= segment_length:
+            return []
+        cut_regex = self._get_cut_regex(handle_reserved, allowed_reserved)
+        if cut_regex is None:
+            return []
+        cuts = []
+        pos = segment_length
+        while pos < len(text):
+            m = cut_regex.search(text, pos)
+            if m is None:
+                break
+            cuts.append(m.start())
+            pos = m.start() + segment_length
+        return cuts
+
+    def split_reserved(self, text: str,
+                       allowed_reserved: Optional[List[str]] = None) -> Iterable[Tuple[int, int, bool]]:
+        """
+        Splits already-normalized text at reserved tokens.
+
+        Args:
+            text: The normalized text.
+            allowed_reserved: Restrict allowed reserved tokens to this list, if provided.
+
+        Returns:
+            Iterable of tuples (start, end, is_reserved) that cover the text without gaps,
+            where is_reserved indicates whether text[start:end] is a reserved token.
+        """
+        if not self.reserved_tokens:
+            if text:
+                yield 0, len(text), False
+            return
+        reserved_regex = self.reserved_tokens_regex
+        if allowed_reserved:
+            key = frozenset(allowed_reserved)
+            reserved_regex = self._allowed_reserved_regex_cache.get(key)
+            if reserved_regex is None:
+                ordered = sorted(set(allowed_reserved), key=len, reverse=True)
+                reserved_regex = re.compile("(" + "|".join(re.escape(t) for t in ordered) + ")", re.UNICODE)
+                self._allowed_reserved_regex_cache[key] = reserved_regex
+        pos = 0
+        for rm in reserved_regex.finditer(text):
+            if pos < rm.start():
+                yield pos, rm.start(), False
+            yield rm.start(), rm.end(), True
+            pos = rm.end()
+        if pos < len(text):
+            yield pos, len(text), False
+
+    def split_and_escape_segment(self, text: str, start: int, end: int,
+                                 allowed_reserved: Optional[List[str]] = None) -> Tuple[List[Tuple[str, int, int]], List[Tuple[int, int]]]:
+        """
+        Splits and escapes a segment of already-normalized text between reserved tokens (see split_reserved)
+        the same way as split_and_escape(..., handle_reserved=True, return_as_tuple=True) does as part of the whole text.
+
+        Args:
+            text: The normalized text.
+            start: The start of the segment.
+            end: The end of the segment.
+            allowed_reserved: Restrict allowed reserved tokens to this list, if provided.
+
+        Returns:
+            A tuple (escaped words as tuples, spans (start, end) in the normalized text).
+
+        Remarks:
+            Soft hyphens are only appended to preceding words inside of the segment.
+        """
+        word_spans = [(text[s:e], s, e) for s, e in self._split_spans(text, start, end)]
+        word_spans = self._merge_soft_hyphen_spans(word_spans)
+        escaped = [self.escape(w,
+                               handle_reserved=True,
+                               allowed_reserved=allowed_reserved,
+                               return_as_tuple=True) for w, _, _ in word_spans]
+        return escaped, [(ns, ne) for _, ns, ne in word_spans]
+
+    def _merge_soft_hyphen_spans(self, word_spans: List[Tuple[str, int, int]]) -> List[Tuple[str, int, int]]:
+        """Append isolated soft hyphens to the preceding word (if preserve_soft_hyphen is 'append')."""
+        if self.preserve_soft_hyphen == 'append' and any(w == "­" for w, _, _ in word_spans):
+            merged: List[Tuple[str, int, int]] = []
+            for w, ns, ne in word_spans:
+                if w == "­" and merged and not merged[-1][0].endswith("­"):
+                    pw, pns, _ = merged[-1]
+                    merged[-1] = (pw + w, pns, ne)
+                else:
+                    merged.append((w, ns, ne))
+            word_spans = merged
+        return word_spans
+
+    def find_safe_cut(self, text: str,
+                      pos: int = 0,
+                      endpos: Optional[int] = None,
+                      last: bool = False,
+                      handle_reserved: bool = False,
+                      allowed_reserved: Optional[list[str]] = None) -> Optional[int]:
+        """
+        Finds a safe cut position c with pos <= c < endpos (see find_segment_boundaries).
+        Characters before pos (text[c-1]) are taken into account.
+
+        Args:
+            text: The text.
+            pos: The minimum cut position.
+            endpos: The cut position must be less than endpos (default: len(text)).
+            last: Whether to find the last instead of the first cut position.
+            handle_reserved: Whether reserved tokens are handled (see split).
+            allowed_reserved: Restrict allowed reserved tokens to this list, if provided.
+
+        Returns:
+            The cut position or None if there is no safe cut position.
+        """
+        cut_regex = self._get_cut_regex(handle_reserved, allowed_reserved, reverse=last)
+        if cut_regex is None:
+            return None
+        m = cut_regex.search(text, max(pos, 1), len(text) if endpos is None else endpos)
+        return m.start() if m is not None else None
+
+    def _get_cut_regex(self, handle_reserved: bool, allowed_reserved: Optional[list[str]], reverse: bool = False):
+        """Returns the regex that matches the character at safe cut positions (None if there are none)."""
+        if self.split_regex.pattern not in SCANNER_SPLIT_REGEXES:
+            return None
+        reserved = (allowed_reserved or self.reserved_tokens_list) if handle_reserved else []
+        cut_chars = "".join(c for c in "\n " if not any(c in t for t in reserved))
+        if not cut_chars:
+            return None
+        key = (cut_chars, reverse)
+        cut_regex = self._cut_regex_cache.get(key)
+        if cut_regex is None:
+            cut_regex = re.compile(f"{_CUT_PREDECESSOR}[{re.escape(cut_chars)}]", re.REVERSE if reverse else 0)
+            self._cut_regex_cache[key] = cut_regex
+        return cut_regex
+
     def _split_normalized(self, text: str,
                           handle_reserved: bool,
                           allowed_reserved: Optional[List[str]]) -> Iterable[Tuple[str, int, int]]:
@@ -381,27 +548,27 @@ class PreTokenizer:
         in the normalized text. Mirrors the splitting logic of :meth:`split` but
         does not re-normalize and exposes match positions."""
         if handle_reserved and self.reserved_tokens:
-            reserved_regex = self.reserved_tokens_regex
-            if allowed_reserved:
-                key = frozenset(allowed_reserved)
-                reserved_regex = self._allowed_reserved_regex_cache.get(key)
-                if reserved_regex is None:
-                    ordered = sorted(set(allowed_reserved), key=len, reverse=True)
-                    reserved_regex = re.compile("(" + "|".join(re.escape(t) for t in ordered) + ")", re.UNICODE)
-                    self._allowed_reserved_regex_cache[key] = reserved_regex
-            pos = 0
-            for rm in reserved_regex.finditer(text):
-                if pos < rm.start():
-                    for sm in self.split_regex.finditer(text, pos, rm.start()):
-                        yield sm.group(1), sm.start(1), sm.end(1)
-                yield rm.group(0), rm.start(), rm.end()
-                pos = rm.end()
-            if pos < len(text):
-                for sm in self.split_regex.finditer(text, pos):
-                    yield sm.group(1), sm.start(1), sm.end(1)
+            for start, end, is_reserved in self.split_reserved(text, allowed_reserved):
+                if is_reserved:
+                    yield text[start:end], start, end
+                else:
+                    for s, e in self._split_spans(text, start, end):
+                        yield text[s:e], s, e
+        else:
+            for start, end in self._split_spans(text):
+                yield text[start:end], start, end
+
+    def _split_spans(self, text: str, pos: int = 0, endpos: Optional[int] = None) -> Iterable[Tuple[int, int]]:
+        """Yield the spans (start, end) of the words in ``text[pos:endpos]`` (group 1 of
+        the split regex), evaluated by the configured split engine."""
+        if self.split_scanner is not None:
+            yield from self.split_scanner.spans(text, pos, endpos)
+        elif endpos is None:
+            for sm in self.split_regex.finditer(text, pos):
+                yield sm.span(1)
         else:
-            for sm in self.split_regex.finditer(text):
-                yield sm.group(1), sm.start(1), sm.end(1)
+            for sm in self.split_regex.finditer(text, pos, endpos):
+                yield sm.span(1)
 
     def _assign_compound_ranges(self, parts: List[str], word: str,
                                 ns: int, ne: int) -> List[Tuple[str, int, int]]:
@@ -491,5 +658,6 @@ class PreTokenizer:
             reserved_tokens=kwargs.get("reserved_tokens", d.get("reserved_tokens")),
             preserve_soft_hyphen=kwargs.get("preserve_soft_hyphen", d.get("preserve_soft_hyphen")),
             preserve_format_and_diactritic=kwargs.get("preserve_format_and_diactritic", d.get("preserve_format_and_diactritic", False)),
+            split_engine=kwargs.get("split_engine", "regex"),
         )
         
\ No newline at end of file
@@ -0,0 +1,168 @@
+# Path: umtoken/scanner.py
+
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import regex as re
+
+# character classes as bit flags, so that unions can be tested with a single "&"
+CLS_OTHER = 0
+CLS_LOWER = 1  # \p{Ll}
+CLS_OTHER_LETTER = 2  # \p{Lo} or \p{Lm}
+CLS_UPPER = 4  # \p{Lu}
+CLS_TITLE = 8  # \p{Lt}
+CLS_DIGIT = 16 # \d
+CLS_SPACE = 32 # \s
+
+_LOWER_RUN = CLS_LOWER | CLS_OTHER_LETTER # [\p{Ll}\p{Lo}\p{Lm}]
+_UPPER_RUN = CLS_UPPER | CLS_OTHER_LETTER # [\p{Lu}\p{Lo}\p{Lm}]
+
+_class_table = None
+
+def get_class_table() -> np.ndarray:
+    """
+    Returns the codepoint -> character class table (uint8 array with 0x110000 entries).
+
+    The table is built once (lazily) from the regex module itself, so that the classes
+    agree with the Unicode version the split regex is evaluated with.
+    """
+    global _class_table
+    if _class_table is None:
+        table = np.zeros(0x110000, dtype=np.uint8)
+        all_chars = "".join(map(chr, range(0x110000)))
+        for pattern, cls in [(r"\p{Ll}+", CLS_LOWER),
+                             (r"[\p{Lo}\p{Lm}]+", CLS_OTHER_LETTER),
+                             (r"\p{Lu}+", CLS_UPPER),
+                             (r"\p{Lt}+", CLS_TITLE),
+                             (r"\d+", CLS_DIGIT),
+                             (r"\s+", CLS_SPACE)]:
+            for m in re.finditer(pattern, all_chars):
+                assert not table[m.start():m.end()].any(), f"overlapping character classes for {pattern}"
+                table[m.start():m.end()] = cls
+        _class_table = table
+    return _class_table
+
+class SplitScanner():
+    def __init__(self, markup: bool = True):
+        """
+        Hand-written state machine that reproduces the matches of the default split regex
+        (see pre.SPLIT_REGEX) from a precomputed codepoint -> character class table.
+
+        Args:
+            markup: Whether to match sub/superscript/underline tags and CriticMarkup brackets as units
+                    (SPLIT_REGEX) or not (LEGACY_SPLIT_REGEX).
+
+        Remarks:
+            The alternatives of the regex are resolved in the same order as the regex engine does:
+            1. a leading blank is merged into the following match if that match succeeds (otherwise, the blank is matched on its own),
+            2. lowercase runs, Camel runs, UPPER runs (backtracking by one char if followed by a lowercase letter), digit runs,
+            3. runs of the same whitespace character (a newline directly after a blank is not matched at all and thus dropped, as by the regex),
+            4. markup units (if enabled),
+            5. runs of any other same character.
+        """
+        self.markup = markup
+        self.class_table = get_class_table()
+
+    def classify(self, text: str) -> bytes:
+        """Returns the character class of each character in text (one byte per character)."""
+        codepoints = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        return self.class_table[codepoints].tobytes()
+
+    def spans(self, text: str, pos: int = 0, endpos: Optional[int] = None) -> Iterable[Tuple[int, int]]:
+        """
+        Yields the spans (start, end) of the words in text[pos:endpos],
+        exactly as split_regex.finditer(text, pos, endpos) would yield the spans of group 1.
+
+        Args:
+            text: The text to split.
+            pos: The position to start splitting at (characters before pos are only used as lookbehind).
+            endpos: The position to stop splitting at (characters after endpos are ignored, also for lookahead).
+        """
+        n = len(text) if endpos is None else min(endpos, len(text))
+        if pos >= n:
+            return
+        cls = self.classify(text[pos:n])
+        # work on local positions, prev is the lookbehind character of the first position
+        s = text[pos:n] if pos > 0 or n < len(text) else text
+        prev = text[pos-1] if pos > 0 else ""
+        n -= pos
+        match = self._match
+        i = 0
+        while i < n:
+            if s[i] == " " and i + 1 < n:
+                # try to merge the blank into the succeeding match
+                j = match(s, cls, i + 1, n, " ")
+                if j < 0:
+                    j = match(s, cls, i, n, s[i-1] if i > 0 else prev)
+            else:
+                j = match(s, cls, i, n, s[i-1] if i > 0 else prev)
+            if j < 0:
+                # no match at this position: skip the character (as finditer does)
+                i += 1
+                continue
+            yield pos + i, pos + j
+            i = j
+
+    def _match(self, s: str, cls: bytes, i: int, n: int, prev: str) -> int:
+        """Returns the end of the match starting at i (without leading blank), or -1 if there is no match."""
+        c = cls[i]
+        j = i + 1
+        if c & _LOWER_RUN:
+            # lower
+            while j < n and cls[j] & _LOWER_RUN:
+                j += 1
+            return j
+        if c == CLS_UPPER and j < n:
+            c1 = cls[j]
+            if c1 == CLS_LOWER:
+                # Camel
+                j += 1
+                while j < n and cls[j] & _LOWER_RUN:
+                    j += 1
+                return j
+            if c1 == CLS_UPPER:
+                # UPPER (not followed by a lowercase letter)
+                j += 1
+                while j < n and cls[j] & _UPPER_RUN:
+                    j += 1
+                if j == n or cls[j] != CLS_LOWER:
+                    return j
+                if j > i + 2:
+                    return j - 1
+            # fall through to the same-character run
+        elif c == CLS_TITLE:
+            # Camel (title case letter)
+            while j < n and cls[j] & _LOWER_RUN:
+                j += 1
+            return j
+        elif c == CLS_DIGIT:
+            while j < n and cls[j] == CLS_DIGIT:
+                j += 1
+            return j
+        elif c == CLS_SPACE:
+            ch = s[i]
+            # the whitespace alternative must not follow a blank, and "." does not match a newline
+            if ch == "\n" and prev == " ":
+                return -1
+            while j < n and s[j] == ch:
+                j += 1
+            return j
+        elif self.markup:
+            ch = s[i]
+            if ch == "<":
+                for tag in ("<sub>", "<sup>", "<u>", "</sub>", "</sup>", "</u>"):
+                    if s.startswith(tag, i, n):
+                        return i + len(tag)
+            elif ch == "{":
+                if s.startswith("==", j, n) or s.startswith("++", j, n) or s.startswith("--", j, n):
+                    return i + 3
+            elif ch == "=" or ch == "+" or ch == "-":
+                if j + 1 < n and s[j] == ch and s[j+1] == "}":
+                    return i + 3
+
+        # any other (repeated) character
+        ch = s[i]
+        j = i + 1
+        while j < n and s[j] == ch:
+            j += 1
+        return j
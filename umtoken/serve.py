@@ -0,0 +1,48 @@
+# Path: umtoken/serve.py
+
+import argparse
+from multiprocessing import Process
+
+from .pool import DEFAULT_POLL_INTERVAL, DEFAULT_STALE_AFTER, serve
+
+def main(args):
+    processes = [Process(target=serve, args=(args.directory, args.poll_interval, args.timeout, args.stale_after))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Serve shards of a distributed training run (see train.py --pool-dir). "
+                    "WARNING: task files with other arguments than arrays and numbers (e.g., the model) are unpickled, "
+                    "which can run arbitrary code, so the directory "
+                    "must only be writable by trusted users.")
+
+    parser.add_argument("directory",
+                        help="shared directory of the training run")
+
+    parser.add_argument("-p", "--processes",
+                        default=1,
+                        type=int,
+                        help="number of worker processes, each serves one shard or stands by to take over "
+                             "the shard of a stopped worker (default: 1)")
+
+    parser.add_argument("-pi", "--poll-interval",
+                        default=DEFAULT_POLL_INTERVAL,
+                        type=float,
+                        help=f"seconds between checks for tasks (default: {DEFAULT_POLL_INTERVAL})")
+
+    parser.add_argument("-to", "--timeout",
+                        type=float,
+                        help="maximum seconds to wait for a training run (default: None = no limit)")
+
+    parser.add_argument("-sa", "--stale-after",
+                        default=DEFAULT_STALE_AFTER,
+                        type=float,
+                        help=f"seconds without heartbeats after which a worker is replaced (default: {DEFAULT_STALE_AFTER})")
+
+    args = parser.parse_args()
+    main(args)
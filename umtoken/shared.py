@@ -0,0 +1,71 @@
+# Path: umtoken/shared.py
+
+import sys
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Tuple
+
+import numpy as np
+
+class SharedArrays():
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """
+        NumPy arrays published in shared memory (one segment per array), so that worker processes can attach
+        to them without copying or unpickling. The publishing process owns the segments and must call close.
+        Before Python 3.13, only child processes of the publishing process may attach (see attach).
+
+        Args:
+            arrays: The arrays to publish.
+        """
+        self.segments = []
+        self.handle = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            segment = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            self.segments.append(segment)
+            self.handle[key] = (segment.name, array.dtype.str, array.shape)
+
+    @staticmethod
+    def attach(handle: Dict[str, Tuple[str, str, tuple]]):
+        """
+        Attaches to published arrays.
+
+        Args:
+            handle: The handle of the published arrays (SharedArrays.handle).
+
+        Returns:
+            The arrays (dict), which keep their segments open until they are released.
+        """
+        arrays = {}
+        for key, (name, dtype, shape) in handle.items():
+            # the publishing process owns the segment, the resource tracker must not unlink it when this process exits
+            # (before Python 3.13, attaching registers the segment with the tracker, which is the tracker of the publishing
+            # process in its child processes, where registering the segment again has no effect)
+            if sys.version_info >= (3, 13):
+                segment = SharedMemory(name=name, track=False)
+            else:
+                segment = SharedMemory(name=name)
+            arrays[key] = np.asarray(_AttachedArray(segment, shape, np.dtype(dtype)))
+        return arrays
+
+    def close(self):
+        """Releases and removes the segments (attached processes keep their mappings)."""
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+class _AttachedArray():
+    def __init__(self, segment: SharedMemory, shape: tuple, dtype: np.dtype):
+        """
+        The base of an attached array (exposed with the array interface), which keeps the segment open as long as
+        the array or any view of it exists, and closes it afterwards.
+        """
+        self.segment = segment
+        self.array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        self.__array_interface__ = self.array.__array_interface__
+
+    def __del__(self):
+        # the segment can only be closed once its buffer is no longer exported
+        self.array = None
+        self.segment.close()
@@ -0,0 +1,120 @@
+# Path: umtoken/streaming.py
+
+from typing import Optional
+
+from .tokenizer import Tokenizer
+
+class StreamingTokenizer():
+    def __init__(self,
+                 tokenizer: Tokenizer,
+                 handle_reserved: bool = False,
+                 allowed_reserved: Optional[list[str]] = None,
+                 merge_prop_ids: bool = True,
+                 return_ranges: bool = False,
+                 force_slow: bool = False,
+                 local_cache: Optional[dict] = None,
+                 max_buffer_length: Optional[int] = 1024):
+        """
+        Tokenizes a text stream that arrives in chunks (e.g., live subtitles).
+
+        Each pushed chunk is appended to a buffer. The words before the last safe cut position of the buffer
+        (see PreTokenizer.find_safe_cut) are tokenized and emitted, the rest of the buffer (the trailing blank and word fragment,
+        a partial reserved token, etc.) is held back until its boundary is certain. The concatenation of all emitted tokens
+        is identical to the result of tokenizing the whole text at once.
+
+        Text without safe cut positions (e.g., long CJK runs without blanks) would be held back until flush.
+        If the buffer grows beyond max_buffer_length, it is cut at the start of its last word instead
+        (or, if the buffer is a single word, at its end). The tokens of forced cuts may differ from the result
+        of tokenizing the whole text at once at the cut.
+
+        Args:
+            tokenizer: The tokenizer.
+            handle_reserved: See Tokenizer.tokenize.
+            allowed_reserved: See Tokenizer.tokenize.
+            merge_prop_ids: See Tokenizer.tokenize.
+            return_ranges: Whether to also return the word ranges (relative to the start of the stream) and
+                           the mapping of tokens to words (indices relative to the start of the stream).
+            force_slow: See Tokenizer.tokenize.
+            local_cache: A local cache for storing token ids (shared across chunks). If not set, a new cache is created.
+            max_buffer_length: The maximum length of the buffer (characters) before a cut is forced
+                               (None: hold back the text until there is a safe cut position).
+        """
+        assert max_buffer_length is None or max_buffer_length > 0
+        self.tokenizer = tokenizer
+        self.handle_reserved = handle_reserved
+        self.allowed_reserved = allowed_reserved
+        self.merge_prop_ids = merge_prop_ids
+        self.return_ranges = return_ranges
+        self.force_slow = force_slow
+        self.local_cache = {} if local_cache is None else local_cache
+        self.max_buffer_length = max_buffer_length
+        self.reset()
+
+    def reset(self):
+        """Discards the buffer and starts a new stream."""
+        self.buffer = ""
+        self.offset = 0
+        self.word_count = 0
+
+    def push(self, chunk: str):
+        """
+        Appends a chunk to the stream.
+
+        Args:
+            chunk: The text chunk.
+
+        Returns:
+            The tokens of the words whose boundaries are certain (see Tokenizer.tokenize, and return_ranges).
+        """
+        # cut positions before the chunk have already been searched
+        pos = max(len(self.buffer), 1)
+        self.buffer += chunk
+        cut = self.tokenizer.pre.find_safe_cut(self.buffer, pos, last=True,
+                                               handle_reserved=self.handle_reserved,
+                                               allowed_reserved=self.allowed_reserved)
+        if cut is None and self.max_buffer_length is not None and len(self.buffer) > self.max_buffer_length:
+            cut = self._forced_cut()
+        return self._emit(0 if cut is None else cut)
+
+    def flush(self):
+        """
+        Ends the stream and tokenizes the rest of the buffer. Subsequent chunks start a new stream.
+
+        Returns:
+            The remaining tokens (see push).
+        """
+        result = self._emit(len(self.buffer))
+        self.reset()
+        return result
+
+    def _forced_cut(self) -> int:
+        """Returns the start of the last word of the buffer (the end of the buffer if it is a single word)."""
+        _, word_ranges, _ = self.tokenizer.tokenize(self.buffer,
+                                                    handle_reserved=self.handle_reserved,
+                                                    allowed_reserved=self.allowed_reserved,
+                                                    return_ranges=True,
+                                                    force_slow=self.force_slow,
+                                                    local_cache=self.local_cache)
+        start = word_ranges[-1][0] if word_ranges else 0
+        return start if start > 0 else len(self.buffer)
+
+    def _emit(self, end: int):
+        """Tokenizes and removes buffer[:end]."""
+        text = self.buffer[:end]
+        if text:
+            tokens, word_ranges, tokens_to_words = self.tokenizer.tokenize(text,
+                                                                           handle_reserved=self.handle_reserved,
+                                                                           allowed_reserved=self.allowed_reserved,
+                                                                           merge_prop_ids=self.merge_prop_ids,
+                                                                           return_ranges=True,
+                                                                           force_slow=self.force_slow,
+                                                                           local_cache=self.local_cache)
+        else:
+            tokens, word_ranges, tokens_to_words = [], [], []
+        if self.return_ranges:
+            word_ranges = [(start + self.offset, length) for start, length in word_ranges]
+            tokens_to_words = [i + self.word_count for i in tokens_to_words]
+        self.buffer = self.buffer[end:]
+        self.offset += end
+        self.word_count += len(word_ranges)
+        return (tokens, word_ranges, tokens_to_words) if self.return_ranges else tokens
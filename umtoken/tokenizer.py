@@ -1,14 +1,20 @@
 # Path: umtoken/tokenizer.py
 
 import json
+import os
+from bisect import bisect_left
+from multiprocessing import Pool
 from typing import Callable, List, Optional, Tuple, Union
 from warnings import warn
 
 from .alphabet import ASCII_ENCODING_SPACE as SP, ASCII_RESERVED_UPPER as UP
+from .cache import SegmentCache
 from .pre import PreTokenizer
 from .model import Model
 from .utils import cumsum
 
+DEFAULT_SEGMENT_LENGTH = 64 * 1024
+
 class Tokenizer():
     def __init__(self, 
                  pre: PreTokenizer,
@@ -39,7 +45,8 @@ class Tokenizer():
                  return_ranges: bool = False,
                  force_slow: bool = False,
                  local_cache: Optional[dict] = None,
-                 split_compound_func: Optional[Callable] = None):
+                 split_compound_func: Optional[Callable] = None,
+                 segment_cache: Optional[SegmentCache] = None):
         """
         Tokenizes text into tuples of token ids.
         
@@ -54,11 +61,22 @@ class Tokenizer():
             local_cache: A local cache for storing token ids.
             split_compound_func: Callable that splits a word into one or more parts (str->list[str]).
                                  The callable is responsible for maintaining case and appending soft hyphens to mods if necessary.
+            segment_cache: A cache for the token ids of the text segments between reserved tokens (only used if handle_reserved is True,
+                           and neither is_split_and_escaped nor split_compound_func are set).
+                           Only segments that are not in the cache are split, escaped, and encoded.
 
         Returns:
             If return_ranges is False, the list of token ids (tuples). Tuples are either: (vocab_id, aux_id) or (vocab_id, rule_id, case_id, space_id)
             If return_ranges is True, a tuple of the list of token ids, the list of word ranges, and a mapping of tokens to words.
         """
+        if local_cache is None:
+            local_cache = {}
+        if segment_cache is not None and handle_reserved and not is_split_and_escaped and split_compound_func is None:
+            result = self._tokenize_segments(text, allowed_reserved, merge_prop_ids, force_slow, local_cache, segment_cache)
+            if result is not None:
+                tokens, word_ranges, tokens_to_words = result
+                return (tokens, word_ranges, tokens_to_words) if return_ranges else tokens
+
         if is_split_and_escaped:
             assert return_ranges == False, "Ranges are not supported for split and escaped text."
             assert isinstance(text, str), "is_split_and_escaped requires a string input"
@@ -72,10 +90,13 @@ class Tokenizer():
                                                            return_ranges=True,
                                                            return_as_tuple=True,
                                                            split_compound_func=split_compound_func)
+        tokens, tokens_to_words = self._encode_words(words, is_tuple, handle_reserved, allowed_reserved, 
+                                                     merge_prop_ids, force_slow, local_cache)
+        return (tokens, word_ranges, tokens_to_words) if return_ranges else tokens
+
+    def _encode_words(self, words, is_tuple, handle_reserved, allowed_reserved, merge_prop_ids, force_slow, local_cache):
         tokens = []
         tokens_to_words = []
-        if local_cache is None:
-            local_cache = {}
         for i, word in enumerate(words):
             try:
                 if not is_tuple:
@@ -114,8 +135,205 @@ class Tokenizer():
                 warn(f"Error tokenizing word '{word}': {e}")
                 tokens.append((self.model.unk_token_id, 0))
                 tokens_to_words.append(i)
+        return tokens, tokens_to_words
+
+    def _tokenize_segments(self, text, allowed_reserved, merge_prop_ids, force_slow, local_cache, segment_cache):
+        """
+        Tokenizes text with reserved tokens handled, using the segment cache for the segments between reserved tokens.
+        Returns None if the text cannot be tokenized segment by segment.
+        """
+        if text is None or len(text) == 0:
+            return [], [], []
+        pre = self.pre
+        normalized, src_map = pre.normalize(text, return_offsets=True)
+        segments = list(pre.split_reserved(normalized, allowed_reserved))
+        if pre.preserve_soft_hyphen == 'append' and any(start > 0 and normalized.startswith("\u00AD", start) for start, _, _ in segments):
+            # a soft hyphen would be appended to the preceding reserved token
+            return None
+        allowed_key = frozenset(allowed_reserved) if allowed_reserved else None
+
+        tokens = []
+        spans = []
+        tokens_to_words = []
+        for start, end, is_reserved in segments:
+            if is_reserved:
+                seg_words = [pre.escape(normalized[start:end], handle_reserved=True, 
+                                        allowed_reserved=allowed_reserved, return_as_tuple=True)]
+                seg_tokens, seg_tokens_to_words = self._encode_words(seg_words, True, True, allowed_reserved,
+                                                                     merge_prop_ids, force_slow, local_cache)
+                seg_spans = [(0, end - start)]
+            else:
+                # the split regex may look behind the start of the segment (at the end of the preceding reserved token)
+                key = segment_cache.key(normalized[start:end], start > 0 and normalized[start-1] == " ",
+                                        allowed_key, merge_prop_ids, force_slow)
+                value = segment_cache.get(key)
+                if value is None:
+                    seg_words, seg_spans = pre.split_and_escape_segment(normalized, start, end, allowed_reserved)
+                    seg_spans = [(ns - start, ne - start) for ns, ne in seg_spans]
+                    seg_tokens, seg_tokens_to_words = self._encode_words(seg_words, True, True, allowed_reserved,
+                                                                         merge_prop_ids, force_slow, local_cache)
+                    segment_cache.put(key, (seg_tokens, seg_spans, seg_tokens_to_words), len(seg_tokens))
+                else:
+                    seg_tokens, seg_spans, seg_tokens_to_words = value
+            word_offset = len(spans)
+            tokens.extend(seg_tokens)
+            spans.extend((ns + start, ne + start) for ns, ne in seg_spans)
+            tokens_to_words.extend(i + word_offset for i in seg_tokens_to_words)
+
+        if src_map is None:
+            word_ranges = [(ns, ne - ns) for ns, ne in spans]
+        else:
+            word_ranges = [(src_map[ns], src_map[ne] - src_map[ns]) for ns, ne in spans]
+        return tokens, word_ranges, tokens_to_words
+
+    def tokenize_long(self,
+                      text: str,
+                      workers: int = 0,
+                      segment_length: int = DEFAULT_SEGMENT_LENGTH,
+                      pool: Optional[Pool] = None,
+                      handle_reserved: bool = False,
+                      allowed_reserved: Optional[list[str]] = None,
+                      merge_prop_ids: bool = True,
+                      return_ranges: bool = False,
+                      force_slow: bool = False,
+                      split_compound_func: Optional[Callable] = None):
+        """
+        Tokenizes a long text in parallel. The text is cut into segments at positions that are safe for
+        pre-tokenization (see PreTokenizer.find_segment_boundaries), the segments are tokenized by a pool of workers,
+        and the results are stitched together. The result is identical to the result of tokenize.
+
+        Args:
+            text: The text to tokenize.
+            workers: The number of workers (<1: use as many workers as cpus, 1: tokenize serially).
+            segment_length: The minimum length of each segment.
+            pool: A pool created by create_pool. If not set, a temporary pool is created.
+                  Reusing a pool avoids starting processes and transferring the tokenizer on each call.
+            handle_reserved: Whether to handle reserved tokens.
+            allowed_reserved: A list of reserved tokens to allow. If not set, all reserved tokens are allowed.
+            merge_prop_ids: See tokenize.
+            return_ranges: Whether to return the ranges of the words (offset, length).
+            force_slow: Whether to force slow decomposition.
+            split_compound_func: See tokenize. Must be picklable (e.g., a module-level function).
+
+        Returns:
+            See tokenize.
+        """
+        kwargs = dict(handle_reserved=handle_reserved,
+                      allowed_reserved=allowed_reserved,
+                      merge_prop_ids=merge_prop_ids,
+                      force_slow=force_slow,
+                      split_compound_func=split_compound_func)
+        cuts = self.pre.find_segment_boundaries(text, segment_length, handle_reserved, allowed_reserved)
+        if not cuts or (pool is None and workers == 1):
+            return self.tokenize(text, return_ranges=return_ranges, **kwargs)
+
+        offsets = [0] + cuts
+        segments = [text[start:end] for start, end in zip(offsets, cuts + [len(text)])]
+        tasks = [(segment, kwargs) for segment in segments]
+        if pool is not None:
+            results = pool.map(_tokenize_segment, tasks)
+        else:
+            if workers <= 0:
+                workers = os.cpu_count()
+            with self.create_pool(min(workers, len(segments))) as p:
+                results = p.map(_tokenize_segment, tasks)
+
+        tokens = []
+        word_ranges = []
+        tokens_to_words = []
+        for offset, (seg_tokens, seg_word_ranges, seg_tokens_to_words) in zip(offsets, results):
+            word_offset = len(word_ranges)
+            tokens.extend(seg_tokens)
+            word_ranges.extend((start + offset, length) for start, length in seg_word_ranges)
+            tokens_to_words.extend(i + word_offset for i in seg_tokens_to_words)
         return (tokens, word_ranges, tokens_to_words) if return_ranges else tokens
-    
+
+    def create_pool(self, workers: int = 0) -> Pool:
+        """
+        Creates a pool of workers for tokenize_long. The tokenizer is transferred to each worker once.
+
+        Args:
+            workers: The number of workers (<1: use as many workers as cpus).
+
+        Returns:
+            The pool (should be closed by the caller, e.g. by using it as a context manager).
+        """
+        if workers <= 0:
+            workers = os.cpu_count()
+        return Pool(workers, initializer=_init_worker, initargs=(self,))
+
+    def retokenize(self,
+                   text: str,
+                   previous: Tuple[list, list, list],
+                   edit: Tuple[int, int, str],
+                   handle_reserved: bool = False,
+                   allowed_reserved: Optional[list[str]] = None,
+                   merge_prop_ids: bool = True,
+                   force_slow: bool = False,
+                   local_cache: Optional[dict] = None,
+                   split_compound_func: Optional[Callable] = None):
+        """
+        Re-tokenizes an edited text incrementally. Only the text between the last safe cut position before the edit
+        and the first safe cut position after the edit (see PreTokenizer.find_safe_cut) is tokenized again,
+        the tokens of the remaining words are reused. The result is identical to the result of tokenize on the edited text.
+
+        Args:
+            text: The edited text.
+            previous: The result of tokenize (with return_ranges=True) or retokenize on the text before the edit,
+                      obtained with the same arguments.
+            edit: The edit as (offset, deleted_len, inserted_text), relative to the text before the edit.
+            handle_reserved: See tokenize.
+            allowed_reserved: See tokenize.
+            merge_prop_ids: See tokenize.
+            force_slow: See tokenize.
+            local_cache: See tokenize. Reusing a local cache across edits avoids encoding the same words again.
+            split_compound_func: See tokenize.
+
+        Returns:
+            A tuple of the list of token ids, the list of word ranges, and a mapping of tokens to words (see tokenize).
+        """
+        tokens, word_ranges, tokens_to_words = previous
+        offset, deleted_len, inserted_text = edit
+        assert 0 <= offset and deleted_len >= 0, "Invalid edit"
+        assert text[offset:offset + len(inserted_text)] == inserted_text, "Edit does not match text"
+        delta = len(inserted_text) - deleted_len
+
+        # cut positions must be safe in the text before and after the edit, thus the characters text[c-1] and text[c]
+        # must not be part of the edit
+        start = self.pre.find_safe_cut(text, 0, offset, last=True,
+                                       handle_reserved=handle_reserved, allowed_reserved=allowed_reserved)
+        if start is None:
+            start = 0
+        end = self.pre.find_safe_cut(text, offset + len(inserted_text) + 1,
+                                     handle_reserved=handle_reserved, allowed_reserved=allowed_reserved)
+        if end is None:
+            end = len(text)
+
+        # words before start and after end (in the text before the edit) are kept
+        word_start = bisect_left(word_ranges, (start,))
+        word_end = bisect_left(word_ranges, (end - delta,)) if end < len(text) else len(word_ranges)
+        token_start = bisect_left(tokens_to_words, word_start)
+        token_end = bisect_left(tokens_to_words, word_end)
+
+        mid_tokens, mid_word_ranges, mid_tokens_to_words = self.tokenize(text[start:end],
+                                                                         handle_reserved=handle_reserved,
+                                                                         allowed_reserved=allowed_reserved,
+                                                                         merge_prop_ids=merge_prop_ids,
+                                                                         return_ranges=True,
+                                                                         force_slow=force_slow,
+                                                                         local_cache=local_cache,
+                                                                         split_compound_func=split_compound_func)
+
+        word_shift = word_start + len(mid_word_ranges) - word_end
+        new_tokens = tokens[:token_start] + mid_tokens + tokens[token_end:]
+        new_word_ranges = word_ranges[:word_start]
+        new_word_ranges.extend((s + start, l) for s, l in mid_word_ranges)
+        new_word_ranges.extend((s + delta, l) for s, l in word_ranges[word_end:])
+        new_tokens_to_words = tokens_to_words[:token_start]
+        new_tokens_to_words.extend(i + word_start for i in mid_tokens_to_words)
+        new_tokens_to_words.extend(i + word_shift for i in tokens_to_words[token_end:])
+        return new_tokens, new_word_ranges, new_tokens_to_words
+
     def detokenize(self, 
                    ids: List[Union[Tuple[int, int], Tuple[int, int, int, int]]], 
                    omit_reserved: bool = True, 
@@ -243,4 +461,15 @@ class Tokenizer():
         """
         with open(path, 'r', encoding="utf8") as f:
             d = json.load(f)
-        return Tokenizer.load_dict(d, **kwargs)
\ No newline at end of file
+        return Tokenizer.load_dict(d, **kwargs)
+
+
+_worker_tokenizer = None
+
+def _init_worker(tokenizer: Tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _tokenize_segment(task):
+    text, kwargs = task
+    return _worker_tokenizer.tokenize(text, return_ranges=True, **kwargs)
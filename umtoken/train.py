@@ -22,6 +22,7 @@ def main(args):
     assert len(args.input_file) > 0, "No input files specified."
     assert len(args.languages) > 0, "No languages specified."
     assert args.normalization in ["default", "ipt", "nfc"], "Unsupported normalization."
+    assert not args.resume or args.cache_dir, "Resuming requires a cache directory."
     
     # expand_languages mutates in place but only returns a deduped/sorted copy;
     # capture the return value so we don't carry duplicates through the rest of the run
@@ -31,16 +32,21 @@ def main(args):
 
     # config
     config = TrainerConfig(
-        vocab_size=args.vocab_size,
+        vocab_size=args.vocab_size if len(args.vocab_size) > 1 else args.vocab_size[0],
         min_count=args.min_count,
         discount_exponent=args.discount_exponent,
         workers=args.workers,
         tie_by_langs=args.tie,
         iterations=args.iterations,
+        spread_factor=args.spread_factor,
         alphabet=alphabet,
         min_balance_langs=args.min_balance_langs,
         min_base_len=args.min_base_len,        
-        force_slow=args.allow_unconditional_ops # building the stem trie may take a long time when there are unconditional ops
+        force_slow=args.allow_unconditional_ops, # building the stem trie may take a long time when there are unconditional ops
+        checkpoint_dir=os.path.join(args.cache_dir, "checkpoints") if args.cache_dir else None,
+        max_candidate_entries=args.max_candidate_entries,
+        stream_dir=args.stream_dir,
+        pool_dir=args.pool_dir
     )
     trainer = Trainer(config)
     pre = PreTokenizer(alphabet=config.alphabet, 
@@ -140,15 +146,31 @@ def main(args):
         eval_words = [pre.encoding.escape(w, return_as_tuple=True)[0] for w in eval_words]
                 
     # train
-    model = trainer.train(rules=rules, words=words, words_by_lang=words_by_langs, eval_words=eval_words)
+    init_model = None
+    if args.warm_start:
+        init_model = Tokenizer.load(args.warm_start).model
+        print(f"Warm start from {args.warm_start} (vocab={len(init_model.vocab)})")
+    if args.stream_dir:
+        # prepare the words out-of-core, training maps them from disk
+        words, _ = trainer.prepare_words_on_disk(words, words_by_langs, os.path.join(args.stream_dir, "words"))
+        words_by_langs = None
+    models = trainer.train(rules=rules, words=words, words_by_lang=words_by_langs, eval_words=eval_words, resume=args.resume,
+                           init_model=init_model)
+    if len(args.vocab_size) == 1:
+        models = {config.vocab_size: models}
 
-    # build and save the tokenizer
-    thumbprint = model.thumbprint()
-    tokenizer = Tokenizer(pre, model, thumbprint=thumbprint)
+    # build and save the tokenizers (one per vocab size, e.g. out.json -> out-24576.json)
     out_dir = os.path.dirname(args.output_file)
     if out_dir:
         os.makedirs(out_dir, exist_ok=True)
-    tokenizer.save(args.output_file)
+    for vocab_size, model in models.items():
+        thumbprint = model.thumbprint()
+        tokenizer = Tokenizer(pre, model, thumbprint=thumbprint)
+        output_file = args.output_file
+        if len(models) > 1:
+            root, ext = os.path.splitext(args.output_file)
+            output_file = f"{root}-{vocab_size}{ext}"
+        tokenizer.save(output_file)
 
 if __name__ == '__main__':
 
@@ -172,9 +194,10 @@ if __name__ == '__main__':
                         help="cache directory to store intermediate results")
     
     parser.add_argument("-v", "--vocab-size",
-                        default=24*1024,
+                        nargs="+",
+                        default=[24*1024],
                         type=int,
-                        help="size of vocabulary to train (default: 24*1024)")
+                        help="size(s) of vocabulary to train, several sizes are trained in one run and saved to <output>-<size>.json (default: 24*1024)")
     
     parser.add_argument("-in", "--input-normalized", 
                         action="store_true",
@@ -256,5 +279,32 @@ if __name__ == '__main__':
                         type=int,
                         help="number of iterations (default: 10)")   
 
+    parser.add_argument("-sf", "--spread-factor",
+                        default=16,
+                        type=float,
+                        help="number of initial candidates relative to the vocabulary size (default: 16)")
+
+    parser.add_argument("-mce", "--max-candidate-entries",
+                        type=int,
+                        help="maximum number of distinct substrings held in memory during candidate generation, "
+                             "more passes are made if exceeded (default: None = unbounded)")
+
+    parser.add_argument("-sd", "--stream-dir",
+                        help="directory for out-of-core training: the prepared words and the lattices are kept on disk, "
+                             "so that word lists larger than the memory can be trained (default: None = in memory)")
+
+    parser.add_argument("-pd", "--pool-dir",
+                        help="shared directory for training on several machines: the shards of the words are served by "
+                             "workers started with 'python -m umtoken.serve DIR' on any machine, "
+                             "--workers is the number of shards (default: None = local workers)")
+
+    parser.add_argument("-r", "--resume",
+                        action="store_true",
+                        help="resume from the latest compatible checkpoint in the cache directory (default: False)")
+
+    parser.add_argument("-ws", "--warm-start",
+                        help="trained tokenizer (json) to start from: its vocab is added to the candidates and its logits "
+                             "initialize training, use with few iterations and a small spread factor (default: None)")
+
     args = parser.parse_args()
     main(args)
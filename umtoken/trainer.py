@@ -1,10 +1,13 @@
 # Path: umtoken/trainer.py
 
 import os
+import hashlib
+import json
+import pickle
 import regex as re
-from collections import Counter
-from typing import Dict, List, Optional, Tuple, Union
-from multiprocessing import Pool
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from tqdm import tqdm
@@ -13,9 +16,13 @@ from .alphabet import (EU3_ALPHABET, ASCII_RESERVED_EOW, ASCII_ENCODING_SHY,
                        ASCII_ENCODING_NEWLINE, ASCII_ENCODING_SPACE, ASCII_ENCODING_TAB, 
                        ASCII_RESERVED_UTF8, ASCII_ENCODING)
 from .pre import DEFAULT_RESERVED_TOKENS, UNK_TOKEN
-from .model import Model, MIN_LOGIT
+from .candidates import partition_of, top_substrings
+from .lattice import PackedLattices
+from .model import Model, MIN_LOGIT, score_edges
+from .pool import FilePool, WorkerPool
 from .rules import MorphRule
-from .utils import chunk_list
+from .utils import balanced_ranges
+from .words import LangColumn, WordTable, WordTableWriter
 
 DEFAULT_NUMBER_SEED = [f"{d:01}" for d in range(0, 10)] + [f"{d:02}" for d in range(0, 100)] # add 0-9, 00-99
 DEFAULT_WS_SEED = sum(([ASCII_ENCODING_SPACE * (2**i), 
@@ -43,12 +50,15 @@ DEFAULT_UTF8_SEED = (
     [ASCII_RESERVED_UTF8 + f"{i+128:02X}" for i in range(2**6)]   # multi-byte continuation: 10xxxxxx = 128
 )
 
+DEFAULT_BATCH_SIZE = 64 * 1024 # words per vectorized forward-backward pass
+PARTITION_BUFFER_SIZE = 4 * 1024 # entries per partition that are buffered before writing (see Trainer.prepare_words_on_disk)
+
 DEFAULT_ALPHA = 1.0
 DEFAULT_BETA = 0.02
 
 class TrainerConfig():
     def __init__(self,
-                 vocab_size: int = 24 * 1024,
+                 vocab_size: Union[int, List[int]] = 24 * 1024,
                  alphabet: str = EU3_ALPHABET,
                  escape_chars: str = ASCII_ENCODING,
                  reserved_tokens: Optional[List[str]] = None,
@@ -69,12 +79,25 @@ class TrainerConfig():
                  number_handling: str = "greedy-head",
                  min_balance_langs: Optional[float] = None,
                  workers: int = 0,
-                 force_slow: bool = False
+                 force_slow: bool = False,
+                 checkpoint_dir: Optional[str] = None,
+                 max_candidate_entries: Optional[int] = None,
+                 subsample_schedule: Optional[List[float]] = None,
+                 subsample_seed: int = 0,
+                 hard_em_iterations: int = 0,
+                 em_steps: Optional[int] = None,
+                 em_tolerance: Optional[float] = None,
+                 squarem: bool = False,
+                 approx_prune_losses: bool = False,
+                 stream_dir: Optional[str] = None,
+                 stream_chunk_size: int = 4 * DEFAULT_BATCH_SIZE,
+                 pool_dir: Optional[str] = None
                  ):
         """unimorph trainer configuration.
         
         Args:
-            vocab_size: The size of the vocabulary.
+            vocab_size: The size of the vocabulary, or a list of sizes to train in a single run: pruning stops at each size
+                        (in descending order) for the final EM steps, and a snapshot of the model is kept (see Trainer.train).
             alphabet: The alphabet to use.
             escape_chars: The escape characters.
             reserved_tokens: The reserved tokens.
@@ -99,12 +122,51 @@ class TrainerConfig():
                                the word counts will be upsampled to meet this condition. 
             workers: The number of workers to use for parallelization (<1: use as many works as cpus).
             force_slow: Force slow mode to prevent building a stem trie (=pretransformed bases).
-                        Note that each worker needs to build its own trie. If the number of workers is high,
-                        it may be preferrable to use force_slow=True to prevent building the stem trie.
+                        Otherwise, the stem trie is built once and shared with the workers (see Morpher.share).
+            checkpoint_dir: The directory to save a checkpoint to after each iteration (default: None = no checkpoints).
+                            Training can be resumed from the checkpoint (see Trainer.train).
+            max_candidate_entries: The maximum number of distinct substrings counted at once during the candidate generation
+                                   (default: None = unbounded). If exceeded, the substrings are counted in several passes
+                                   (see candidates.top_substrings), the resulting candidates are the same.
+            subsample_schedule: The fraction of words used for the EM steps of the first iterations, one entry per
+                                iteration (default: None = all words). The words are subsampled by frequency (see
+                                subsample_words), tokens that don't occur in the sample keep their logits.
+                                Pruning and the final iteration use all words.
+            subsample_seed: The seed for subsampling the words.
+            hard_em_iterations: The number of (first) iterations that use hard EM (default: 0): the E-step counts the best
+                                decompositions (Viterbi) instead of computing marginals, and pruning removes the tokens
+                                which are least used by the best decompositions. Use iterations for hard EM only.
+            em_steps: The maximum number of EM steps per iteration (default: None = 2, 3 in the final iteration).
+            em_tolerance: Stop the EM steps of an iteration early when the NLL decreases by less than this value
+                          (default: None = no early stopping).
+            squarem: Whether to accelerate EM by extrapolating the logits after every two EM steps (SQUAREM).
+                     Extrapolations are validated by the next E-step and rejected if their NLL is higher than the NLL
+                     of the EM step they replace (no extrapolation after the last EM step of an iteration).
+                     Only useful with em_steps > 2.
+            approx_prune_losses: Whether to compute the pruning losses in the E-steps from their forward and backward logits,
+                                 instead of in an extra pass over all words after the last M-step. The losses are
+                                 approximate, since they are based on the logits before the last M-step. If the EM steps
+                                 stop early (see em_tolerance), the losses of soft EM are computed in the extra pass.
+                                 Iterations on a sample of the words (see subsample_schedule) use the extra pass.
+            stream_dir: The directory for the files of the out-of-core mode (default: None = in memory): the prepared words
+                        are mapped from disk by the workers (see WordTable.load), and the lattices are kept on disk
+                        in chunks of stream_chunk_size words, so that the E-steps, the pruning losses and tying only
+                        hold one chunk per worker in memory. The words can be prepared out-of-core as well
+                        (see Trainer.prepare_words_on_disk).
+            stream_chunk_size: The number of words per chunk of lattices in the out-of-core mode.
+            pool_dir: A shared directory for training on several machines (default: None = local workers): the shards
+                      of the words are served by worker processes started on any machine (see pool.serve), which
+                      exchange the tasks and results with the trainer through the directory (see pool.FilePool).
+                      workers is the number of shards then. With stream_dir, it must be shared as well.
+                      Workers that stop sending heartbeats are replaced by spare workers. The directory must only be
+                      writable by trusted users, since the workers unpickle the tasks that send the words and the model
+                      (the logits and the results are exchanged as .npz files without pickling).
         """
         assert iterations > 1
 
-        self.vocab_size = vocab_size
+        # vocab_size is the smallest size, vocab_sizes are all sizes in descending order (None: a single size)
+        self.vocab_sizes = sorted(set(vocab_size), reverse=True) if isinstance(vocab_size, (list, tuple)) else None
+        self.vocab_size = self.vocab_sizes[-1] if self.vocab_sizes else vocab_size
         self.alphabet = alphabet
         self.reserved_tokens = list(reserved_tokens) if reserved_tokens is not None else list(DEFAULT_RESERVED_TOKENS)
         self.escape_chars = escape_chars
@@ -128,6 +190,22 @@ class TrainerConfig():
         self.min_balance_langs = min_balance_langs
         self.workers = workers if workers > 0 else os.cpu_count()
         self.force_slow = force_slow
+        self.checkpoint_dir = checkpoint_dir
+        self.max_candidate_entries = max_candidate_entries
+        self.subsample_schedule = list(subsample_schedule) if subsample_schedule is not None else None
+        self.subsample_seed = subsample_seed
+        self.hard_em_iterations = hard_em_iterations
+        self.em_steps = em_steps
+        self.em_tolerance = em_tolerance
+        self.squarem = squarem
+        self.approx_prune_losses = approx_prune_losses
+        self.stream_dir = stream_dir
+        self.stream_chunk_size = stream_chunk_size
+        self.pool_dir = pool_dir
+
+# config fields that do not affect the training result (ignored by the checkpoint fingerprint)
+NON_FINGERPRINT_CONFIG = frozenset(["workers", "checkpoint_dir", "max_candidate_entries", "stream_dir", "stream_chunk_size",
+                                    "pool_dir"])
 
 class Trainer():
     def __init__(self, config: TrainerConfig):
@@ -146,199 +224,552 @@ class Trainer():
 
     def train(self, 
               rules: List[MorphRule],
-              words: Optional[Dict[str, Union[int, float]]],
+              words: Optional[Union[Dict[str, Union[int, float]], WordTable]],
               words_by_lang: Optional[Dict[str, Dict[str, Union[int, float]]]],
-              eval_words: Optional[List[str]] = None):
+              eval_words: Optional[List[str]] = None,
+              resume: bool = False,
+              init_model: Optional[Model] = None) -> Union[Model, Dict[int, Model]]:
         """
         Train the unimorph model.
+
+        If config.vocab_size is a list, the models of all sizes are trained in one run: the vocab is pruned to the
+        largest size first, the final EM steps are run and a snapshot is kept, then pruning continues towards the
+        next size. The early (most expensive) iterations are shared by all sizes.
+
+        If config.checkpoint_dir is set, a checkpoint is saved after each iteration. It is only compatible with
+        training runs with the same config, rules and words (see fingerprint).
         
         Args:
             rules: The morphological rules.
-            words: The words.
-            words_by_lang: The words by language.
+            words: The words, or the prepared words (see prepare_words and prepare_words_on_disk).
+            words_by_lang: The words by language (ignored if words are prepared).
             eval_words: The evaluation words.
+            resume: Whether to continue from a compatible checkpoint in config.checkpoint_dir (if there is one).
+            init_model: A trained model to start from (warm start, e.g., for a refreshed corpus or a new domain): its vocab
+                        is added to the candidates, and its logits initialize the EM steps (see init_logits).
+                        A few iterations and a small spread_factor are usually sufficient.
+
+        Returns:
+            The model, or the models by vocab size if config.vocab_size is a list.
         """
         assert words is not None or words_by_lang is not None, "Either words or words_by_lang must be provided"
         
+        if not isinstance(words, WordTable):
+            words, _ = self.prepare_words(words, words_by_lang)
         langs = list(sorted(set([l for r in rules for l in r.langs or [] if not r.any_lang]) | 
-                            set((words_by_lang or {}).keys())))
-        words, lang_by_words = self.prepare_words(words, words_by_lang)
-        
-        print("Building initial candidates")
-        candidates = self.generate_candidates(words)
-        candidates.update(self.protected_tokens)
-        if len(candidates) > self.config.vocab_size:
-            prune_rate = 1 - (len(candidates) / self.config.vocab_size) ** (-1.0 / (self.config.iterations - 1))
-        else:
-            # already at or below target — nothing to prune geometrically
-            prune_rate = 0.0
-        
+                            set(words.langs[1:])))
+
+        checkpoint_file = None
+        checkpoint = None
+        if self.config.checkpoint_dir:
+            fingerprint = self.fingerprint(rules, words, init_model)
+            checkpoint_file = os.path.join(self.config.checkpoint_dir, f"checkpoint--{fingerprint}.json")
+            if resume and os.path.exists(checkpoint_file):
+                checkpoint = load_checkpoint(checkpoint_file)
+                print(f"Resuming after iteration {checkpoint['iteration']} ({len(checkpoint['candidates'])} candidates)")
+
+        # the sizes that are still to be reached, and the snapshots (vocab, vocab logits, rules logits) by size
+        pending = list(self.config.vocab_sizes or [self.config.vocab_size])
+        snapshots = {}
+        # each additional size may take an additional iteration at the end (see pruning below)
+        end = self.config.iterations + len(pending) - 1
+        start = 0
         final = False
-        for it in range(self.config.iterations):
-            print(f'it={it}')
-            
-            model = Model(candidates, rules,
-                          [0.0] * len(candidates), 
-                          [0.0] * len(rules),
-                          self.config.alpha, self.config.beta,
-                          langs=langs,
-                          min_base_len=self.config.min_base_len,
-                          number_handling=self.config.number_handling)
-            model.reset_logits()
-            
-            # EM
-            for subit in range(3 if final else 2):
-                nll, m_vocab, m_rules = self.step_E(model, words, lang_by_words)
-                self.step_M(model, m_vocab, m_rules)
-                print(f'  NLL({subit})={nll}')           
-                 
-            # eval
-            self.eval_model(model, eval_words)
-            
-            # prune
-            if final:
-                # update progress bar properly
-                if it == self.config.iterations - 1:
-                    continue
+        model = None
+        if checkpoint is not None:
+            candidates = checkpoint["candidates"]
+            prune_rate = checkpoint["prune_rate"]
+            final = checkpoint["final"]
+            start = checkpoint["iteration"] + 1
+            snapshots = checkpoint["snapshots"]
+            pending = [size for size in pending if size not in snapshots]
+            if checkpoint["done"]:
+                # all iterations are done, only finalizing is left
+                start = end
+                model = self.create_model(rules, langs, checkpoint["vocab"], checkpoint["vocab_logits"], checkpoint["rules_logits"])
+
+        # the words are sent to the workers once, and stay there with their lattices for the whole run
+        # (shards are balanced by estimated cost, since the lattice size grows superlinearly with the word length,
+        # and rebalanced by the actual lattice sizes once the lattices are built)
+        with self.create_pool() as pool, stream_directory(self.config.stream_dir) as stream_dir:
+            if stream_dir is not None and words.path is None:
+                # the workers map their shards from disk instead of receiving them
+                words.save(os.path.join(stream_dir, "words"))
+                words = WordTable.load(os.path.join(stream_dir, "words"))
+            shards = balanced_ranges(words.costs(), pool.workers)
+            pool.run(_init_shard, [(words[s:e], stream_dir) for s, e in shards])
+
+            if checkpoint is None:
+                print("Building initial candidates")
+                candidates = self.generate_candidates(words, pool)
+                candidates.update(self.protected_tokens)
+                if init_model is not None:
+                    candidates.update(init_model.vocab)
+                # keep a stable order, so that the vocab ids of the packed lattices can be remapped after pruning
+                candidates = sorted(candidates)
+                if len(candidates) > self.config.vocab_size:
+                    prune_rate = 1 - (len(candidates) / self.config.vocab_size) ** (-1.0 / (self.config.iterations - 1))
                 else:
-                    break
-            prune_count = min(int(len(model.vocab) * prune_rate), len(model.vocab) - self.config.vocab_size)
-            if it == self.config.iterations - 2 or prune_count <= 0:
-                prune_count = max(0, len(model.vocab) - self.config.vocab_size)
-                final = True
+                    # already at or below target — nothing to prune geometrically
+                    prune_rate = 0.0
             
-            if prune_count > 0:
-                remove = self.prune(model, words, lang_by_words, prune_count)
-                candidates = candidates - remove
-                print(f'  pruned {len(remove)} tokens ({len(candidates)} left)')
-        self.finalize_model(model)
-        
-        if self.config.tie_by_langs:
-            self.tie_model(model, words, lang_by_words)
-            self.eval_model(model, eval_words)
-            untied = sum(1 for l in model.vocab_langs[len(self.protected_tokens):] if l == 0)
-            print(f"Untied vocab: {untied}")
+            # sizes that cannot be reached by pruning are skipped (the smallest size is always trained)
+            for size in pending[:-1]:
+                if size > len(candidates):
+                    print(f"Skipping vocab size {size} ({len(candidates)} candidates)")
+            pending = [size for size in pending[:-1] if size <= len(candidates)] + pending[-1:]
+
+            counts = words.counts.astype(np.float64)
+            vocab_map = None # of the last pruning
+            for it in range(start, end):
+                print(f'it={it}')
+                
+                if model is None:
+                    model = self.create_model(rules, langs, candidates, [0.0] * len(candidates), [0.0] * len(rules))
+                elif vocab_map is not None:
+                    # remove the pruned tokens in place (the tries of the morpher are kept)
+                    model.remap_vocab(vocab_map)
+                    vocab_map = None
+                assert model.vocab == candidates
+                self.init_logits(model, init_model)
+
+                if it == start:
+                    # decompose all words once, later iterations only re-score and remap the edges
+                    self.build_lattices(pool, model)
+                    shards = self.rebalance_shards(pool, words, shards)
+                
+                # EM (on a sample of the words in early iterations, with Viterbi counts in hard EM iterations)
+                sampled = self.sample_words(pool, shards, counts, it, final)
+                hard = it < self.config.hard_em_iterations
+                # the pruning losses of the last E-step on all words (if approximated, see approx_prune_losses)
+                with_losses = self.config.approx_prune_losses and not sampled and (not final or len(pending) > 1)
+                losses = None
+                prev_nll = None
+                points = [] # logits before the last EM steps (for SQUAREM)
+                fallback = None
+                soft_nll = [] # of the last hard E-step (comparable to soft EM)
+                n_steps = self.config.em_steps or (3 if final else 2)
+                try:
+                    for subit in range(n_steps):
+                        logits = (model.vocab_logits, model.rules_logits)
+                        with_soft_nll = hard and subit == n_steps - 1
+                        # only the last E-step computes the losses of soft EM (after an early stop, prune computes them),
+                        # the losses of hard EM are its counts
+                        step_losses = with_losses and (hard or subit == n_steps - 1)
+                        nll, m_vocab, m_rules, losses, *soft_nll = self.step_E(pool, model, hard, step_losses, with_soft_nll)
+                        if fallback is not None:
+                            # the extrapolation must improve on the EM step it replaces (whose NLL is at most prev_nll)
+                            extrapolated = logits
+                            model.set_logits(*fallback)
+                            if nll > prev_nll or nll > nll_pool(pool, model, hard, sampled=True):
+                                # the extrapolation overshot, continue with the logits of the last EM step
+                                print(f'  NLL({subit})={nll} (rejected extrapolation)')
+                                logits = fallback
+                                nll, m_vocab, m_rules, losses, *soft_nll = self.step_E(pool, model, hard, step_losses, with_soft_nll)
+                            else:
+                                model.set_logits(*extrapolated)
+                        fallback = None
+                        if sampled:
+                            # tokens that don't occur in the sample keep their logits (instead of being starved)
+                            unseen = np.asarray(m_vocab) <= 0
+                            vocab_logits = model.vocab_logits
+                            self.step_M(model, m_vocab, m_rules)
+                            model.set_logits(restore_logits(model.vocab_logits, vocab_logits, unseen), model.rules_logits)
+                        else:
+                            self.step_M(model, m_vocab, m_rules)
+                        print(f'  NLL({subit})={nll}' + (' (sample)' if sampled else '') + (' (viterbi)' if hard else ''))
+                        if self.config.em_tolerance is not None and prev_nll is not None and prev_nll - nll < self.config.em_tolerance:
+                            print('  converged')
+                            break
+                        prev_nll = nll
+                        if self.config.squarem:
+                            points.append(logits)
+                            # only extrapolate if the next E-step can reject the extrapolation
+                            if len(points) == 2 and subit < n_steps - 1:
+                                fallback = (model.vocab_logits, model.rules_logits)
+                                model.set_logits(*extrapolate_logits(*points, fallback))
+                                points = []
+                finally:
+                    if sampled:
+                        # pruning and the next iterations use all words
+                        pool.broadcast(_sample_shard, None, None)
+                if hard:
+                    # report the NLL of all decompositions, comparable to soft EM
+                    # (after an early stop, the last E-step has not computed it)
+                    print(f'  NLL={soft_nll[0] if soft_nll else nll_pool(pool, model)}' + (' (sample)' if sampled and soft_nll else ''))
+                     
+                # eval
+                self.eval_model(model, eval_words)
+                
+                # prune
+                if final:
+                    if len(pending) == 1:
+                        self.save_checkpoint(checkpoint_file, it, model, candidates, prune_rate, final, done=True,
+                                             snapshots=snapshots)
+                        break
+                    # a larger vocab size is reached, keep a snapshot and continue pruning towards the next size
+                    print(f'  snapshot of vocab size {len(model.vocab)}')
+                    snapshots[pending.pop(0)] = (list(model.vocab), model.vocab_logits.copy(), model.rules_logits.copy())
+                    final = False
+                target = pending[0]
+                prune_count = min(int(len(model.vocab) * prune_rate), len(model.vocab) - target)
+                if it >= self.config.iterations - 2 or prune_count <= 0:
+                    prune_count = max(0, len(model.vocab) - target)
+                final = len(model.vocab) - prune_count <= target
+                
+                if prune_count > 0:
+                    remove = self.prune(pool, model, prune_count, hard, losses)
+                    keep = np.array([v not in remove for v in model.vocab], dtype=bool)
+                    vocab_map = np.where(keep, np.cumsum(keep) - 1, -1)
+                    pool.broadcast(_remap_shard, vocab_map)
+                    candidates = [v for v in candidates if v not in remove]
+                    print(f'  pruned {len(remove)} tokens ({len(candidates)} left)')
+                self.save_checkpoint(checkpoint_file, it, model, candidates, prune_rate, final, done=False,
+                                     snapshots=snapshots)
+
+            models = {size: self.create_model(rules, langs, *snapshot) for size, snapshot in snapshots.items()}
+            models[self.config.vocab_size] = model
+            for size, model in sorted(models.items(), reverse=True):
+                if len(models) > 1:
+                    print(f'finalizing vocab size {size}')
+                self.finalize_model(model)
+
+                if self.config.tie_by_langs:
+                    self.tie_model(pool, model)
+                    self.eval_model(model, eval_words)
+                    untied = sum(1 for l in model.vocab_langs[len(self.protected_tokens):] if l == 0)
+                    print(f"Untied vocab: {untied}")
         
         print('done')
-        return model
+        return models if self.config.vocab_sizes else models[self.config.vocab_size]
         
-    def prepare_words(self, words, words_by_lang):
+    def fingerprint(self, rules: List[MorphRule], words: WordTable, init_model: Optional[Model] = None) -> str:
+        """
+        Returns a fingerprint of everything that determines the course of training: the config (except for
+        NON_FINGERPRINT_CONFIG), the rules, the prepared words and the initial model. Training is deterministic,
+        so runs with the same fingerprint can continue each other's checkpoints.
+        """
+        config = {k: v for k, v in vars(self.config).items() if k not in NON_FINGERPRINT_CONFIG}
+        md5 = hashlib.md5(repr(sorted(config.items())).encode("utf-8"))
+        md5.update(json.dumps([r.save_dict() for r in rules]).encode("utf-8"))
+        md5.update(json.dumps(words.langs).encode("utf-8"))
+        for column in [words.buffer, words.offsets, words.counts, words.lang_ids]:
+            md5.update(np.ascontiguousarray(column).tobytes())
+        if init_model is not None:
+            md5.update(json.dumps([init_model.vocab, init_model.vocab_logits.tolist(), init_model.rules_logits.tolist()],
+                                  ensure_ascii=False).encode("utf-8"))
+        return md5.hexdigest()
+
+    def create_pool(self) -> Union[WorkerPool, FilePool]:
+        """Creates the pool of workers which hold the shards of the words (see TrainerConfig.pool_dir)."""
+        if self.config.pool_dir:
+            print(f"Training with {self.config.workers} shards served by workers in {self.config.pool_dir} (see umtoken.serve)")
+            return FilePool(self.config.pool_dir, self.config.workers)
+        return WorkerPool(self.config.workers)
+
+    def create_model(self, rules: List[MorphRule], langs: List[str], vocab: List[str], vocab_logits, rules_logits) -> Model:
+        """Creates a model from a vocab and its logits (e.g., of a snapshot or a checkpoint)."""
+        return Model(vocab, rules, vocab_logits, rules_logits,
+                     self.config.alpha, self.config.beta,
+                     langs=langs,
+                     min_base_len=self.config.min_base_len,
+                     number_handling=self.config.number_handling)
+
+    def init_logits(self, model: Model, init_model: Optional[Model] = None):
+        """
+        Initializes the logits of a model for the EM steps: uniform, or based on the logits of a trained model (warm start).
+
+        Tokens and rules unknown to init_model, as well as reserved and seed tokens (whose logits are overridden by
+        finalize_model), start with the median logit of init_model. The logits are renormalized over the vocab and rules of the model.
+
+        Args:
+            model: The model.
+            init_model: The trained model (None: uniform logits).
+        """
+        if init_model is None:
+            model.reset_logits()
+            return
+        overridden = set(self.config.reserved_tokens) | set(self.config.seed_tokens)
+        vocab_logits = {v: l for v, l in zip(init_model.vocab, init_model.vocab_logits) if v not in overridden}
+        rules_logits = {rule_key(r): l for r, l in zip(init_model.rules, init_model.rules_logits)}
+        model.set_logits(warm_start_logits([vocab_logits.get(v) for v in model.vocab]),
+                         warm_start_logits([rules_logits.get(rule_key(r)) for r in model.rules]))
+
+    def save_checkpoint(self, checkpoint_file: Optional[str], it: int, model: Model, candidates: List[str],
+                        prune_rate: float, final: bool, done: bool, snapshots: Optional[dict] = None):
+        """
+        Saves the state after an iteration (no-op if checkpoint_file is None).
+
+        Args:
+            checkpoint_file: The checkpoint file.
+            it: The index of the finished iteration.
+            model: The model of the iteration (before pruning).
+            candidates: The candidates for the next iteration.
+            prune_rate: The prune rate.
+            final: Whether the next iteration is the final one.
+            done: Whether all iterations are done (the model is ready to be finalized).
+            snapshots: The snapshots (vocab, vocab logits, rules logits) of the larger vocab sizes reached so far.
+        """
+        if checkpoint_file is None:
+            return
+        checkpoint = {
+            "iteration": it,
+            "done": done,
+            "final": final,
+            "prune_rate": prune_rate,
+            "candidates": list(candidates),
+            "vocab": list(model.vocab),
+            "vocab_logits": model.vocab_logits.tolist(),
+            "rules_logits": model.rules_logits.tolist(),
+            "snapshots": [[size, vocab, vocab_logits.tolist(), rules_logits.tolist()]
+                          for size, (vocab, vocab_logits, rules_logits) in (snapshots or {}).items()]
+        }
+        os.makedirs(os.path.dirname(checkpoint_file) or ".", exist_ok=True)
+        # write to a temporary file first, so that an interruption never leaves a broken checkpoint
+        with open(checkpoint_file + ".tmp", "w", encoding="utf8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+    def prepare_words(self, words, words_by_lang) -> Tuple[WordTable, LangColumn]:
         """
         Prepare the words:
         - balance word counts among languages, if necessary.
         - remove protected tokens (reserved + seed + alphabet).
         - strip soft-hyphens (encoded as 'H' and indicated word continuation, e.g. modifier in compound words).
         - otherwise, append end-of-word marker 'X'.
+
+        The counts of all languages are merged in arrays: each distinct word is looked up once per language
+        it occurs in, instead of looking up every word in every language.
         
         Args:
             words: The words.
             words_by_lang: The words by language.
             
         Returns:
-            A tuple of the prepared words and their languages.
+            A tuple of the prepared words (see WordTable) and their languages (a view of the table).
+        """
+        words_by_lang = words_by_lang or {}
+        langs = [None] + list(words_by_lang.keys())
+        lang_counts = [sum(lang_words.values()) for lang_words in words_by_lang.values()]
+        factors = [1.0] + self.balance_factors(list(words_by_lang.keys()), lang_counts)
+        words = WordTable.from_words(*self.merge_words([words or {}] + list(words_by_lang.values()), factors), langs)
+        return words, words.lang_by_words
+
+    def prepare_words_on_disk(self, words, words_by_lang, path: str, partitions: int = 64) -> Tuple[WordTable, LangColumn]:
+        """
+        Prepares the words out-of-core (see prepare_words), for word counts that don't fit into memory: the entries are
+        distributed into partition files by the hash of the word, then the counts of each partition are merged and
+        appended to the table. Only one partition of the distinct words is held in memory at a time.
+        The words are in the order of the partitions (instead of the order of the input).
+
+        Args:
+            words: The words (a dict or an iterable of (word, count) pairs, e.g., read from a file).
+            words_by_lang: The words by language (dicts or iterables of (word, count) pairs).
+            path: The directory of the table (see WordTable.load), also used for the temporary partition files.
+            partitions: The number of partitions.
+
+        Returns:
+            A tuple of the prepared words (mapped from the directory) and their languages (a view of the table).
+        """
+        words_by_lang = words_by_lang or {}
+        langs = [None] + list(words_by_lang.keys())
+        sources = [words or {}] + list(words_by_lang.values())
+        source_counts = [0.0] * len(sources)
+        os.makedirs(path, exist_ok=True)
+        with TemporaryDirectory(dir=path) as directory:
+            files = [open(os.path.join(directory, f"partition-{p}.pkl"), "wb") for p in range(partitions)]
+            buffers = [[] for _ in range(partitions)]
+            for i, source in enumerate(sources):
+                for word, count in (source.items() if isinstance(source, dict) else source):
+                    p = partition_of(word, partitions)
+                    buffers[p].append((i, word, count))
+                    source_counts[i] += count
+                    if len(buffers[p]) >= PARTITION_BUFFER_SIZE:
+                        pickle.dump(buffers[p], files[p], protocol=pickle.HIGHEST_PROTOCOL)
+                        buffers[p] = []
+            for f, buffer in zip(files, buffers):
+                if buffer:
+                    pickle.dump(buffer, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.close()
+
+            factors = [1.0] + self.balance_factors(list(words_by_lang.keys()), source_counts[1:])
+            with WordTableWriter(path, langs) as writer:
+                for file in files:
+                    partition = [{} for _ in sources]
+                    with open(file.name, "rb") as f:
+                        while True:
+                            try:
+                                entries = pickle.load(f)
+                            except EOFError:
+                                break
+                            for i, word, count in entries:
+                                partition[i][word] = partition[i].get(word, 0) + count
+                    writer.append(*self.merge_words(partition, factors))
+        words = WordTable.load(path)
+        return words, words.lang_by_words
+
+    def balance_factors(self, langs: List[str], lang_counts: List[float]) -> List[float]:
+        """Returns the factors for the word counts of the languages (see TrainerConfig.min_balance_langs)."""
+        factors = [1.0] * len(langs)
+        if not langs or not self.config.min_balance_langs:
+            return factors
+        dominant_count = max(lang_counts)
+        for i, (lang, lang_count) in enumerate(zip(langs, lang_counts)):
+            if lang_count <= 0:
+                # nothing to upsample (and would divide by zero)
+                factors[i] = 0.0
+            elif lang_count < self.config.min_balance_langs * dominant_count:
+                factors[i] = self.config.min_balance_langs * dominant_count / lang_count
+                print(f"Upsampling {lang} by factor {factors[i]}")
+        return factors
+
+    def merge_words(self, sources: List[Dict[str, Union[int, float]]], factors: List[float]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """
+        Merges the word counts of the sources (the words, then the words of each language), see prepare_words.
+
+        Args:
+            sources: The word counts of the sources.
+            factors: The factor for the counts of each source (see balance_factors).
+
+        Returns:
+            The prepared words, their counts and the indices of their languages (0: all languages, i: the language of source i).
         """
         eow = ASCII_RESERVED_EOW
         shy = ASCII_ENCODING_SHY
         
+        # the (word, count) entries of all sources, with the ids of their distinct words
+        ids = {}
+        entry_ids = [np.fromiter((ids.setdefault(w, len(ids)) for w in source), dtype=np.int64, count=len(source))
+                     for source in sources]
+        entry_counts = [np.fromiter(source.values(), dtype=np.float64, count=len(source)) for source in sources]
+
         # balance word counts between languages
-        words = Counter(words or dict())
-        if words_by_lang:
-            if self.config.min_balance_langs:
-                count_by_langs = Counter({lang: sum(words_by_lang[lang].values()) for lang in words_by_lang})
-                _, dominant_count = count_by_langs.most_common(1)[0]
-                for lang, lang_words in words_by_lang.items():
-                    lang_count = count_by_langs[lang]
-                    if lang_count <= 0:
-                        # nothing to upsample (and would divide by zero)
-                        continue
-                    lang_factor = 1.0
-                    if lang_count < self.config.min_balance_langs * dominant_count:
-                        lang_factor = self.config.min_balance_langs * dominant_count / lang_count
-                    if lang_factor != 1.0:
-                        print(f"Upsampling {lang} by factor {lang_factor}")
-                    for word in lang_words:
-                        if word in self.protected_tokens:
-                            continue
-                        words[word] += lang_words[word] * lang_factor # float is ok here
-            else:
-                for lang, lang_words in words_by_lang.items():
-                    words += Counter(lang_words)
+        counts = np.zeros(len(ids))
+        for _ids, _counts, factor in zip(entry_ids, entry_counts, factors):
+            counts += np.bincount(_ids, weights=_counts * factor, minlength=len(ids)) # float is ok here
         
+        # get primary language for each word (only consider langs with positive counts, ties go to the first lang)
+        lang_ids = np.zeros(len(ids), dtype=np.uint8) # 0 means all languages
+        if self.config.tie_by_langs and len(sources) > 1:
+            all_ids = np.concatenate(entry_ids[1:])
+            all_counts = np.concatenate(entry_counts[1:])
+            all_langs = np.repeat(np.arange(1, len(sources)), [len(i) for i in entry_ids[1:]])
+            positive = all_counts > 0
+            all_ids, all_counts, all_langs = all_ids[positive], all_counts[positive], all_langs[positive]
+            order = np.lexsort((all_langs, -all_counts, all_ids))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = all_ids[order[1:]] != all_ids[order[:-1]]
+            lang_ids[all_ids[order[first]]] = all_langs[order[first]]
+
         # filter and discount
-        for word in list(words.keys()):
-            count = words.pop(word)
-            if count < self.config.min_count:
-                continue
-            if word == "":
-                continue
-            if word in self.protected_tokens:
-                continue
-            if self.config.skip_numbers and word.isdigit():
-                continue
-            count = count ** self.config.discount_exponent
-            words[word] = count
-
-        # get primary language for each word
-        words = list(words.items())
-        lang_by_words = [None] * len(words) # None means all languages
-        if self.config.tie_by_langs and words_by_lang:
-            # get primary language for each word (only consider langs with positive counts)
-            for i, (word, _) in enumerate(words):
-                lang_counts = Counter()
-                for lang in words_by_lang:
-                    c = words_by_lang[lang].get(word, 0)
-                    if c > 0:
-                        lang_counts[lang] = c
-                if lang_counts:
-                    lang_by_words[i] = lang_counts.most_common(1)[0][0]
-                else:
-                    lang_by_words[i] = None
+        protected = self.protected_tokens
+        skip_numbers = self.config.skip_numbers
+        keep = counts >= self.config.min_count
+        keep &= np.fromiter((w != "" and w not in protected and not (skip_numbers and w.isdigit()) for w in ids),
+                            dtype=bool, count=len(ids))
+        counts = counts[keep] ** self.config.discount_exponent
+        lang_ids = lang_ids[keep]
                     
         # remove soft-hyphens, add end-of-word marker
-        for i, (word, count) in enumerate(words):    
-            if len(word) > 1 and word[-1] == shy:
-                words[i] = word[:-1], count
-            else:
-                words[i] = word + eow, count
-
-        return words, lang_by_words
+        words = [word[:-1] if len(word) > 1 and word[-1] == shy else word + eow
+                 for word, k in zip(ids, keep.tolist()) if k]
+        return words, counts, lang_ids
     
-    def generate_candidates(self, words):
+    def generate_candidates(self, words, pool: Optional[WorkerPool] = None):
         """
         Generate candidates.
         
         Args:
             words: The words.
+            pool: The worker pool holding the words in shards (see _init_shard), the shards are counted in parallel.
             
         Returns:
             The candidates.
         """
         token_regex = re.compile(self.config.token_regex) if self.config.token_regex is not None else None
-        candidates = Counter()
-        for word, count in words:
-            # avoid dangling end-of-word markers
-            word_len = len(word) - 1 if word.endswith(ASCII_RESERVED_EOW) else len(word)
-            for i in range(word_len):
-                for j in range(i + 2, min(i + self.config.max_token_length, word_len) + 1):
-                    token = word[i:j]
-                    if token_regex and not token_regex.match(token):
-                        continue
-                    candidates[token] += count
-        return set(t for t, _ in candidates.most_common(int(self.config.vocab_size * self.config.spread_factor)))
+        vocab_size = max(self.config.vocab_sizes or [self.config.vocab_size])
+        candidates = top_substrings(words, int(vocab_size * self.config.spread_factor), self.config.max_token_length,
+                                    token_regex=token_regex, max_entries=self.config.max_candidate_entries, pool=pool)
+        return set(t for t, _ in candidates)
     
-    def step_E(self, model: Model, words: List[Tuple[str, float]], lang_by_words: List[Optional[str]]):
-        return step_E(model, words, lang_by_words, self.config.workers, self.config.force_slow)
+    def build_lattices(self, pool: WorkerPool, model: Model):
+        with shared_morpher(pool, model, self.config.force_slow):
+            return pool.broadcast(_build_shard_lattices, model, self.config.force_slow, self.config.stream_chunk_size)
+
+    def rebalance_shards(self, pool: WorkerPool, words: WordTable, shards: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """
+        Rebalances the shards by the edge counts of the built lattices, since the EM steps take time linear in the edges,
+        and the shards are only balanced by the estimated costs of the words before (see WordTable.costs).
+        The lattices of the words that change their shard are moved between the workers, in the out-of-core mode
+        the shards are balanced by whole chunks, which are reassigned (the files stay in place).
+
+        Args:
+            pool: The worker pool holding the words and their lattices.
+            words: The words.
+            shards: The (start, end) of the words of each worker.
+
+        Returns:
+            The new shards.
+        """
+        if pool.workers == 1:
+            return shards
+        edges = pool.broadcast(_shard_edges)
+        if self.config.stream_dir is not None:
+            # (start, end, file, edge count) of all chunks
+            chunks = [(start + s, start + e, file, count) for (start, _), worker_chunks in zip(shards, edges)
+                      for s, e, file, count in worker_chunks]
+            bounds = [s for s, _, _, _ in chunks] + [len(words)]
+            ranges = balanced_ranges([count for _, _, _, count in chunks], pool.workers)
+            new_shards = [(bounds[a], bounds[b]) for a, b in ranges]
+            if new_shards != shards:
+                pool.run(_assign_chunks, [(words[ns:ne], [(s - ns, e - ns, file, count) for s, e, file, count in chunks[a:b]])
+                                          for (ns, ne), (a, b) in zip(new_shards, ranges)])
+            return new_shards
+        new_shards = balanced_ranges(np.concatenate(edges), pool.workers)
+        if new_shards == shards:
+            return shards
+        # the workers keep the lattices of their new shards and return the others, which are sent to their new workers
+        moved = [[] for _ in shards]
+        for pieces in pool.run(_split_shard, [(s, e, ns, ne) for (s, e), (ns, ne) in zip(shards, new_shards)]):
+            for start, arrays in pieces:
+                lattices = PackedLattices(*arrays)
+                for i, (ns, ne) in enumerate(new_shards):
+                    s, e = max(start, ns), min(start + len(lattices), ne)
+                    if s < e:
+                        moved[i].append((s, lattices.slice(s - start, e - start)))
+        pool.run(_merge_shard, [(words[ns:ne], pieces) for (ns, ne), pieces in zip(new_shards, moved)])
+        return new_shards
+
+    def sample_words(self, pool: WorkerPool, shards: List[Tuple[int, int]], counts: np.ndarray, it: int, final: bool) -> bool:
+        """
+        Subsamples the words of the workers for the EM steps of an iteration (see TrainerConfig.subsample_schedule).
+
+        Returns:
+            Whether the words are subsampled (the sample must be cleared with _sample_shard after the EM steps).
+        """
+        schedule = self.config.subsample_schedule
+        if final or schedule is None or it >= len(schedule) or schedule[it] >= 1.0:
+            return False
+        indices, weights = subsample_words(counts, schedule[it], np.random.default_rng([self.config.subsample_seed, it]))
+        bounds = np.searchsorted(indices, [s for s, _ in shards] + [shards[-1][1]])
+        pool.run(_sample_shard, [(indices[b:e] - s, weights[b:e]) for (s, _), b, e in zip(shards, bounds[:-1], bounds[1:])])
+        print(f'  sampled {len(indices)} of {len(counts)} words')
+        return True
+
+    def step_E(self, pool: WorkerPool, model: Model, hard: bool = False, with_losses: bool = False, with_soft_nll: bool = False):
+        return step_E_pool(pool, model, hard, with_losses, with_soft_nll)
     
     def step_M(self, model: Model, m_vocab, m_rules):
         model.update_logits(m_vocab, m_rules)
         # TODO: apply special logit rules here
 
-    def prune(self, model: Model, words: List[Tuple[str, float]], langs_by_words: List[Optional[set]], prune_count: int):
+    def prune(self, pool: WorkerPool, model: Model, prune_count: int, hard: bool = False, losses: Optional[np.ndarray] = None):
         unused = frozenset(v for v, l in zip(model.vocab, model.vocab_logits) if l <= MIN_LOGIT) - self.protected_tokens
         if len(unused) > prune_count:
             remove = unused
         else:
-            losses = compute_losses(model, words, langs_by_words, self.config.workers, self.config.force_slow)
+            if losses is None:
+                losses = compute_losses_pool(pool, model, hard)
             losses = sorted([(l, v) for v, l in zip(model.vocab, losses) if v not in self.protected_tokens])
             remove = frozenset(v for _, v in losses[0:prune_count])
         return remove
@@ -364,75 +795,503 @@ class Trainer():
             for token in self.config.seed_tokens:
                 model.vocab_logits[model.vocab_lookup[token]] = self.config.seed_token_logit
         
-    def tie_model(self, model: Model, words: List[Tuple[str, float]], langs_by_words: List[Optional[set]]):
-        vocab_langs = tie(model, words, langs_by_words, self.config.workers, self.config.force_slow)
+    def tie_model(self, pool: WorkerPool, model: Model):
+        with shared_morpher(pool, model, self.config.force_slow):
+            vocab_langs = tie_pool(pool, model, self.config.force_slow)
         for i in range(len(self.protected_tokens)):
             vocab_langs[i] = (1 << len(model.langs)) - 1
         model.update_tied_langs(model.langs, vocab_langs)
     
-def step_E_single(model: Model, words: List[Tuple[str, float]], langs_by_words: List[Optional[set]], show_progress: bool, force_slow: bool):
-    m_vocab = [0.0] * len(model.vocab)
-    m_rules = [0.0] * len(model.rules)
+def rule_key(rule: MorphRule) -> str:
+    """Returns a key that identifies a rule across models (its serialization)."""
+    return json.dumps(rule.save_dict(), sort_keys=True, ensure_ascii=False)
+
+def warm_start_logits(logits: List[Optional[float]]) -> np.ndarray:
+    """
+    Returns normalized logits (log probabilities, at least MIN_LOGIT) from known logits,
+    unknown logits (None) are set to the median of the known logits (of used entries, i.e., above MIN_LOGIT).
+    """
+    known = [l for l in logits if l is not None and l > MIN_LOGIT]
+    default = float(np.median(known)) if known else 0.0
+    logits = np.array([default if l is None else l for l in logits], dtype=np.float64)
+    if len(logits) == 0:
+        return logits.astype(np.float32)
+    return np.maximum(logits - np.logaddexp.reduce(logits), MIN_LOGIT).astype(np.float32)
+
+def restore_logits(logits: np.ndarray, prev_logits: np.ndarray, restore: np.ndarray) -> np.ndarray:
+    """
+    Restores the previous logits of some entries after an M-step and renormalizes the logits,
+    so that they hold the same probability mass as the logits of the M-step.
+
+    Args:
+        logits: The logits of the M-step.
+        prev_logits: The logits before the M-step.
+        restore: The mask of the entries to restore.
+
+    Returns:
+        The restored logits (at least MIN_LOGIT).
+    """
+    logits = np.asarray(logits, dtype=np.float64)
+    restored = np.where(restore, np.asarray(prev_logits, dtype=np.float64), logits)
+    if len(restored) == 0:
+        return restored.astype(np.float32)
+    alive = restored > MIN_LOGIT
+    restored[alive] += np.logaddexp.reduce(logits) - np.logaddexp.reduce(restored)
+    return np.maximum(restored, MIN_LOGIT).astype(np.float32)
+
+def extend_model(model: Model, bases: List[str], words: WordTable, lang_by_words: Optional[Sequence[Optional[str]]] = None,
+                 em_steps: int = 2, prior_count: Optional[float] = None, workers: int = 1, force_slow: bool = False) -> List[int]:
+    """
+    Adds (e.g., domain-specific) bases to a trained model and re-estimates the logits on a (small) list of words,
+    without retraining: the bases are appended to the vocab (see Model.extend_vocab).
+
+    The logits are estimated as a mixture of the current model and the words: the current probabilities count as
+    prior_count words, so that tokens and rules which don't occur in the words keep their relative logits.
+    The new bases start with the median logit of the model.
+
+    Args:
+        model: The trained model (modified in place).
+        bases: The bases to add (bases which are already in the vocab are ignored).
+        words: The words and their counts (prepared, see Trainer.prepare_words).
+        lang_by_words: The languages of the words (default: None = the languages of the table).
+        em_steps: The number of EM steps.
+        prior_count: The weight of the current model (default: None = the total count of the words).
+        workers: The number of workers.
+        force_slow: Whether to force slow decomposition (see Morpher.decompose).
+
+    Returns:
+        The ids of the bases.
+    """
+    if lang_by_words is None:
+        lang_by_words = words.lang_by_words
+    counts = words.counts.astype(np.float64)
+    if prior_count is None:
+        prior_count = counts.sum()
+    # the new bases are not part of the prior
+    prior_vocab = prior_count * np.exp(model.vocab_logits.astype(np.float64))
+    prior_rules = prior_count * np.exp(model.rules_logits.astype(np.float64))
+
+    used = model.vocab_logits[model.vocab_logits > MIN_LOGIT]
+    initial_logit = float(np.median(used)) if len(used) > 0 else 0.0
+    ids = model.extend_vocab(bases, [initial_logit] * len(bases))
+    prior_vocab = np.concatenate([prior_vocab, np.zeros(len(model.vocab) - len(prior_vocab))])
+
+    with WorkerPool(workers) as pool:
+        pool.run(_init_shard, [(words[s:e], None, lang_by_words[s:e]) for s, e in balanced_ranges(words.costs(), workers)])
+        with shared_morpher(pool, model, force_slow):
+            pool.broadcast(_build_shard_lattices, model, force_slow, None)
+        for step in range(em_steps):
+            nll, m_vocab, m_rules, _ = step_E_pool(pool, model)
+            print(f'  NLL({step})={nll}')
+            total = counts.sum() + prior_count
+            with np.errstate(divide='ignore'):
+                model.set_logits(np.maximum(np.log((m_vocab + prior_vocab) / total), MIN_LOGIT),
+                                 np.maximum(np.log((m_rules + prior_rules) / total), MIN_LOGIT))
+    return ids
+
+def load_checkpoint(checkpoint_file: str) -> dict:
+    """Loads a checkpoint (see Trainer.save_checkpoint), logits are restored as float32 arrays."""
+    with open(checkpoint_file, "r", encoding="utf8") as f:
+        checkpoint = json.load(f)
+    checkpoint["vocab_logits"] = np.array(checkpoint["vocab_logits"], dtype=np.float32)
+    checkpoint["rules_logits"] = np.array(checkpoint["rules_logits"], dtype=np.float32)
+    checkpoint["snapshots"] = {size: (vocab, np.array(vocab_logits, dtype=np.float32), np.array(rules_logits, dtype=np.float32))
+                               for size, vocab, vocab_logits, rules_logits in checkpoint.get("snapshots", [])}
+    return checkpoint
+
+def build_lattices_single(model: Model, words: WordTable, lang_by_words: Sequence[Optional[str]], show_progress: bool, force_slow: bool):
+    words = tqdm(words.iter_words(), desc='decompose', total=len(words), disable=not show_progress)
+    return model.build_packed_lattices(words, lang_by_words, force_slow=force_slow)
+
+def step_E_lattices_single(lattices: PackedLattices, edge_logits: np.ndarray, counts: np.ndarray, vocab_size: int, rules_size: int, show_progress: bool,
+                           losses: Optional[np.ndarray] = None):
+    """
+    Computes the NLL and the expected counts of the tokens and rules (soft EM).
+    If losses is given, the removal losses of the tokens (see compute_losses_lattices_single) are added to it,
+    reusing the forward and backward logits.
+    """
+    m_vocab = np.zeros(vocab_size)
+    m_rules = np.zeros(rules_size)
     nll = 0.0
-    total_count = 0
-    for (word, count), lang in tqdm(zip(words, langs_by_words), desc=f'step E', total=len(words), disable=not show_progress):
-        # force_slow to prevent building stem trie
-        nll -= model.add_marginal(word, count, lang, m_vocab, m_rules, force_slow=force_slow)
-        total_count += count
+    for s, e, batch, batch_logits in tqdm(iter_batches(lattices, edge_logits), desc=f'step E', disable=not show_progress):
+        logits_forward = batch.forward_sum(batch_logits)
+        logits_backward = batch.backward_sum(batch_logits)
+        partitions = batch.partitions(logits_forward)
+        # skip words without full-coverage decomposition (see Model.add_marginal)
+        finite = np.isfinite(partitions)
+        nll -= np.dot(partitions[finite], counts[s:e][finite])
+        weights = np.exp(batch.marginal_logits(batch_logits, logits_forward, logits_backward)) * counts[s:e][batch.word_ids()]
+        m_vocab += np.bincount(batch.vocab_ids, weights=weights, minlength=vocab_size)
+        m_rules += np.bincount(batch.rule_ids, weights=weights, minlength=rules_size)
+        if losses is not None:
+            weights = batch.removal_losses(batch_logits, logits_forward, logits_backward) * counts[s:e][batch.word_ids()]
+            losses += np.bincount(batch.vocab_ids, weights=weights, minlength=vocab_size)
+    total_count = counts.sum()
     if total_count > 0:
         nll /= total_count
     return nll, m_vocab, m_rules
-    
-def step_E(model: Model, words: List[Tuple[str, float]], lang_by_words: List[Optional[str]], workers: int, force_slow: bool):
-    if workers == 1:
-        return step_E_single(model, words, lang_by_words, show_progress=True, force_slow=force_slow)
-    word_chunks = chunk_list(words, workers)
-    lang_chunks = chunk_list(lang_by_words, workers)
-        
-    with Pool(workers) as p:
-        results = [p.apply_async(step_E_single, (model, cw, cl, i==0, force_slow))
-                   for i, (cw, cl) in enumerate(zip(word_chunks, lang_chunks))]
-
-        nll = 0.0
-        total = 0
-        m_vocab = [0.0] * len(model.vocab)
-        m_rules = [0.0] * len(model.rules)
-        for result, chunk in zip(results, word_chunks):
-            _nll, _m_vocab, _m_rules = result.get()
-            _total = sum(c for _, c in chunk)
-            nll += _nll * _total
-            total += _total
-            add_arrays(m_vocab, _m_vocab)
-            add_arrays(m_rules, _m_rules)
-
-        if total > 0:
-            nll /= total
-        return nll, m_vocab, m_rules
-
-def compute_losses_single(model: Model, words: List[Tuple[str, float]], lang_by_words: List[Optional[str]], show_progress: bool, force_slow: bool):
-    losses = [0.0] * len(model.vocab)
-    for (word, count), lang in tqdm(zip(words, lang_by_words), desc=f'pruning', total=len(words), disable=not show_progress):
-        model.add_vocab_loss(word, count, lang, losses, force_slow=force_slow)
+
+def step_E_viterbi_lattices_single(lattices: PackedLattices, edge_logits: np.ndarray, counts: np.ndarray, vocab_size: int, rules_size: int, show_progress: bool,
+                                   with_soft_nll: bool = False):
+    """
+    Like step_E_lattices_single, but counts the best decompositions (hard EM), the NLL is the one of the best decompositions.
+    If with_soft_nll, the NLL of all decompositions (as in soft EM) is computed from the same batches and returned as well
+    (otherwise None).
+    """
+    m_vocab = np.zeros(vocab_size)
+    m_rules = np.zeros(rules_size)
+    nll = 0.0
+    soft_nll = 0.0 if with_soft_nll else None
+    for s, e, batch, batch_logits in tqdm(iter_batches(lattices, edge_logits), desc=f'step E (viterbi)', disable=not show_progress):
+        best_logits, path = batch.viterbi(batch_logits)
+        finite = np.isfinite(best_logits)
+        nll -= np.dot(best_logits[finite], counts[s:e][finite])
+        weights = counts[s:e][batch.word_ids()[path]]
+        m_vocab += np.bincount(batch.vocab_ids[path], weights=weights, minlength=vocab_size)
+        m_rules += np.bincount(batch.rule_ids[path], weights=weights, minlength=rules_size)
+        if with_soft_nll:
+            # words with a best decomposition are exactly the words with a finite partition function
+            partitions = batch.partitions(batch.forward_sum(batch_logits))
+            soft_nll -= np.dot(partitions[finite], counts[s:e][finite])
+    total_count = counts.sum()
+    if total_count > 0:
+        nll /= total_count
+        if with_soft_nll:
+            soft_nll /= total_count
+    return nll, m_vocab, m_rules, soft_nll
+
+def compute_usage_lattices_single(lattices: PackedLattices, edge_logits: np.ndarray, counts: np.ndarray, vocab_size: int, show_progress: bool):
+    """Returns how often each token is used by the best decompositions (the pruning losses of hard EM)."""
+    usage = np.zeros(vocab_size)
+    for s, e, batch, batch_logits in tqdm(iter_batches(lattices, edge_logits), desc=f'pruning (viterbi)', disable=not show_progress):
+        _, path = batch.viterbi(batch_logits)
+        usage += np.bincount(batch.vocab_ids[path], weights=counts[s:e][batch.word_ids()[path]], minlength=vocab_size)
+    return usage
+
+def compute_losses_lattices_single(lattices: PackedLattices, edge_logits: np.ndarray, counts: np.ndarray, vocab_size: int, show_progress: bool):
+    losses = np.zeros(vocab_size)
+    for s, e, batch, batch_logits in tqdm(iter_batches(lattices, edge_logits), desc=f'pruning', disable=not show_progress):
+        logits_forward = batch.forward_sum(batch_logits)
+        logits_backward = batch.backward_sum(batch_logits)
+        weights = batch.removal_losses(batch_logits, logits_forward, logits_backward) * counts[s:e][batch.word_ids()]
+        losses += np.bincount(batch.vocab_ids, weights=weights, minlength=vocab_size)
     return losses
 
-def compute_losses(model: Model, words: List[Tuple[str, float]], lang_by_words: List[Optional[str]], workers: int, force_slow: bool):
-    if workers == 1:
-        return compute_losses_single(model, words, lang_by_words, show_progress=True, force_slow=force_slow)
-    word_chunks = chunk_list(words, workers)
-    langs_chunks = chunk_list(lang_by_words, workers)
+def iter_batches(lattices: PackedLattices, edge_logits: np.ndarray, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Yields batches of words (start, end, lattices, edge logits) for the vectorized forward-backward passes."""
+    for s, e, batch in lattices.batches(batch_size):
+        o = lattices.offsets[s] - lattices.offsets[0]
+        yield s, e, batch, edge_logits[o:o+batch.edge_count]
+
+def step_E_pool(pool: WorkerPool, model: Model, hard: bool = False, with_losses: bool = False, with_soft_nll: bool = False):
+    """
+    Runs the E-step on the words of the workers.
 
-    with Pool(workers) as p:
-        results = [p.apply_async(compute_losses_single, (model, cw, cl, i==0, force_slow))
-                   for i, (cw, cl) in enumerate(zip(word_chunks, langs_chunks))]
+    Args:
+        pool: The worker pool holding the lattices.
+        model: The model.
+        hard: Whether to count the best decompositions only (hard EM).
+        with_losses: Whether to compute the pruning losses in the same pass (see compute_losses_pool),
+                     based on the current logits. The workers must not use a sample of their words.
+        with_soft_nll: Whether to also return the NLL of all decompositions, computed in the same pass
+                       (the NLL of hard EM is the one of the best decompositions, see nll_pool).
+
+    Returns:
+        The NLL, the counts of the tokens and rules, and the pruning losses (None if not requested),
+        followed by the NLL of all decompositions if with_soft_nll.
+    """
+    nll = 0.0
+    soft_nll = 0.0
+    total = 0.0
+    m_vocab = np.zeros(len(model.vocab))
+    m_rules = np.zeros(len(model.rules))
+    losses = np.zeros(len(model.vocab)) if with_losses and not hard else None
+    for _nll, _total, _m_vocab, _m_rules, _losses, _soft_nll in pool.broadcast(_step_E_shard, model.vocab_logits, model.rules_logits,
+                                                                               hard, with_losses, with_soft_nll):
+        nll += _nll * _total
+        total += _total
+        m_vocab += _m_vocab
+        m_rules += _m_rules
+        if losses is not None:
+            losses += _losses
+        if with_soft_nll:
+            soft_nll += _soft_nll * _total
+    if total > 0:
+        nll /= total
+        soft_nll /= total
+    if with_losses and hard:
+        # the usage of the tokens by the best decompositions are the counts of hard EM
+        losses = m_vocab.copy()
+    if with_soft_nll:
+        return nll, m_vocab, m_rules, losses, soft_nll
+    return nll, m_vocab, m_rules, losses
 
-        losses = [0.0] * len(model.vocab)
-        for result in results:
-            _losses = result.get()
-            add_arrays(losses, _losses)
+def extrapolate_logits(logits0, logits1, logits2):
+    """
+    Extrapolates the logits of three consecutive EM steps, each given as a tuple (vocab logits, rules logits)
+    (SQUAREM, scheme S3 of Varadhan & Roland, 2008).
 
-        return losses
+    Returns:
+        The extrapolated (vocab logits, rules logits), clipped to [MIN_LOGIT, 0].
+    """
+    theta0, theta1, theta2 = (np.concatenate([np.asarray(l, dtype=np.float64) for l in logits]) for logits in (logits0, logits1, logits2))
+    # logits clipped to MIN_LOGIT (pruned by the M-step) would dominate the step length, they are kept as they are
+    alive = theta2 > MIN_LOGIT
+    r = (theta1 - theta0)[alive]
+    v = (theta2 - theta1)[alive] - r
+    norm_v = np.linalg.norm(v)
+    # alpha = -1 yields theta2, i.e., no extrapolation
+    alpha = min(-np.linalg.norm(r) / norm_v, -1.0) if norm_v > 0 else -1.0
+    theta = theta2.copy()
+    theta[alive] = np.clip(theta0[alive] - 2 * alpha * r + alpha ** 2 * v, MIN_LOGIT, 0.0)
+    vocab_size = len(logits0[0])
+    return theta[:vocab_size], theta[vocab_size:]
 
-def tie_single(model: Model, words: List[Tuple[str, float]], lang_by_words: List[Optional[str]], show_progress: bool, force_slow: bool):
+def nll_pool(pool: WorkerPool, model: Model, hard: bool = False, sampled: bool = False):
+    """
+    Returns the NLL per word of the words of the workers (without an E-step).
+
+    Args:
+        pool: The worker pool holding the lattices.
+        model: The model.
+        hard: Whether to return the NLL of the best decompositions (as the E-step of hard EM).
+        sampled: Whether to use the sample of the words of the workers, if there is one (as the E-step).
+
+    Returns:
+        The NLL.
+    """
+    nll = 0.0
+    total = 0.0
+    for _nll, _total in pool.broadcast(_nll_shard, model.vocab_logits, model.rules_logits, hard, sampled):
+        nll += _nll
+        total += _total
+    return nll / total if total > 0 else nll
+
+def subsample_words(counts: np.ndarray, rate: float, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draws a frequency-stratified sample of about rate * len(counts) words (threshold sampling): words with a count of
+    at least the threshold are always kept with their count, the other words are kept with a probability proportional
+    to their count and weighted with the threshold. The weighted sample is an unbiased estimate of the counts.
+
+    Args:
+        counts: The word counts.
+        rate: The fraction of words to keep.
+        rng: The random generator.
+
+    Returns:
+        A tuple of the (sorted) indices of the sampled words and their weights.
+    """
+    target = rate * len(counts)
+    if target >= len(counts):
+        return np.arange(len(counts)), counts
+    # keep the m most frequent words and sample the rest with the threshold sum(rest) / (target - m),
+    # for the smallest m for which the threshold exceeds the count of the next word
+    sorted_counts = np.sort(counts)[::-1]
+    rest = np.cumsum(sorted_counts[::-1])[::-1]
+    m = np.arange(int(np.ceil(target)))
+    thresholds = rest[m] / (target - m)
+    threshold = thresholds[np.argmax(sorted_counts[m] < thresholds)]
+    keep = (counts >= threshold) | (rng.random(len(counts)) * threshold < counts)
+    indices = np.flatnonzero(keep)
+    return indices, np.maximum(counts[indices], threshold)
+
+def compute_losses_pool(pool: WorkerPool, model: Model, hard: bool = False):
+    losses = np.zeros(len(model.vocab))
+    for _losses in pool.broadcast(_losses_shard, model.vocab_logits, model.rules_logits, hard):
+        losses += _losses
+    return losses
+
+def tie_pool(pool: WorkerPool, model: Model, force_slow: bool):
+    vocab_langs = np.zeros(len(model.vocab), dtype=lang_mask_dtype(model.langs))
+    for _vocab_langs in pool.broadcast(_tie_shard, model, force_slow):
+        vocab_langs |= np.asarray(_vocab_langs, dtype=vocab_langs.dtype)
+    return vocab_langs.tolist()
+
+@contextmanager
+def shared_morpher(pool: WorkerPool, model: Model, force_slow: bool):
+    """
+    Shares the tries of the model's morpher with the workers while the context is active (see Morpher.share).
+    Workers of other machines (see FilePool) cannot attach to shared memory, they receive the tries.
+    """
+    if pool.workers == 1 or force_slow or not pool.local:
+        yield
+        return
+    with TemporaryDirectory() as directory:
+        model.morpher.share(directory)
+        try:
+            yield
+        finally:
+            model.morpher.unshare()
+
+@contextmanager
+def stream_directory(stream_dir: Optional[str]):
+    """Yields a temporary directory in stream_dir for the files of a training run (None if stream_dir is None)."""
+    if stream_dir is None:
+        yield None
+        return
+    os.makedirs(stream_dir, exist_ok=True)
+    with TemporaryDirectory(dir=stream_dir) as directory:
+        yield directory
+
+def _init_shard(state, words, stream_dir=None, lang_by_words=None):
+    state["words"] = words
+    state["lang_by_words"] = words.lang_by_words if lang_by_words is None else lang_by_words
+    state["stream_dir"] = stream_dir
+    if stream_dir is None:
+        state["counts"] = words.counts.astype(np.float64)
+
+def _build_shard_lattices(state, model, force_slow, chunk_size):
+    # only the scoring parameters are kept, the logits are broadcasted with each step
+    state["scoring"] = (model.alpha, model.beta, [r.penalty for r in model.rules])
+    words, show_progress = state["words"], state["index"] == 0
+    if state["stream_dir"] is None:
+        state["lattices"] = build_lattices_single(model, words, state["lang_by_words"], show_progress, force_slow)
+        return
+    # out-of-core: the lattices are saved chunk by chunk
+    state["chunks"] = []
+    state["chunk_edges"] = []
+    for s in range(0, len(words), chunk_size):
+        e = min(s + chunk_size, len(words))
+        file = os.path.join(state["stream_dir"], f"lattices-{state['index']}-{len(state['chunks'])}-v0.npz")
+        lattices = build_lattices_single(model, words[s:e], state["lang_by_words"][s:e], show_progress, force_slow)
+        _save_lattices(lattices, file)
+        state["chunks"].append((s, e, file))
+        state["chunk_edges"].append(lattices.edge_count)
+
+def _shard_edges(state):
+    # the edge count of each word, out-of-core: the (start, end, file, edge count) of each chunk
+    if state["stream_dir"] is None:
+        return np.diff(state["lattices"].offsets)
+    return [(s, e, file, count) for (s, e, file), count in zip(state["chunks"], state["chunk_edges"])]
+
+def _split_shard(state, start, end, new_start, new_end):
+    # keeps the lattices of the words in the new shard, returns the others as (start, lattice arrays) (see _merge_shard)
+    lattices = state["lattices"]
+    s, e = max(start, new_start), min(end, new_end)
+    if s >= e:
+        s = e = start
+    state["kept"] = (s, lattices.slice(s - start, e - start))
+    del state["lattices"]
+    return [(a, lattices.slice(a - start, b - start).arrays()) for a, b in [(start, s), (e, end)] if a < b]
+
+def _merge_shard(state, words, pieces):
+    pieces = sorted(pieces + [state.pop("kept")], key=lambda piece: piece[0])
+    state["lattices"] = PackedLattices.concatenate([lattices for _, lattices in pieces])
+    assert len(state["lattices"]) == len(words)
+    _init_shard(state, words, state["stream_dir"])
+
+def _assign_chunks(state, words, chunks):
+    _init_shard(state, words, state["stream_dir"])
+    state["chunks"] = [(s, e, file) for s, e, file, _ in chunks]
+    state["chunk_edges"] = [count for _, _, _, count in chunks]
+
+def _remap_shard(state, vocab_map):
+    if state["stream_dir"] is None:
+        state["lattices"] = state["lattices"].remap_vocab(vocab_map)
+        if state.get("sample") is not None:
+            lattices, weights = state["sample"]
+            state["sample"] = (lattices.remap_vocab(vocab_map), weights)
+        return
+    # the remapped lattices are saved as the next version of a chunk file, so that a worker which takes over the shard
+    # can replay the calls of the shard (see FilePool): versions that are missing have been remapped already
+    chunks = []
+    for s, e, file in state["chunks"]:
+        base, version = file[:-len(".npz")].rsplit("-v", 1)
+        next_file = f"{base}-v{int(version) + 1}.npz"
+        if os.path.exists(file):
+            if not os.path.exists(next_file):
+                _save_lattices(PackedLattices.load(file).remap_vocab(vocab_map), next_file)
+            os.remove(file)
+        chunks.append((s, e, next_file))
+    state["chunks"] = chunks
+
+def _save_lattices(lattices, file):
+    # readers never see partial files
+    tmp_file = f"{file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        lattices.save(f)
+    os.replace(tmp_file, file)
+
+def _sample_shard(state, indices, weights):
+    # the E-step uses the sample until it is cleared (indices=None),
+    # in the out-of-core mode the sample is selected from each chunk when it is loaded
+    if indices is None:
+        state["sample"] = None
+    elif state["stream_dir"] is None:
+        state["sample"] = (state["lattices"].select(indices), weights)
+    else:
+        state["sample"] = (indices, weights)
+
+def _iter_shard(state, sampled: bool = True):
+    """
+    Yields the lattices of the worker and the counts of their words (the sample, if sampled and there is one),
+    loaded chunk by chunk in the out-of-core mode.
+    """
+    sample = state.get("sample") if sampled else None
+    if state["stream_dir"] is None:
+        yield sample or (state["lattices"], state["counts"])
+        return
+    for s, e, file in state["chunks"]:
+        lattices = PackedLattices.load(file)
+        if sample is None:
+            yield lattices, state["words"].counts[s:e].astype(np.float64)
+        else:
+            indices, weights = sample
+            lo, hi = np.searchsorted(indices, [s, e])
+            yield lattices.select(indices[lo:hi] - s), weights[lo:hi]
+
+def _step_E_shard(state, vocab_logits, rules_logits, hard, with_losses, with_soft_nll=False):
+    assert not (with_losses and state.get("sample"))
+    nll, total, soft_nll = 0.0, 0.0, 0.0
+    m_vocab, m_rules = np.zeros(len(vocab_logits)), np.zeros(len(rules_logits))
+    losses = np.zeros(len(vocab_logits)) if with_losses and not hard else None
+    for lattices, counts in _iter_shard(state):
+        edge_logits = score_edges(lattices, vocab_logits, rules_logits, *state["scoring"])
+        if hard:
+            _nll, _m_vocab, _m_rules, _soft_nll = step_E_viterbi_lattices_single(lattices, edge_logits, counts, len(vocab_logits),
+                                                                                 len(rules_logits), show_progress=state["index"] == 0,
+                                                                                 with_soft_nll=with_soft_nll)
+        else:
+            _nll, _m_vocab, _m_rules = step_E_lattices_single(lattices, edge_logits, counts, len(vocab_logits), len(rules_logits),
+                                                              show_progress=state["index"] == 0, losses=losses)
+            _soft_nll = _nll
+        nll += _nll * counts.sum()
+        if with_soft_nll:
+            soft_nll += _soft_nll * counts.sum()
+        total += counts.sum()
+        m_vocab += _m_vocab
+        m_rules += _m_rules
+    if total > 0:
+        nll /= total
+        soft_nll /= total
+    return nll, total, m_vocab, m_rules, losses, soft_nll if with_soft_nll else None
+
+def _nll_shard(state, vocab_logits, rules_logits, hard=False, sampled=False):
+    nll, total = 0.0, 0.0
+    for lattices, counts in _iter_shard(state, sampled=sampled):
+        edge_logits = score_edges(lattices, vocab_logits, rules_logits, *state["scoring"])
+        for s, e, batch, batch_logits in iter_batches(lattices, edge_logits):
+            if hard:
+                partitions, _ = batch.viterbi(batch_logits)
+            else:
+                partitions = batch.partitions(batch.forward_sum(batch_logits))
+            finite = np.isfinite(partitions)
+            nll -= np.dot(partitions[finite], counts[s:e][finite])
+        total += counts.sum()
+    return nll, total
+
+def _losses_shard(state, vocab_logits, rules_logits, hard):
+    losses_func = compute_usage_lattices_single if hard else compute_losses_lattices_single
+    losses = np.zeros(len(vocab_logits))
+    for lattices, counts in _iter_shard(state, sampled=False):
+        edge_logits = score_edges(lattices, vocab_logits, rules_logits, *state["scoring"])
+        losses += losses_func(lattices, edge_logits, counts, len(vocab_logits), show_progress=state["index"] == 0)
+    return losses
+
+def _tie_shard(state, model, force_slow):
+    return tie_single(model, state["words"], state["lang_by_words"], state["index"] == 0, force_slow)
+
+def tie_single(model: Model, words: WordTable, lang_by_words: Sequence[Optional[str]], show_progress: bool, force_slow: bool):
     langs = model.langs
     langs_map = {l: i for i, l in enumerate(langs)}
     vocab_langs = [0] * len(model.vocab) # don't care about memory consumption here
@@ -448,25 +1307,6 @@ def tie_single(model: Model, words: List[Tuple[str, float]], lang_by_words: List
             vocab_langs[v_id] |= lang_mask
     return vocab_langs
 
-def tie(model: Model, words: List[Tuple[str, float]], lang_by_words: List[Optional[str]], workers: int, force_slow: bool):
-    if workers == 1:
-        return tie_single(model, words, lang_by_words, show_progress=True, force_slow=force_slow)
-    word_chunks = chunk_list(words, workers)
-    langs_chunks = chunk_list(lang_by_words, workers)
-
-    with Pool(workers) as p:
-        results = [p.apply_async(tie_single, (model, cw, cl, i==0, force_slow))
-                   for i, (cw, cl) in enumerate(zip(word_chunks, langs_chunks))]
-
-        vocab_langs = [0] * len(model.vocab)
-        for result in results:
-            _vocab_langs = result.get()
-            for i in range(len(vocab_langs)):
-                vocab_langs[i] |= _vocab_langs[i]
-        return vocab_langs
-
-
-def add_arrays(a, b):
-    assert len(a) == len(b), f"add_arrays: length mismatch ({len(a)} vs {len(b)})"
-    for i in range(len(a)):
-        a[i] += b[i]
+def lang_mask_dtype(langs: List[str]):
+    """Returns the dtype for merging language bitmasks (NumPy integers hold up to 64 languages, more need Python ints)."""
+    return np.uint64 if len(langs) <= 64 else object
@@ -2,6 +2,7 @@
 
 from typing import Any, Tuple
 
+import numpy as np
 from marisa_trie import Trie
 
 class DictTrie():
@@ -38,6 +39,20 @@ class DictTrie():
     
     def prefixes_and_values(self, word) -> list[Tuple[str, Any]]:
         return [(p, self.list[i]) for p, i in self.trie.iter_prefixes_with_ids(word)]
+
+    def export(self, path) -> dict:
+        """Saves the trie to path and returns the values as arrays (values must be ints, see load_exported)."""
+        self.trie.save(path)
+        return {"values": np.array(self.list, dtype=np.int64)}
+
+    @staticmethod
+    def load_exported(path, arrays):
+        """Memory-maps an exported trie (see export), the values are read from the array on demand."""
+        obj = DictTrie.__new__(DictTrie)
+        obj.trie = Trie()
+        obj.trie.mmap(path)
+        obj.list = PackedValues(arrays["values"])
+        return obj
     
     def values(self, word=None) -> list:
         if word is None:
@@ -77,4 +92,51 @@ class LookupTrie():
     def values(self, word) -> list[list]:
         return [self.list[i] for _, i in self.trie.iter_prefixes_with_ids(word)]
 
+    def export(self, path) -> dict:
+        """
+        Saves the trie to path and returns the values as arrays in CSR format (see load_exported).
+        Values must be ints or tuples of ints of the same length.
+        """
+        self.trie.save(path)
+        offsets = np.zeros(len(self.list) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in self.list], out=offsets[1:])
+        return {"offsets": offsets, "values": np.array([v for vs in self.list for v in vs], dtype=np.int64)}
+
+    @staticmethod
+    def load_exported(path, arrays):
+        """Memory-maps an exported trie (see export), the values are read from the arrays on demand."""
+        obj = LookupTrie.__new__(LookupTrie)
+        obj.trie = Trie()
+        obj.trie.mmap(path)
+        obj.list = PackedLists(arrays["offsets"], arrays["values"])
+        return obj
+
+
+class PackedLists():
+    def __init__(self, offsets, values):
+        """Read-only list of lists stored in CSR format (lists of tuples, if values is two-dimensional)."""
+        self.offsets = offsets
+        self.values = values
+        self.as_tuples = values.ndim == 2
+
+    def __getitem__(self, i):
+        values = self.values[self.offsets[i]:self.offsets[i+1]].tolist()
+        return [tuple(v) for v in values] if self.as_tuples else values
+
+    def __len__(self):
+        return len(self.offsets) - 1
     
+
+class PackedValues():
+    def __init__(self, values):
+        """Read-only list of ints stored in an array."""
+        self.values = values
+
+    def __getitem__(self, i):
+        return self.values.item(i)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values.tolist())
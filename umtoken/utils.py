@@ -1,6 +1,8 @@
 # Path: umtoken/utils.py
 
-from typing import List, Optional, Union
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
 
 
 def cumsum(items):
@@ -61,25 +63,54 @@ def format(ids, morpher, no_join: bool = False, apply_ws: bool = False, apply_ca
             cs = 0 if cs < 2 else 2
     return parts if no_join else "|".join(parts)
 
-def chunk_list(l: list, n: int):
+def word_cost(word: str) -> int:
     """
-    Splits a list into n interleaved chunks.
-    
+    Estimates the cost of processing a word (decomposition, lattice), which grows with the number of its parts.
+
     Args:
-        l: The list to split.
-        n: The number of chunks.
-        
+        word: The (escaped) word.
+
     Returns:
-        A list of n chunks.
-        
+        The number of substrings of the word.
+    """
+    return length_cost(len(word))
+
+def length_cost(length: Union[int, np.ndarray]) -> Union[int, np.ndarray]:
+    """
+    Estimates the cost of processing words of the given lengths (see word_cost).
+
+    Args:
+        length: The length of a word, or an array of lengths.
+
+    Returns:
+        The number of substrings of the words (an array for an array of lengths).
+    """
+    return length * (length + 1) // 2
+
+def balanced_ranges(costs: Sequence[float], n: int):
+    """
+    Splits range(len(costs)) into n contiguous ranges of (almost) equal total cost.
+    Ranges may be empty, e.g., if there are less than n items.
+
+    Args:
+        costs: The cost of each item.
+        n: The number of ranges.
+
+    Returns:
+        A list of n (start, end) tuples.
+
     Examples:
-        chunk_list([1,2,3,4,5,6,7,8,9,10], 3) -> [[1,4,7,10], [2,5,8], [3,6,9]]    
+        balanced_ranges([1, 1, 4, 1, 1], 2) -> [(0, 2), (2, 5)]
     """
-    if not isinstance(l, list):
-        l = list(l)
-    chunks = [l[i::n] for i in range(n)]
-    assert sum(len(c) for c in chunks) == len(l)
-    return chunks
+    bounds = np.cumsum(costs)
+    total = bounds[-1] if len(bounds) else 0
+    ranges = []
+    start = 0
+    for i in range(1, n + 1):
+        end = int(np.searchsorted(bounds, total * i / n, side="right")) if i < n else len(bounds)
+        ranges.append((start, end))
+        start = end
+    return ranges
 
 def get_rules_bitmask(langs, rules):
     rules_langs = [0] * len(rules)
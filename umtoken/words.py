@@ -0,0 +1,221 @@
+# Path: umtoken/words.py
+
+import json
+import os
+from collections.abc import Sequence
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .utils import length_cost
+
+BLOCK_SIZE = 64 * 1024 # words per block when iterating or writing tables
+
+# the columns of a table on disk (see WordTable.save)
+COLUMNS = [("buffer", np.uint8), ("offsets", np.int64), ("counts", np.float32), ("lang_ids", np.uint8)]
+
+class WordTable(Sequence):
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray, counts: np.ndarray, lang_ids: np.ndarray,
+                 langs: List[Optional[str]], path: Optional[str] = None, start: int = 0):
+        """
+        The training words in columns: the concatenated words (UTF-8), the offsets of the words,
+        their counts and the indices of their languages.
+
+        Compared to a list of (word, count) tuples, the table needs a fraction of the memory, slices are views
+        (no copies), and only the sliced part is pickled (e.g., when the shards are sent to the workers).
+        The table is a sequence of (word, count) tuples, so it can be iterated like the list.
+
+        Args:
+            buffer: The encoded words (uint8).
+            offsets: The start of each word in the buffer and the end of the last word (int64, len(words) + 1).
+            counts: The counts of the words (float32).
+            lang_ids: The index of the language of each word in langs (uint8).
+            langs: The languages, langs[0] is None (all languages).
+            path: The directory the table is mapped from (see load), slices of mapped tables are pickled
+                  as references to the directory, so that workers map the files instead of receiving the words.
+            start: The index of the first word of the table in the mapped table.
+        """
+        assert len(offsets) == len(counts) + 1 and len(counts) == len(lang_ids)
+        assert len(langs) <= 256 and langs[0] is None
+        self.buffer = buffer
+        self.offsets = offsets
+        self.counts = counts
+        self.lang_ids = lang_ids
+        self.langs = langs
+        self.path = path
+        self.start = start
+
+    @staticmethod
+    def from_words(words: List[str], counts, lang_ids=None, langs: Optional[List[Optional[str]]] = None) -> "WordTable":
+        """
+        Creates a table from a list of words.
+
+        Args:
+            words: The words.
+            counts: The counts of the words.
+            lang_ids: The index of the language of each word in langs (default: None = all languages).
+            langs: The languages, langs[0] must be None (default: [None]).
+
+        Returns:
+            The table.
+        """
+        encoded = [w.encode("utf-8", "surrogatepass") for w in words]
+        buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(words)), out=offsets[1:])
+        if lang_ids is None:
+            lang_ids = np.zeros(len(words), dtype=np.uint8)
+        return WordTable(buffer, offsets, np.asarray(counts, dtype=np.float32), np.asarray(lang_ids, dtype=np.uint8),
+                         langs or [None])
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, "Only contiguous slices are supported"
+            stop = max(start, stop)
+            return WordTable(self.buffer, self.offsets[start:stop+1], self.counts[start:stop],
+                             self.lang_ids[start:stop], self.langs, self.path, self.start + start)
+        return self.word(index), float(self.counts[index])
+
+    def __iter__(self) -> Iterator[Tuple[str, float]]:
+        for b in range(0, len(self), BLOCK_SIZE):
+            block = self[b:b+BLOCK_SIZE]
+            yield from zip(block.iter_words(), block.counts.tolist())
+
+    def __reduce__(self):
+        if self.path is not None:
+            return _load_slice, (self.path, self.start, self.start + len(self))
+        # rebase the offsets, so that only the viewed part of the buffer is pickled
+        s, e = self.offsets[0], self.offsets[-1]
+        return WordTable, (self.buffer[s:e], self.offsets - s, self.counts, self.lang_ids, self.langs)
+
+    def word(self, index: int) -> str:
+        """Returns the word at index."""
+        s, e = self.offsets[index], self.offsets[index + 1]
+        return self.buffer[s:e].tobytes().decode("utf-8", "surrogatepass")
+
+    def iter_words(self) -> Iterator[str]:
+        """Yields the words (block by block, so that mapped tables are not read at once)."""
+        for b in range(0, len(self), BLOCK_SIZE):
+            offsets = self.offsets[b:b+BLOCK_SIZE+1]
+            data = self.buffer[offsets[0]:offsets[-1]].tobytes()
+            offsets = (offsets - offsets[0]).tolist()
+            for s, e in zip(offsets, offsets[1:]):
+                yield data[s:e].decode("utf-8", "surrogatepass")
+
+    def sizes(self) -> np.ndarray:
+        """Returns the encoded lengths of the words (bytes)."""
+        return np.diff(self.offsets)
+
+    def costs(self) -> np.ndarray:
+        """Returns the estimated cost of processing each word (see utils.word_cost, based on the encoded lengths)."""
+        return length_cost(self.sizes())
+
+    def save(self, path: str):
+        """Saves the table to a directory (one file per column, see load)."""
+        with WordTableWriter(path, self.langs) as writer:
+            for b in range(0, len(self), BLOCK_SIZE):
+                writer.append_table(self[b:b+BLOCK_SIZE])
+
+    @staticmethod
+    def load(path: str, mmap: bool = True) -> "WordTable":
+        """
+        Loads a table from a directory (see save and WordTableWriter).
+
+        Args:
+            path: The directory.
+            mmap: Whether to map the columns into memory instead of reading them, so that the words are read
+                  from disk when they are accessed (and only the accessed parts are held in memory).
+
+        Returns:
+            The table.
+        """
+        with open(os.path.join(path, "langs.json"), "r", encoding="utf8") as f:
+            langs = json.load(f)
+        columns = []
+        for name, dtype in COLUMNS:
+            file = os.path.join(path, f"{name}.bin")
+            # empty files cannot be mapped
+            if mmap and os.path.getsize(file) > 0:
+                columns.append(np.memmap(file, dtype=dtype, mode="r"))
+            else:
+                columns.append(np.fromfile(file, dtype=dtype))
+        return WordTable(*columns, langs, path=path if mmap else None)
+
+    @property
+    def lang_by_words(self) -> "LangColumn":
+        """The language of each word (None: all languages), a view of the table."""
+        return LangColumn(self.lang_ids, self.langs)
+
+class WordTableWriter():
+    def __init__(self, path: str, langs: List[Optional[str]]):
+        """
+        Writes a table to a directory block by block, so that tables larger than the memory can be written
+        (see WordTable.load). Must be closed (or used as a context manager).
+
+        Args:
+            path: The directory (created if necessary, existing tables are overwritten).
+            langs: The languages, langs[0] must be None.
+        """
+        assert langs[0] is None
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "langs.json"), "w", encoding="utf8") as f:
+            json.dump(langs, f, ensure_ascii=False)
+        self.files = {name: open(os.path.join(path, f"{name}.bin"), "wb") for name, _ in COLUMNS}
+        self.size = 0
+        self.files["offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def append(self, words: List[str], counts, lang_ids=None):
+        """Appends words with their counts and language indices (default: None = all languages)."""
+        self.append_table(WordTable.from_words(words, counts, lang_ids))
+
+    def append_table(self, table: WordTable):
+        """Appends the words of a table (with the same languages)."""
+        s, e = table.offsets[0], table.offsets[-1]
+        self.files["buffer"].write(np.ascontiguousarray(table.buffer[s:e]).tobytes())
+        self.files["offsets"].write((table.offsets[1:] - s + self.size).astype(np.int64).tobytes())
+        self.files["counts"].write(np.ascontiguousarray(table.counts, dtype=np.float32).tobytes())
+        self.files["lang_ids"].write(np.ascontiguousarray(table.lang_ids, dtype=np.uint8).tobytes())
+        self.size += int(e - s)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _load_slice(path: str, start: int, end: int) -> WordTable:
+    return WordTable.load(path)[start:end]
+
+class LangColumn(Sequence):
+    def __init__(self, lang_ids: np.ndarray, langs: List[Optional[str]]):
+        """
+        The languages of the words of a WordTable, as a sequence of languages (or None), slices are views.
+
+        Args:
+            lang_ids: The index of the language of each word in langs (uint8).
+            langs: The languages, langs[0] is None (all languages).
+        """
+        self.lang_ids = lang_ids
+        self.langs = langs
+
+    def __len__(self) -> int:
+        return len(self.lang_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LangColumn(self.lang_ids[index], self.langs)
+        return self.langs[self.lang_ids[index]]
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        langs = self.langs
+        for b in range(0, len(self.lang_ids), BLOCK_SIZE):
+            yield from (langs[i] for i in self.lang_ids[b:b+BLOCK_SIZE].tolist())